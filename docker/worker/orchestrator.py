@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
+import collections
 import json
 import logging
 import os
+import random
+import signal
 import subprocess
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import getenv
 from subprocess import CalledProcessError
 
-from azure.storage.queue import (
-    BinaryBase64DecodePolicy,
-    BinaryBase64EncodePolicy,
-    QueueClient,
-    QueueMessage,
+from prometheus_client import Counter, Gauge, start_http_server
+from queues import WorkQueue, open_queue
+from scheduler import RunHistory, Scheduler
+from warm_worker import (
+    ProcessorError,
+    WarmWorkerPool,
+    WarmWorkerTimeout,
+    has_entry_point,
+    warm_module,
 )
 
 logging.basicConfig(
@@ -22,82 +31,180 @@ logger = logging.getLogger(__name__)
 logging.getLogger("azure").setLevel(logging.ERROR)
 logging.getLogger("urllib3").setLevel(logging.ERROR)
 
+# Poll efficiency, served on WORKER_METRICS_PORT if it's set.
+POLLS = Counter("worker_polls", "Receive calls made to the queue, by result.", ["result"])
+MESSAGES_RECEIVED = Counter("worker_messages_received", "Messages received from the queue.")
+JOBS = Counter("worker_jobs", "Jobs run, by outcome.", ["outcome"])
+IDLE_SECONDS = Counter("worker_idle_seconds", "Time spent waiting between empty polls.")
+POLL_DELAY = Gauge("worker_poll_delay_seconds", "Current delay before the next poll.")
+
 
 class Orchestrator:
-    inbound_queue = None  # type: QueueClient
-    outbound_queue = None  # type: QueueClient
+    inbound_queue = None  # type: WorkQueue
+    outbound_queue = None  # type: WorkQueue
 
     @staticmethod
-    def initialize_queue(connection_string: str, queue_name: str) -> QueueClient:
-        """Initialize a queue given the connection string and queue name."""
-        if connection_string is None or queue_name is None:
-            return None
+    def initialize_queue(connection_string: str, queue_name: str) -> WorkQueue:
+        """
+        Initialize a queue given the connection string and queue name, on the backend
+        named by WORKER_QUEUE_BACKEND (azure, redis or memory; default: azure).
+        """
+        return open_queue(os.getenv("WORKER_QUEUE_BACKEND", "azure"), connection_string, queue_name)
 
-        client = None
-        try:
-            client = QueueClient.from_connection_string(connection_string, queue_name)
-            client.message_encode_policy = BinaryBase64EncodePolicy()
-            client.message_decode_policy = BinaryBase64DecodePolicy()
+    def __init__(
+        self,
+        inbound_queue=None,
+        outbound_queue=None,
+        config: dict = None,
+        history: RunHistory = None,
+    ):
+        """
+        Initialize a new Orchestrator object.
+
+        The queues and configuration are read from the environment unless they're passed
+        in (for instance, InMemoryQueue objects for testing). If there's a run history
+        (from SCHEDULER_STATE_FILE), jobs whose data is still fresh are skipped and each
+        job's outcome is recorded for the scheduler.
+        """
+
+        if inbound_queue is None:
+            inbound_queue = Orchestrator.initialize_queue(
+                os.getenv("DEFAULT_QUEUE_CONNECTION_STRING"), os.getenv("DEFAULT_QUEUE_WORK_TO_DO")
+            )
+        self.inbound_queue = inbound_queue
+
+        if outbound_queue is None:
+            outbound_queue = Orchestrator.initialize_queue(
+                os.getenv("DEFAULT_QUEUE_CONNECTION_STRING"),
+                os.getenv("DEFAULT_QUEUE_WORK_COMPLETE"),
+            )
+        self.outbound_queue = outbound_queue
+
+        if config is not None:
+            self.config = config
+        else:
             try:
-                client.create_queue()
-            except:
-                pass  # OK to ignore
-        except:
-            client = None
+                config_filename = os.getenv("CONFIGURATION_FILE")
+                if not os.path.exists(config_filename):
+                    raise FileNotFoundError("Missing configuration file.")
 
-        return client
+                with open(config_filename, "r") as f:
+                    self.config = json.load(f)
+            except Exception as msg:
+                logger.error("Unable to read configuration: %s", msg, exc_info=True)
+                raise
 
-    def __init__(self):
-        """Initialize a new Orchestrator object."""
+        if history is None and os.getenv("SCHEDULER_STATE_FILE"):
+            history = RunHistory(os.getenv("SCHEDULER_STATE_FILE"))
+        self.scheduler = Scheduler(self.config, self.inbound_queue, history) if history else None
 
-        self.inbound_queue = Orchestrator.initialize_queue(
-            os.getenv("DEFAULT_QUEUE_CONNECTION_STRING"), os.getenv("DEFAULT_QUEUE_WORK_TO_DO")
-        )
+        # Jobs are subprocesses, so the pool's threads only wait on them.
+        self.concurrency = int(os.getenv("WORKER_CONCURRENCY", os.cpu_count() or 1))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
 
-        self.outbound_queue = Orchestrator.initialize_queue(
-            os.getenv("DEFAULT_QUEUE_CONNECTION_STRING"), os.getenv("DEFAULT_QUEUE_WORK_COMPLETE")
-        )
+        # Azure Storage Queues return at most 32 messages at a time. Messages stay hidden
+        # from other workers for visibility_timeout seconds, which should cover the time
+        # to run a whole batch.
+        self.messages_per_batch = min(32, int(os.getenv("WORKER_BATCH_SIZE", self.concurrency)))
+        self.visibility_timeout = int(os.getenv("WORKER_VISIBILITY_TIMEOUT", "600"))
 
-        try:
-            config_filename = os.getenv("CONFIGURATION_FILE")
-            if not os.path.exists(config_filename):
-                raise FileNotFoundError("Missing configuration file.")
+        # Warm workers: processors written as `python -m <module> $TARGET` run in
+        # long-lived processes (one pool per job-name) instead of a new interpreter per job.
+        # Jobs can opt out with "warm": false.
+        self.warm = os.getenv("WORKER_WARM_PROCESSORS", "").lower() in ("1", "true", "yes")
+        self.warm_max_jobs = int(os.getenv("WORKER_WARM_MAX_JOBS", "100"))
+        self.warm_pools = {}  # job-name -> WarmWorkerPool
+        self.warm_lock = threading.Lock()
 
-            with open(config_filename, "r") as f:
-                self.config = json.load(f)
-        except Exception as msg:
-            logger.error("Unable to read configuration: %s", msg, exc_info=True)
-            raise
+    def execute(self) -> int:
+        """
+        Receives a batch of messages and runs all of their jobs on the worker pool.
 
-    def execute(self):
-        messages = self.inbound_queue.receive_messages()  # Only gets one message
+        Each message is deleted once (at most), after all of its jobs have finished. The
+        batch's responses are sent together, and then its finished messages are deleted
+        together. Returns the number of messages received.
+        """
+        messages = self.receive()
         if not messages:
-            logger.debug("receive_messages() was empty.")
-            return
-
-        try:
-            message = next(messages)
-        except StopIteration:
             logger.debug("No messages found on queue.")
-            return
+            return 0
 
+        logger.debug("Received %d messages.", len(messages))
+        remaining = {}  # message id -> number of jobs still running
+        outcomes = collections.defaultdict(list)  # message id -> [(job, result)]
+        futures = {}
+        responses = []
+        finished = []  # messages to delete
+
+        for message in messages:
+            content = self.parse_message(message)
+            if content is None:
+                continue  # Do not delete message
+
+            jobs = self.find_jobs(content)
+            logger.debug("Job list: %s", jobs)
+            if not jobs:
+                continue
+
+            if self.scheduler:
+                jobs = [job for job in jobs if self.scheduler.is_due(job, content.get("target"))]
+                if not jobs:
+                    logger.info("Dropping request for [%s], it is up to date.", message.id)
+                    finished.append(message)
+                    continue
+
+            remaining[message.id] = len(jobs)
+            for job in jobs:
+                future = self.executor.submit(self.run_job, job, content.get("target"))
+                futures[future] = (message, content, job)
+
+        for future in as_completed(futures):
+            message, content, job = futures[future]
+            try:
+                result = future.result()
+            except Exception as msg:
+                logger.warning("Error running [%s]: %s", job.get("job-name"), msg, exc_info=True)
+                result = None
+            outcomes[message.id].append((job, result))
+            remaining[message.id] -= 1
+            if remaining[message.id] == 0:
+                try:
+                    message_responses, done = self.complete(
+                        content, outcomes.pop(message.id), message.dequeue_count
+                    )
+                    responses.extend(message_responses)
+                    if done:
+                        finished.append(message)
+                except Exception as msg:
+                    logger.warning("Error completing message %s: %s", message.id, msg)
+
+        self.flush(responses, finished)
+        return len(messages)
+
+    def receive(self) -> list:
+        """Receives up to messages_per_batch messages, hiding them while they're processed."""
+        return self.inbound_queue.receive_messages(
+            max_messages=self.messages_per_batch, visibility_timeout=self.visibility_timeout
+        )
+
+    def parse_message(self, message) -> dict:
+        """Returns the content of a job request, or None if the message isn't one."""
         try:
             content = json.loads(message.content)
         except Exception as msg:
             logger.warning("Message content [%s] was not JSON: %s", message.content, msg)
-            return
-
-        success = False
-        result = None
+            return None
 
         if content.get("message-type") != "job-request":
             logger.debug("Message type [%s] was not a job-request.", content.get("message-type"))
-            return  # Do not delete message
-
-        target = content.get("target")
+            return None
+        return content
 
-        # Figure out which processor(s) to use
-        # In theory, there could be multiple processors for the same job name.
+    def find_jobs(self, content: dict) -> list:
+        """
+        Figures out which processor(s) to use.
+        In theory, there could be multiple processors for the same job name.
+        """
         jobs = []
         for job in self.config.get("config", []):
             if (
@@ -106,66 +213,222 @@ class Orchestrator:
                 and job.get("job-name") == content.get("job-name")
             ):
                 jobs.append(job)
+        return sorted(jobs, key=lambda j: j.get("ordering", 0))
 
-        logger.debug("Job list: %s", jobs)
-        for job in sorted(jobs, key=lambda j: j.get("ordering", 0)):
-            can_execute = True
-            cmd = []
-            for param in job.get("cmd", []):
-                value = param.replace("$TARGET", target)
-                cmd.append(value)
-
-            logger.debug("Assembled command: %s", cmd)
-
-            # Process requires
-            for require in job.get("requires"):
-                if require.startswith("env:") and os.getenv(require[4:]) is None:
-                    logger.warning("Missing required environment variable: %s", require)
-                    can_execute = False
-                    continue
+    def run_job(self, job: dict, target: str):
+        """
+        Runs a single job in a subprocess (or a warm worker), within the job's timeout.
+        Called from the worker pool. Returns the parsed result, or None if the job failed.
+        """
+        cmd = []
+        for param in job.get("cmd", []):
+            value = param.replace("$TARGET", target)
+            cmd.append(value)
 
-            if can_execute:
-                private_env = os.environ.copy()
-                # TODO Remove additional environment variables that could be sensitive.
-                # Only those specified in requires should be passed in.
-                del private_env["DEFAULT_QUEUE_CONNECTION_STRING"]
-                timeout = int(job.get("timeout", "60"))
-                try:
-                    result = subprocess.check_output(cmd, env=private_env, timeout=timeout)
-                    result = json.loads(result)
-                    success = True
-                except CalledProcessError as msg:
-                    logger.warning("Command [%s] did not return successfully: %s", cmd, msg)
-                    success = False
-                except subprocess.TimeoutExpired as msg:
-                    logger.warning("Command [%s] took too long to complete: %s", cmd, msg)
-                    success = False
-                except Exception as msg:
-                    logger.warning("Error processing [%s]: %s", cmd, msg, exc_info=True)
-                    success = False
-
-                if success:
-                    response_message = json.dumps(
-                        {
-                            "message-type": "job-response",
-                            "target": target,
-                            "job-name": job.get("job-name"),
-                            "correlation-id": message.get("correlation-id"),
-                            "result": result,
-                        }
-                    )
-                    self.outbound_queue.send_message(response_message)
-                    self.inbound_queue.delete_message(message)
+        logger.debug("Assembled command: %s", cmd)
+
+        # Process requires
+        for require in job.get("requires", []):
+            if require.startswith("env:") and os.getenv(require[4:]) is None:
+                logger.warning("Missing required environment variable: %s", require)
+                return None
+
+        private_env = os.environ.copy()
+        # TODO Remove additional environment variables that could be sensitive.
+        # Only those specified in requires should be passed in.
+        private_env.pop("DEFAULT_QUEUE_CONNECTION_STRING", None)
+        timeout = int(job.get("timeout", "60"))
+
+        pool = self.get_warm_pool(job, private_env)
+        if pool is not None:
+            try:
+                return pool.run(target, timeout)
+            except ProcessorError as msg:
+                logger.warning("Processor for [%s] failed: %s", job.get("job-name"), msg)
+                return None
+            except WarmWorkerTimeout as msg:
+                # Running it again as a subprocess would hold the batch for another timeout.
+                logger.warning("Processor for [%s] took too long: %s", job.get("job-name"), msg)
+                return None
+            except Exception as msg:
+                # The worker exited, couldn't start or sent something garbled.
+                logger.warning(
+                    "Warm worker for [%s] failed, running a subprocess: %s",
+                    job.get("job-name"),
+                    msg,
+                )
+
+        try:
+            result = subprocess.check_output(cmd, env=private_env, timeout=timeout)
+            return json.loads(result)
+        except CalledProcessError as msg:
+            logger.warning("Command [%s] did not return successfully: %s", cmd, msg)
+        except subprocess.TimeoutExpired as msg:
+            logger.warning("Command [%s] took too long to complete: %s", cmd, msg)
+        except Exception as msg:
+            logger.warning("Error processing [%s]: %s", cmd, msg, exc_info=True)
+        return None
+
+    def get_warm_pool(self, job: dict, env: dict) -> WarmWorkerPool:
+        """
+        Returns the warm worker pool for a job, or None if it runs as a subprocess. Only
+        processors that define `process(target)` are warmed, since importing any other
+        module would run it as a script.
+        """
+        if not self.warm or not job.get("warm", True):
+            return None
+        module_name = warm_module(job.get("cmd", []))
+        if module_name is None:
+            return None
+
+        with self.warm_lock:
+            if job.get("job-name") not in self.warm_pools:
+                pool = None
+                if has_entry_point(module_name):
+                    pool = WarmWorkerPool(job["cmd"][0], module_name, env, self.warm_max_jobs)
+                else:
+                    logger.info("Not warming %s, it has no process() function.", module_name)
+                self.warm_pools[job.get("job-name")] = pool
+            return self.warm_pools[job.get("job-name")]
+
+    def close(self):
+        """Waits for running jobs, then stops any warm workers."""
+        self.executor.shutdown(wait=True)
+        with self.warm_lock:
+            pools, self.warm_pools = list(self.warm_pools.values()), {}
+        for pool in pools:
+            if pool is not None:
+                pool.close()
+
+    def complete(self, content: dict, outcomes: list, dequeue_count: int):
+        """
+        Returns a response for each job that succeeded, and whether the message is done
+        with: if any job succeeded or it has already been retried enough.
+        """
+        responses = []
+        for job, result in outcomes:
+            JOBS.labels("failure" if result is None else "success").inc()
+            if self.scheduler:
+                self.scheduler.history.record(
+                    job.get("job-name"), content.get("target"), result is not None
+                )
+            if result is None:
+                continue
+            responses.append(
+                json.dumps(
+                    {
+                        "message-type": "job-response",
+                        "target": content.get("target"),
+                        "job-name": job.get("job-name"),
+                        "correlation-id": content.get("correlation-id"),
+                        "result": result,
+                    }
+                )
+            )
+
+        if responses:
+            return responses, True
+        if dequeue_count > 2:
+            logger.info("Removing message - we tried but failed.")
+            return responses, True
+        return responses, False
+
+    def flush(self, responses: list, finished: list):
+        """
+        Sends the batch's responses, then deletes its finished messages. If the responses
+        can't be sent, the messages are left to be received (and run) again.
+        """
+        try:
+            if responses:
+                self.outbound_queue.send_messages(responses)
+        except Exception as msg:
+            logger.warning("Error sending %d responses: %s", len(responses), msg)
+            return
+
+        if finished:
+            try:
+                self.inbound_queue.delete_messages(finished)
+            except Exception as msg:
+                logger.warning("Error deleting %d messages: %s", len(finished), msg)
+
+
+class PollLoop:
+    """
+    Runs the Orchestrator until it is stopped, polling adaptively.
+
+    While messages keep arriving, the queue is polled again immediately. Each empty poll
+    doubles the delay before the next one, from min_delay up to max_delay (with some
+    jitter, so idle workers don't poll in lockstep), and any message resets it.
+
+    SIGTERM and SIGINT stop the loop gracefully: the current batch is finished (and its
+    messages deleted) before exiting, and a sleeping loop wakes up right away.
+    """
+
+    def __init__(self, orchestrator: Orchestrator, min_delay: float = 1, max_delay: float = 60):
+        self.orchestrator = orchestrator
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.stopping = threading.Event()
+
+        self.num_polls = 0
+        self.num_empty_polls = 0
+        self.num_messages = 0
 
-                    # TODO: Bug: If we have multiple jobs running on the same target, we'll
-                    # send multiple responses and delete the message multiple times.
-                elif message.dequeue_count > 2:
-                    logger.info("Removing message - we tried but failed.")
-                    self.inbound_queue.delete_message(message)
+    def next_delay(self, num_messages: int) -> float:
+        if num_messages:
+            self.delay = 0.0
+        else:
+            self.delay = min(self.max_delay, max(self.min_delay, self.delay * 2))
+        return self.delay
+
+    def stop(self, signum=None, frame=None):
+        logger.info("Stopping after the current batch (signal %s).", signum)
+        self.stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping.is_set():
+            try:
+                num_messages = self.orchestrator.execute()
+            except Exception as msg:
+                logger.warning("Error processing batch: %s", msg, exc_info=True)
+                num_messages = 0
+
+            self.num_polls += 1
+            self.num_messages += num_messages
+            if num_messages:
+                POLLS.labels("messages").inc()
+                MESSAGES_RECEIVED.inc(num_messages)
+            else:
+                self.num_empty_polls += 1
+                POLLS.labels("empty").inc()
+
+            delay = self.next_delay(num_messages)
+            POLL_DELAY.set(delay)
+            if delay:
+                delay *= random.uniform(0.8, 1.0)
+                start_time = time.monotonic()
+                self.stopping.wait(delay)
+                IDLE_SECONDS.inc(time.monotonic() - start_time)
+
+        self.orchestrator.close()
+        logger.info(
+            "Stopped after %d polls (%d empty), %d messages received.",
+            self.num_polls,
+            self.num_empty_polls,
+            self.num_messages,
+        )
 
 
 if __name__ == "__main__":
-    orchestrator = Orchestrator()
-    while True:
-        orchestrator.execute()
-        time.sleep(3)
+    if os.getenv("WORKER_METRICS_PORT"):
+        start_http_server(int(os.getenv("WORKER_METRICS_PORT")))
+
+    PollLoop(
+        Orchestrator(),
+        min_delay=float(os.getenv("WORKER_POLL_MIN_DELAY", "1")),
+        max_delay=float(os.getenv("WORKER_POLL_MAX_DELAY", "60")),
+    ).run()
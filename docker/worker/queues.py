@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Queue backends for the worker. Each backend receives messages in batches (hiding them
+# from other workers for a visibility timeout), and sends and deletes them in batches.
+# Received messages have the same attributes as an Azure QueueMessage: id, content,
+# dequeue_count and pop_receipt.
+#
+#   azure   Azure Storage Queues (the default). The connection string is a storage
+#           account connection string.
+#   redis   Redis lists and hashes. The connection string is a URL, such as
+#           redis://redis:6379/0.
+#   memory  In-process queues, for running and benchmarking workers locally.
+
+import collections
+import itertools
+import logging
+import threading
+import time
+import uuid
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+QUEUE_BACKENDS = ["azure", "redis", "memory"]
+
+
+class Message:
+    """A message received from a Redis or in-memory queue."""
+
+    def __init__(self, content, id: str = None, dequeue_count: int = 0, pop_receipt: str = None):
+        self.id = id or str(uuid.uuid4())
+        self.content = content
+        self.dequeue_count = dequeue_count
+        self.pop_receipt = pop_receipt
+        self.next_visible_on = 0.0
+
+
+class WorkQueue:
+    """Base class for queue backends."""
+
+    def send_messages(self, contents: Iterable):
+        raise NotImplementedError()
+
+    def receive_messages(self, max_messages: int = 1, visibility_timeout: int = 30) -> list:
+        raise NotImplementedError()
+
+    def delete_messages(self, messages: Iterable) -> int:
+        """Deletes messages that are still hidden by this receive. Returns the count."""
+        raise NotImplementedError()
+
+    def send_message(self, content):
+        self.send_messages([content])
+
+    def delete_message(self, message):
+        if not self.delete_messages([message]):
+            raise KeyError(f"Message {message.id} not found, or its pop receipt changed.")
+
+
+class AzureQueue(WorkQueue):
+    """
+    An Azure Storage Queue. The service has no batch operations, so batches are sent and
+    deleted one message at a time (over one connection); receives are batched, up to 32.
+    """
+
+    def __init__(self, connection_string: str, queue_name: str):
+        from azure.storage.queue import (
+            BinaryBase64DecodePolicy,
+            BinaryBase64EncodePolicy,
+            QueueClient,
+        )
+
+        self.client = QueueClient.from_connection_string(connection_string, queue_name)
+        self.client.message_encode_policy = BinaryBase64EncodePolicy()
+        self.client.message_decode_policy = BinaryBase64DecodePolicy()
+        try:
+            self.client.create_queue()
+        except:
+            pass  # OK to ignore
+
+    def send_messages(self, contents: Iterable):
+        for content in contents:
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            self.client.send_message(content)
+
+    def receive_messages(self, max_messages: int = 1, visibility_timeout: int = 30) -> list:
+        max_messages = min(32, max_messages)
+        messages = self.client.receive_messages(
+            messages_per_page=max_messages, visibility_timeout=visibility_timeout
+        )
+        return list(itertools.islice(messages, max_messages))
+
+    def delete_messages(self, messages: Iterable) -> int:
+        num_deleted = 0
+        for message in messages:
+            try:
+                self.client.delete_message(message)
+                num_deleted += 1
+            except Exception as msg:
+                logger.warning("Unable to delete message %s: %s", message.id, msg)
+        return num_deleted
+
+
+class RedisQueue(WorkQueue):
+    """
+    A queue in Redis, with the same visibility semantics as Azure Storage Queues.
+
+    Message ids wait in a list; their content, dequeue counts and pop receipts are kept in
+    hashes. Received messages move to a sorted set, scored by when they become visible
+    again, and go back to the front of the list once that has passed. Receives and
+    deletes are Lua scripts, so each batch is one atomic round trip.
+    """
+
+    RECEIVE_SCRIPT = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+        for _, id in ipairs(expired) do
+            redis.call('ZREM', KEYS[2], id)
+            redis.call('HDEL', KEYS[5], id)
+            redis.call('RPUSH', KEYS[1], id)
+        end
+        local received = {}
+        for i = 1, tonumber(ARGV[3]) do
+            local id = redis.call('RPOP', KEYS[1])
+            if not id then break end
+            local content = redis.call('HGET', KEYS[3], id)
+            if content then
+                local count = redis.call('HINCRBY', KEYS[4], id, 1)
+                local receipt = ARGV[4] .. ':' .. i
+                redis.call('ZADD', KEYS[2], ARGV[2], id)
+                redis.call('HSET', KEYS[5], id, receipt)
+                table.insert(received, {id, content, count, receipt})
+            end
+        end
+        return received
+    """
+
+    DELETE_SCRIPT = """
+        local deleted = 0
+        for i = 1, #ARGV, 2 do
+            if redis.call('HGET', KEYS[5], ARGV[i]) == ARGV[i + 1] then
+                redis.call('ZREM', KEYS[2], ARGV[i])
+                redis.call('HDEL', KEYS[3], ARGV[i])
+                redis.call('HDEL', KEYS[4], ARGV[i])
+                redis.call('HDEL', KEYS[5], ARGV[i])
+                deleted = deleted + 1
+            end
+        end
+        return deleted
+    """
+
+    def __init__(self, url: str, queue_name: str, client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+
+        # The hash tag keeps all of a queue's keys in the same slot on a Redis Cluster.
+        self.keys = [
+            f"{{{queue_name}}}:{name}"
+            for name in ("ready", "hidden", "content", "dequeues", "receipts")
+        ]
+        self.receive_script = self.client.register_script(self.RECEIVE_SCRIPT)
+        self.delete_script = self.client.register_script(self.DELETE_SCRIPT)
+
+    def send_messages(self, contents: Iterable):
+        messages = {str(uuid.uuid4()): content for content in contents}
+        if not messages:
+            return
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.keys[2], mapping=messages)
+        pipeline.lpush(self.keys[0], *messages.keys())
+        pipeline.execute()
+
+    def receive_messages(self, max_messages: int = 1, visibility_timeout: int = 30) -> list:
+        now = time.time()
+        received = self.receive_script(
+            keys=self.keys,
+            args=[now, now + visibility_timeout, max_messages, uuid.uuid4().hex],
+        )
+        return [
+            Message(content, id=id, dequeue_count=int(count), pop_receipt=receipt)
+            for id, content, count, receipt in received
+        ]
+
+    def delete_messages(self, messages: Iterable) -> int:
+        args = []
+        for message in messages:
+            args.extend([message.id, message.pop_receipt])
+        if not args:
+            return 0
+        num_deleted = self.delete_script(keys=self.keys, args=args)
+        if num_deleted < len(args) // 2:
+            logger.warning(
+                "Deleted %d of %d messages; the rest were received again.",
+                num_deleted,
+                len(args) // 2,
+            )
+        return num_deleted
+
+    def __len__(self):
+        return self.client.hlen(self.keys[2])
+
+
+class InMemoryQueue(WorkQueue):
+    """
+    An in-process queue, for running the Orchestrator without a storage account or
+    Redis. It implements visibility timeouts and pop receipts like the other backends.
+    """
+
+    def __init__(self):
+        self.messages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def send_messages(self, contents: Iterable):
+        with self.lock:
+            for content in contents:
+                message = Message(content)
+                self.messages[message.id] = message
+
+    def receive_messages(self, max_messages: int = 1, visibility_timeout: int = 30) -> list:
+        now = time.monotonic()
+        received = []
+        with self.lock:
+            for message in self.messages.values():
+                if len(received) >= (max_messages or 1):
+                    break
+                if message.next_visible_on > now:
+                    continue
+                message.dequeue_count += 1
+                message.pop_receipt = str(uuid.uuid4())
+                message.next_visible_on = now + (visibility_timeout or 30)
+                # A copy, so that a stale receipt stays stale.
+                received.append(
+                    Message(
+                        message.content,
+                        id=message.id,
+                        dequeue_count=message.dequeue_count,
+                        pop_receipt=message.pop_receipt,
+                    )
+                )
+        return received
+
+    def delete_messages(self, messages: Iterable) -> int:
+        num_deleted = 0
+        with self.lock:
+            for message in messages:
+                stored = self.messages.get(message.id)
+                if stored is not None and stored.pop_receipt == message.pop_receipt:
+                    del self.messages[message.id]
+                    num_deleted += 1
+        return num_deleted
+
+    def __len__(self):
+        return len(self.messages)
+
+
+# In-memory queues are shared by name within a process, like the other backends.
+_memory_queues = {}
+_memory_queues_lock = threading.Lock()
+
+
+def open_queue(backend: str, connection_string: str, queue_name: str) -> WorkQueue:
+    """Opens a queue on the given backend. Returns None if it isn't configured."""
+    if backend not in QUEUE_BACKENDS:
+        raise ValueError(f"Unknown queue backend: {backend}")
+    if queue_name is None:
+        return None
+
+    if backend == "memory":
+        with _memory_queues_lock:
+            if queue_name not in _memory_queues:
+                _memory_queues[queue_name] = InMemoryQueue()
+            return _memory_queues[queue_name]
+
+    if connection_string is None:
+        return None
+    try:
+        if backend == "redis":
+            return RedisQueue(connection_string, queue_name)
+        return AzureQueue(connection_string, queue_name)
+    except Exception as msg:
+        logger.error("Unable to open %s queue [%s]: %s", backend, queue_name, msg)
+        return None
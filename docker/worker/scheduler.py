@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+CADENCE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24, "w": 60 * 60 * 24 * 7}
+
+# Targets that have never been analyzed are treated as this many cadences overdue, so
+# they sort ahead of everything except very stale, more critical targets.
+NEVER_RUN_STALENESS = 10.0
+
+
+def parse_cadence(cadence: str) -> timedelta:
+    """Parse a cadence such as "30d", "12h" or "1w"."""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdw])\s*", str(cadence))
+    if not match:
+        raise ValueError(f"Invalid cadence: {cadence}")
+    return timedelta(seconds=int(match.group(1)) * CADENCE_UNITS[match.group(2)])
+
+
+class RunHistory:
+    """
+    Remembers when each (job-name, target) last ran successfully, and which are currently
+    queued, in a SQLite database. SQLite handles locking, so the scheduler and any number
+    of orchestrators on the same host can share one file.
+    """
+
+    def __init__(self, filename: str, in_flight_timeout: int = 60 * 60 * 24):
+        self.filename = filename
+        self.in_flight_timeout = in_flight_timeout
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_run (
+                    job_name TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    last_success REAL,
+                    in_flight_since REAL,
+                    PRIMARY KEY (job_name, target)
+                )
+                """
+            )
+
+    def get(self, job_name: str, target: str) -> Tuple[float, float]:
+        """Returns the (last_success, in_flight_since) timestamps, either may be None."""
+        with self.lock:
+            row = self.connection.execute(
+                """
+                SELECT last_success, in_flight_since FROM job_run
+                WHERE job_name = ? AND target = ?
+                """,
+                (job_name, target),
+            ).fetchone()
+        return row or (None, None)
+
+    def get_all(self, job_name: str) -> Dict[str, Tuple[float, float]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT target, last_success, in_flight_since FROM job_run WHERE job_name = ?",
+                (job_name,),
+            ).fetchall()
+        return {target: (last_success, in_flight) for target, last_success, in_flight in rows}
+
+    def is_in_flight(self, in_flight_since: float, now: float) -> bool:
+        """In-flight markers expire, so work whose message was lost is scheduled again."""
+        return in_flight_since is not None and now - in_flight_since < self.in_flight_timeout
+
+    def mark_in_flight(self, items: Iterable[Tuple[str, str]], now: float = None):
+        now = now or time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO job_run (job_name, target, in_flight_since) VALUES (?, ?, ?)
+                ON CONFLICT (job_name, target)
+                DO UPDATE SET in_flight_since = excluded.in_flight_since
+                """,
+                [(job_name, target, now) for job_name, target in items],
+            )
+
+    def record(self, job_name: str, target: str, success: bool, now: float = None):
+        """Records the outcome of a run, clearing its in-flight marker."""
+        now = now or time.time()
+        with self.lock, self.connection:
+            if success:
+                self.connection.execute(
+                    """
+                    INSERT INTO job_run (job_name, target, last_success) VALUES (?, ?, ?)
+                    ON CONFLICT (job_name, target)
+                    DO UPDATE SET last_success = excluded.last_success, in_flight_since = NULL
+                    """,
+                    (job_name, target, now),
+                )
+            else:
+                self.connection.execute(
+                    "UPDATE job_run SET in_flight_since = NULL WHERE job_name = ? AND target = ?",
+                    (job_name, target),
+                )
+
+
+class Scheduler:
+    """
+    Enqueues job-requests only for work that is due, according to each job's cadence.
+
+    A (job-name, target) pair is due if it has never run successfully, or its last
+    success is older than the job's cadence. Pairs that are already queued aren't queued
+    again. Due work is queued most overdue first, weighted by the target's criticality.
+    """
+
+    def __init__(self, config: dict, queue, history: RunHistory):
+        self.config = config
+        self.queue = queue
+        self.history = history
+
+    def jobs(self) -> List[dict]:
+        return [
+            job
+            for job in self.config.get("config", [])
+            if job.get("enabled", True) and job.get("exec-environment") == "docker-scanner"
+        ]
+
+    def cadence(self, job: dict) -> timedelta:
+        default = self.config.get("defaults", {}).get("cadence", "30d")
+        return parse_cadence(job.get("cadence", default))
+
+    def is_due(self, job: dict, target: str, now: float = None) -> bool:
+        now = now or time.time()
+        last_success, _ = self.history.get(job.get("job-name"), target)
+        return last_success is None or now - last_success >= self.cadence(job).total_seconds()
+
+    def plan(self, targets: Dict[str, float], now: float = None) -> List[Tuple[float, dict, str]]:
+        """
+        Returns the due work as (priority, job, target), highest priority first. Targets
+        map to their criticality, from 0 to 1.
+        """
+        now = now or time.time()
+        planned = []
+        for job in self.jobs():
+            cadence = self.cadence(job).total_seconds()
+            history = self.history.get_all(job.get("job-name"))
+            for target, criticality in targets.items():
+                last_success, in_flight_since = history.get(target, (None, None))
+                if self.history.is_in_flight(in_flight_since, now):
+                    continue
+
+                if last_success is None:
+                    staleness = NEVER_RUN_STALENESS
+                else:
+                    staleness = (now - last_success) / cadence
+                    if staleness < 1:
+                        continue
+
+                priority = min(staleness, NEVER_RUN_STALENESS) * (0.5 + (criticality or 0))
+                planned.append((priority, job, target))
+
+        planned.sort(key=lambda p: p[0], reverse=True)
+        return planned
+
+    def enqueue(self, targets: Dict[str, float], limit: int = None, now: float = None) -> int:
+        """Sends a job-request for each piece of due work (up to limit). Returns the count."""
+        now = now or time.time()
+        planned = self.plan(targets, now)
+        if limit is not None:
+            planned = planned[:limit]
+
+        requests = []
+        sent = []
+        for _, job, target in planned:
+            requests.append(
+                json.dumps(
+                    {
+                        "message-type": "job-request",
+                        "job-name": job.get("job-name"),
+                        "target": target,
+                        "metadata-subtree": job.get("metadata-subtree"),
+                        "correlation-id": str(uuid.uuid4()),
+                    }
+                )
+            )
+            sent.append((job.get("job-name"), target))
+        self.queue.send_messages(requests)
+        self.history.mark_in_flight(sent, now)
+        return len(sent)
+
+
+def read_targets(filename: str) -> Dict[str, float]:
+    """Reads targets, one per line, optionally followed by a comma and their criticality."""
+    targets = {}
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            target, _, criticality = line.partition(",")
+            try:
+                targets[target.strip()] = float(criticality) if criticality else 0.0
+            except ValueError:
+                logger.warning("Invalid criticality for target [%s], ignoring.", target)
+                targets[target.strip()] = 0.0
+    return targets
+
+
+if __name__ == "__main__":
+    from orchestrator import Orchestrator
+
+    parser = argparse.ArgumentParser(description="Enqueue job-requests for work that is due.")
+    parser.add_argument("targets", help="File with one target per line: TARGET[,CRITICALITY]")
+    parser.add_argument("--limit", type=int, help="Maximum number of job-requests to send.")
+    args = parser.parse_args()
+
+    with open(os.getenv("CONFIGURATION_FILE"), "r") as f:
+        config = json.load(f)
+
+    queue = Orchestrator.initialize_queue(
+        os.getenv("DEFAULT_QUEUE_CONNECTION_STRING"), os.getenv("DEFAULT_QUEUE_WORK_TO_DO")
+    )
+    history = RunHistory(os.getenv("SCHEDULER_STATE_FILE", "scheduler.sqlite3"))
+    count = Scheduler(config, queue, history).enqueue(read_targets(args.targets), args.limit)
+    logger.info("Enqueued %d job-requests.", count)
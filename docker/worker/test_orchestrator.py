@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Tests for the Orchestrator, run against in-memory queues:
+#
+#   cd docker/worker && python -m unittest test_orchestrator
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from orchestrator import Orchestrator
+from queues import InMemoryQueue
+
+PRINT_TARGET = "import json, sys; print(json.dumps({'target': sys.argv[1]}))"
+
+
+def job(name: str, code: str = PRINT_TARGET, ordering: int = 0) -> dict:
+    return {
+        "job-name": name,
+        "exec-environment": "docker-scanner",
+        "cmd": [sys.executable, "-c", code, "$TARGET"],
+        "timeout": "30",
+        "ordering": ordering,
+    }
+
+
+def request(job_name: str, target: str) -> str:
+    return json.dumps({"message-type": "job-request", "job-name": job_name, "target": target})
+
+
+class RecordingQueue(InMemoryQueue):
+    """An InMemoryQueue that records each batch sent and deleted."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.deleted = []
+
+    def send_messages(self, contents):
+        contents = list(contents)
+        self.sent.append(contents)
+        super().send_messages(contents)
+
+    def delete_messages(self, messages):
+        messages = list(messages)
+        self.deleted.append([message.id for message in messages])
+        return super().delete_messages(messages)
+
+
+class OrchestratorTests(unittest.TestCase):
+    def setUp(self):
+        environment = mock.patch.dict(
+            os.environ, {"WORKER_CONCURRENCY": "4", "WORKER_BATCH_SIZE": "10"}
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+        os.environ.pop("SCHEDULER_STATE_FILE", None)
+        os.environ.pop("WORKER_WARM_PROCESSORS", None)
+
+        self.inbound = RecordingQueue()
+        self.outbound = RecordingQueue()
+
+    def orchestrator(self, jobs: list) -> Orchestrator:
+        orchestrator = Orchestrator(self.inbound, self.outbound, {"config": jobs})
+        self.addCleanup(orchestrator.close)
+        return orchestrator
+
+    def responses(self) -> list:
+        return [json.loads(content) for batch in self.outbound.sent for content in batch]
+
+    def test_each_message_is_deleted_once(self):
+        # Two processors for the same job, so each message has two jobs to finish.
+        orchestrator = self.orchestrator([job("Echo"), job("Echo", ordering=1)])
+        self.inbound.send_messages([request("Echo", f"target-{i}") for i in range(5)])
+        sent_ids = list(self.inbound.messages)
+
+        self.assertEqual(orchestrator.execute(), 5)
+
+        self.assertEqual(len(self.inbound.deleted), 1)
+        self.assertEqual(sorted(self.inbound.deleted[0]), sorted(sent_ids))
+        self.assertEqual(len(self.inbound), 0)
+
+    def test_responses_are_sent_as_one_batch(self):
+        orchestrator = self.orchestrator([job("Echo")])
+        self.inbound.send_messages([request("Echo", f"target-{i}") for i in range(5)])
+
+        orchestrator.execute()
+
+        self.assertEqual(len(self.outbound.sent), 1)
+        self.assertEqual(
+            sorted(response["result"]["target"] for response in self.responses()),
+            [f"target-{i}" for i in range(5)],
+        )
+
+    def test_failing_job_does_not_lose_the_batch(self):
+        orchestrator = self.orchestrator([job("Echo"), job("Fail", "import sys; sys.exit(1)")])
+        self.inbound.send_messages(
+            [request("Echo", "first"), request("Fail", "broken"), request("Echo", "second")]
+        )
+
+        self.assertEqual(orchestrator.execute(), 3)
+
+        self.assertEqual(
+            sorted(response["target"] for response in self.responses()), ["first", "second"]
+        )
+        # The failed message stays on the queue, to be retried once it's visible again.
+        remaining = list(self.inbound.messages.values())
+        self.assertEqual([json.loads(m.content)["target"] for m in remaining], ["broken"])
+
+    def test_unexpected_error_does_not_lose_the_batch(self):
+        orchestrator = self.orchestrator([job("Echo")])
+        self.inbound.send_messages([request("Echo", "first"), request("Echo", "explode")])
+
+        run_job = orchestrator.run_job
+
+        def explode(job: dict, target: str):
+            if target == "explode":
+                raise RuntimeError("Unexpected error")
+            return run_job(job, target)
+
+        orchestrator.run_job = explode
+        orchestrator.execute()
+
+        self.assertEqual([response["target"] for response in self.responses()], ["first"])
+        remaining = list(self.inbound.messages.values())
+        self.assertEqual([json.loads(m.content)["target"] for m in remaining], ["explode"])
+
+    def test_warm_timeout_is_not_rerun_as_subprocess(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        marker = os.path.join(directory, "ran-as-script")
+        with open(os.path.join(directory, "hanging_processor.py"), "w") as f:
+            f.write(
+                "import sys, time\n"
+                "def process(target):\n"
+                "    time.sleep(30)\n"
+                "if __name__ == '__main__':\n"
+                f"    open({marker!r}, 'w').close()\n"
+            )
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+        environment = mock.patch.dict(
+            os.environ, {"WORKER_WARM_PROCESSORS": "true", "PYTHONPATH": directory}
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        hanging = {
+            "job-name": "Hang",
+            "exec-environment": "docker-scanner",
+            "cmd": [sys.executable, "-m", "hanging_processor", "$TARGET"],
+            "timeout": "1",
+        }
+        orchestrator = self.orchestrator([hanging])
+        self.inbound.send_messages([request("Hang", "slow")])
+
+        start_time = time.monotonic()
+        orchestrator.execute()
+
+        self.assertLess(time.monotonic() - start_time, 10)
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(self.responses(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Warm processor workers. Instead of starting `python -m processors.<name> $TARGET` for
+# every job, the Orchestrator can keep long-lived processes that have already imported a
+# processor (and everything it depends on), and send them one target at a time.
+#
+# Only processors that define a `process(target)` function, returning the result, can be
+# warmed. Importing a processor that is written as a script would run it, so modules are
+# checked (without importing them) first, and the others run as subprocesses.
+#
+# Protocol: the Orchestrator writes one JSON line per job ({"target": ...}) to the
+# worker's stdin, and the worker answers with one JSON line on its stdout, either
+# {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+
+import ast
+import collections
+import importlib
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WarmWorkerError(Exception):
+    """A warm worker timed out or exited; it can't be reused."""
+
+
+class ProcessorError(WarmWorkerError):
+    """The processor failed for a target; the worker itself can be reused."""
+
+
+class WarmWorkerTimeout(WarmWorkerError):
+    """The processor didn't finish a target within the job's timeout."""
+
+
+def find_module_file(module_name: str, path: list = None) -> str:
+    """Returns the source file for a module on the path, without importing anything."""
+    parts = module_name.split(".")
+    for directory in path if path is not None else [os.getcwd()] + sys.path:
+        base = os.path.join(directory or os.getcwd(), *parts)
+        for filename in (base + ".py", os.path.join(base, "__init__.py")):
+            if os.path.isfile(filename):
+                return filename
+    return None
+
+
+def has_entry_point(module_name: str, path: list = None) -> bool:
+    """Returns True if a module defines a top-level `process` function."""
+    filename = find_module_file(module_name, path)
+    if filename is None:
+        return False
+    try:
+        with open(filename, "rb") as f:
+            tree = ast.parse(f.read(), filename)
+    except (OSError, SyntaxError, ValueError):
+        return False
+    return any(
+        isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == "process"
+        for node in tree.body
+    )
+
+
+def serve(module_name: str):
+    """
+    Calls a processor module's `process(target)` for each target read from stdin. The
+    module (and its dependencies) are imported only once. Modules without a `process`
+    function are refused before they are imported: the worker exits, and the
+    Orchestrator runs the job as a subprocess instead.
+    """
+    sys.path.insert(0, os.getcwd())
+    if not has_entry_point(module_name):
+        logger.error("Refusing to warm %s, it has no process() function.", module_name)
+        sys.exit(2)
+
+    # Keep the real stdout for responses, and point file descriptor 1 at stderr so that
+    # nothing else (including programs the processor runs) can write to it.
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    sys.argv = [module_name]
+    handler = importlib.import_module(module_name).process
+
+    for line in sys.stdin:
+        try:
+            target = json.loads(line)["target"]
+            response = {"ok": True, "result": handler(target)}
+        except Exception as msg:
+            response = {"ok": False, "error": f"{type(msg).__name__}: {msg}"}
+
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+
+class WarmWorker:
+    """A long-lived process running serve() for one processor module."""
+
+    def __init__(self, python: str, module_name: str, env: dict):
+        self.module_name = module_name
+        self.num_jobs = 0
+        self.process = subprocess.Popen(
+            [python, os.path.abspath(__file__), module_name],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        self._buffer = b""
+
+    def run(self, target: str, timeout: float):
+        """Returns the result for a target, or raises WarmWorkerError."""
+        self.num_jobs += 1
+        try:
+            self.process.stdin.write((json.dumps({"target": target}) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as msg:
+            raise WarmWorkerError(f"Worker for {self.module_name} has exited: {msg}")
+
+        response = json.loads(self._read_line(time.monotonic() + timeout))
+        if not response.get("ok"):
+            raise ProcessorError(response.get("error"))
+        return response.get("result")
+
+    def _read_line(self, deadline: float) -> bytes:
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WarmWorkerTimeout(f"Worker for {self.module_name} timed out.")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise WarmWorkerError(f"Worker for {self.module_name} exited unexpectedly.")
+            self._buffer += chunk
+
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line
+
+    def close(self):
+        """Asks the worker to exit, killing it if it doesn't."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class WarmWorkerPool:
+    """
+    Warm workers for one job. Idle workers are reused; a worker that fails, times out or
+    crashes is killed, and one that has run max_jobs jobs is recycled. The Orchestrator's
+    pool bounds how many are busy at once.
+    """
+
+    def __init__(self, python: str, module_name: str, env: dict, max_jobs: int = 100):
+        self.python = python
+        self.module_name = module_name
+        self.env = env
+        self.max_jobs = max_jobs
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    def run(self, target: str, timeout: float):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = WarmWorker(self.python, self.module_name, self.env)
+
+        try:
+            return worker.run(target, timeout)
+        except ProcessorError:
+            raise
+        except Exception:
+            worker.kill()
+            worker = None
+            raise
+        finally:
+            if worker is not None:
+                self.release(worker)
+
+    def release(self, worker: WarmWorker):
+        if worker.num_jobs >= self.max_jobs:
+            worker.close()
+        else:
+            with self.lock:
+                self.idle.append(worker)
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = list(self.idle), collections.deque()
+        for worker in workers:
+            worker.close()
+
+
+def warm_module(cmd: list) -> str:
+    """Returns the module for a `python -m <module> $TARGET` command, or None."""
+    if len(cmd) == 4 and cmd[1] == "-m" and cmd[3] == "$TARGET" and "python" in cmd[0]:
+        return cmd[2]
+    return None
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
@@ -1,6 +1,7 @@
 using System;
 using System.Collections.Generic;
 using System.ComponentModel;
+using System.IO.Compression;
 using System.Linq;
 using System.Text.Json;
 using System.Threading.Tasks;
@@ -99,7 +100,13 @@ namespace MetricAPI
         public async Task<IActionResult> AddMetric(
             [HttpTrigger(AuthorizationLevel.Function, "post", Route = null)] HttpRequest req, ILogger log)
         {
-            var root = (await JsonDocument.ParseAsync(req.Body)).RootElement;
+            var body = req.Body;
+            if (req.Headers.TryGetValue("Content-Encoding", out var contentEncoding) &&
+                string.Equals(contentEncoding.ToString(), "gzip", StringComparison.OrdinalIgnoreCase))
+            {
+                body = new GZipStream(req.Body, CompressionMode.Decompress);
+            }
+            var root = (await JsonDocument.ParseAsync(body)).RootElement;
             var errorList = new List<string>();
             var currentIndex = -1;
             var totalChanges = 0;
@@ -1,18 +1,283 @@
+import contextlib
+import gzip
 import io
+import json
 import logging
 import os
+import random
+import shutil
+import sqlite3
+import stat
 import subprocess
+import tempfile
+import threading
+import time
 import zipfile
-from typing import TypeVar, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, TypeVar, Union
 
 import requests
 from dotenv import load_dotenv
 from packageurl import PackageURL
+from requests.adapters import HTTPAdapter
+
+from .GitHubTokenPool import GitHubTokenPool
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "openssf-metrics")
+
+
+class SourceRepositoryCache:
+    """
+    Remembers which source repository each PackageURL resolved to, in a SQLite database,
+    so that OSS Gadget only runs for PackageURLs that haven't been seen recently. Failed
+    lookups are cached too, for a shorter time.
+    """
+
+    def __init__(self, filename: str, ttl: int, negative_ttl: int):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS source_repository (
+                    package_url TEXT PRIMARY KEY,
+                    repository_url TEXT,
+                    resolved_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Opens a connection for one transaction, closing it afterwards."""
+        # A connection per call, since collectors may run on several threads.
+        connection = sqlite3.connect(self.filename, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_many(self, package_urls: Iterable[str]) -> Dict[str, Union[str, None]]:
+        """Returns the fresh entries for the PackageURLs; a value of None is a cached miss."""
+        package_urls = list(package_urls)
+        now = time.time()
+        found = {}
+        with self.connect() as connection:
+            for start in range(0, len(package_urls), 500):
+                chunk = package_urls[start : start + 500]
+                rows = connection.execute(
+                    "SELECT package_url, repository_url, resolved_at FROM source_repository "
+                    f"WHERE package_url IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for package_url, repository_url, resolved_at in rows:
+                    ttl = self.ttl if repository_url else self.negative_ttl
+                    if now - resolved_at < ttl:
+                        found[package_url] = repository_url
+        return found
+
+    def set_many(self, resolved: Dict[str, Union[str, None]]):
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany(
+                """
+                INSERT INTO source_repository (package_url, repository_url, resolved_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (package_url) DO UPDATE
+                SET repository_url = excluded.repository_url, resolved_at = excluded.resolved_at
+                """,
+                [(package_url, url, now) for package_url, url in resolved.items()],
+            )
+
+
+class MetricSubmitter:
+    """
+    Submits metric payloads to the metric API in batches.
+
+    Payloads are serialized as they're submitted and collected into batches of at most
+    max_batch_entries payloads and max_batch_bytes bytes (of JSON). Full batches are
+    posted in the background, gzip-compressed, with up to `concurrency` batches in flight;
+    submitting more than that waits for one to finish. Batches that fail with a
+    connection error, 429 or 5xx are retried with exponential backoff. wait() sends the
+    last partial batch and waits for everything to be posted.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        session: requests.Session,
+        max_batch_entries: int = 5000,
+        max_batch_bytes: int = 4 * 1024 * 1024,
+        concurrency: int = 4,
+        compress: bool = True,
+        max_retries: int = 5,
+        timeout: int = 120,
+    ):
+        self.endpoint = endpoint
+        self.session = session
+        self.max_batch_entries = max_batch_entries
+        self.max_batch_bytes = max_batch_bytes
+        self.compress = compress
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.in_flight = threading.BoundedSemaphore(concurrency)
+        self.futures = []
+        self.batch = []
+        self.batch_bytes = 0
+        self.lock = threading.Lock()
+
+        self.num_payloads = 0
+        self.num_batches = 0
+        self.num_failed_batches = 0
+        self.num_retries = 0
+        self.num_bytes = 0
+        self.num_bytes_sent = 0
+        self.post_seconds = 0.0
+        self.max_post_seconds = 0.0
+
+    def submit(self, payload: dict):
+        entry = json.dumps(payload).encode("utf-8")
+        if self.batch and (
+            len(self.batch) >= self.max_batch_entries
+            or self.batch_bytes + len(entry) + 1 > self.max_batch_bytes
+        ):
+            self.flush()
+        self.batch.append(entry)
+        self.batch_bytes += len(entry) + 1
+        self.num_payloads += 1
+
+    def submit_many(self, payloads: Iterable[dict]):
+        for payload in payloads:
+            self.submit(payload)
+
+    def flush(self):
+        """Posts the current batch in the background, once a slot is free."""
+        if not self.batch:
+            return
+        body = b"[" + b",".join(self.batch) + b"]"
+        self.batch = []
+        self.batch_bytes = 0
+
+        self.in_flight.acquire()
+        try:
+            self.futures.append(self.executor.submit(self._post, body))
+        except Exception:
+            self.in_flight.release()
+            raise
+
+    def wait(self) -> bool:
+        """Posts any partial batch and waits for all batches. Returns True if all succeeded."""
+        self.flush()
+        futures, self.futures = self.futures, []
+        success = all([future.result() for future in futures])
+        logging.info(
+            "Submitted %d entries in %d batches (%d failed, %d retries); %d KB sent "
+            "(%d KB uncompressed), %.2fs average and %.2fs maximum latency.",
+            self.num_payloads,
+            self.num_batches,
+            self.num_failed_batches,
+            self.num_retries,
+            self.num_bytes_sent // 1024,
+            self.num_bytes // 1024,
+            self.post_seconds / max(1, self.num_batches),
+            self.max_post_seconds,
+        )
+        return success
+
+    def close(self) -> bool:
+        success = self.wait()
+        self.executor.shutdown()
+        return success
+
+    def _post(self, body: bytes) -> bool:
+        try:
+            headers = {"Content-Type": "application/json"}
+            data = body
+            if self.compress:
+                headers["Content-Encoding"] = "gzip"
+                data = gzip.compress(body, compresslevel=5)
+
+            for attempt in range(self.max_retries + 1):
+                start_time = time.monotonic()
+                retry_after = None
+                try:
+                    res = self.session.post(
+                        self.endpoint, data=data, headers=headers, timeout=self.timeout
+                    )
+                    if res.status_code == 200:
+                        self._record(body, data, time.monotonic() - start_time, success=True)
+                        return True
+                    if res.status_code != 429 and res.status_code < 500:
+                        logging.warning("Failure: status code: %s", res.status_code)
+                        break
+                    retry_after = res.headers.get("Retry-After")
+                    error = f"status code {res.status_code}"
+                except requests.RequestException as msg:
+                    error = str(msg)
+
+                if attempt < self.max_retries:
+                    delay = 2**attempt + random.random()
+                    if retry_after and retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                    logging.info("Retrying batch in %.1fs after error: %s", delay, error)
+                    with self.lock:
+                        self.num_retries += 1
+                    time.sleep(delay)
+                else:
+                    logging.warning("Giving up on batch after error: %s", error)
+
+            self._record(body, data, 0.0, success=False)
+            return False
+        finally:
+            self.in_flight.release()
+
+    def _record(self, body: bytes, data: bytes, seconds: float, success: bool):
+        with self.lock:
+            self.num_batches += 1
+            if success:
+                self.num_bytes += len(body)
+                self.num_bytes_sent += len(data)
+                self.post_seconds += seconds
+                self.max_post_seconds = max(self.max_post_seconds, seconds)
+            else:
+                self.num_failed_batches += 1
 
 
 class BaseJob:
     METRIC_API_ENDPOINT = None
-    OSS_GADGET_RELEASE_URL = "https://github.com/microsoft/OSSGadget/releases/download/v0.1.260/OSSGadget_linux_0.1.260.zip"
+    OSS_GADGET_VERSION = "0.1.260"
+    OSS_GADGET_RELEASE_URL = (
+        "https://github.com/microsoft/OSSGadget/releases/download/"
+        f"v{OSS_GADGET_VERSION}/OSSGadget_linux_{OSS_GADGET_VERSION}.zip"
+    )
+    # Where OSS Gadget is installed, if it isn't already on the PATH.
+    OSS_GADGET_DIR = os.environ.get("OSS_GADGET_DIR", os.path.join(CACHE_DIR, "ossgadget"))
+
+    # How long resolved (and unresolvable) source repositories are cached, in seconds.
+    SOURCE_REPOSITORY_CACHE = os.environ.get(
+        "SOURCE_REPOSITORY_CACHE", os.path.join(CACHE_DIR, "source-repositories.sqlite3")
+    )
+    SOURCE_REPOSITORY_TTL = int(os.environ.get("SOURCE_REPOSITORY_TTL", 60 * 60 * 24 * 7))
+    SOURCE_REPOSITORY_NEGATIVE_TTL = int(
+        os.environ.get("SOURCE_REPOSITORY_NEGATIVE_TTL", 60 * 60 * 24)
+    )
+
+    # Maximum PackageURLs per oss-find-source run.
+    SOURCE_REPOSITORY_BATCH_SIZE = 100
+
+    # Metric API submissions: gzip request bodies unless METRIC_API_GZIP is false.
+    METRIC_API_GZIP = os.environ.get("METRIC_API_GZIP", "true").lower() not in ("0", "false", "no")
+    METRIC_API_CONCURRENCY = int(os.environ.get("METRIC_API_CONCURRENCY", 4))
+
+    _oss_find_source = None
+    _source_repository_cache = None
+    _session = None
+    _lock = threading.Lock()
 
     package_url = None  # type: PackageURL
 
@@ -31,6 +296,137 @@ class BaseJob:
         else:
             self.package_url = package_url
 
+    @classmethod
+    def get_oss_find_source(cls) -> str:
+        """
+        Returns the path to oss-find-source, from the PATH or OSS_GADGET_DIR. If it isn't
+        found in either, OSS Gadget is downloaded to OSS_GADGET_DIR (once) and reused.
+        """
+        with cls._lock:
+            if cls._oss_find_source:
+                return cls._oss_find_source
+
+            installed = os.path.join(
+                cls.OSS_GADGET_DIR, f"OSSGadget_linux_{cls.OSS_GADGET_VERSION}", "oss-find-source"
+            )
+            path = shutil.which("oss-find-source") or (
+                installed if os.path.isfile(installed) else None
+            )
+            if not path:
+                logging.info("Downloading OSS Gadget to %s", cls.OSS_GADGET_DIR)
+                res = requests.get(cls.OSS_GADGET_RELEASE_URL, timeout=300)
+                res.raise_for_status()
+
+                # Extract next to the final location, then move it into place, so that an
+                # interrupted download never leaves a partial install behind.
+                os.makedirs(cls.OSS_GADGET_DIR, exist_ok=True)
+                staging = tempfile.mkdtemp(dir=cls.OSS_GADGET_DIR)
+                try:
+                    with zipfile.ZipFile(io.BytesIO(res.content)) as zip_:
+                        zip_.extractall(staging)
+                    name = f"OSSGadget_linux_{cls.OSS_GADGET_VERSION}"
+                    for entry in os.scandir(os.path.join(staging, name)):
+                        if entry.name.startswith("oss-") and entry.is_file():
+                            os.chmod(entry.path, os.stat(entry.path).st_mode | stat.S_IXUSR)
+                    if not os.path.exists(os.path.dirname(installed)):
+                        os.replace(os.path.join(staging, name), os.path.dirname(installed))
+                finally:
+                    shutil.rmtree(staging, ignore_errors=True)
+                path = installed
+
+            cls._oss_find_source = path
+            return path
+
+    @classmethod
+    def get_source_repository_cache(cls) -> SourceRepositoryCache:
+        with cls._lock:
+            if cls._source_repository_cache is None:
+                cls._source_repository_cache = SourceRepositoryCache(
+                    cls.SOURCE_REPOSITORY_CACHE,
+                    cls.SOURCE_REPOSITORY_TTL,
+                    cls.SOURCE_REPOSITORY_NEGATIVE_TTL,
+                )
+            return cls._source_repository_cache
+
+    @classmethod
+    def resolve_source_repositories(
+        cls, package_urls: Iterable[Union[PackageURL, str]]
+    ) -> Dict[str, Union[str, None]]:
+        """
+        Identifies the GitHub source code repository for each PackageURL, using OSS
+        Gadget. Returns a dictionary of PackageURL (as a string) to repository URL, or
+        None where it couldn't be identified.
+
+        Results are cached, and PackageURLs that aren't cached are resolved in batches,
+        with one oss-find-source run per batch.
+        """
+        package_urls = list(dict.fromkeys(str(p) for p in package_urls if p))
+        cache = cls.get_source_repository_cache()
+        resolved = cache.get_many(package_urls)
+
+        missing = [p for p in package_urls if p not in resolved]
+        for start in range(0, len(missing), cls.SOURCE_REPOSITORY_BATCH_SIZE):
+            batch = missing[start : start + cls.SOURCE_REPOSITORY_BATCH_SIZE]
+            found = cls._find_source(batch)
+            cache.set_many(found)
+            resolved.update(found)
+
+        for package_url in missing:
+            if not resolved.get(package_url):
+                logging.warning(f"Unable to identify source code repository for [{package_url}]")
+        return resolved
+
+    @classmethod
+    def _find_source(cls, package_urls: List[str]) -> Dict[str, Union[str, None]]:
+        """
+        Runs oss-find-source for the PackageURLs. Each line of its output names the
+        repository found and the PackageURL it was found for. If a batch fails, or its
+        output can't be matched up that way, each PackageURL is run on its own instead, so
+        that one bad PackageURL doesn't leave the rest of its batch unresolved.
+        """
+        try:
+            output = subprocess.check_output(
+                [cls.get_oss_find_source()] + package_urls, timeout=60 + 10 * len(package_urls)
+            ).decode("utf-8")
+        except OSError as msg:
+            logging.warning("Unable to run oss-find-source: %s", msg)
+            return {}  # Not cached, so they're tried again next time
+        except subprocess.SubprocessError as msg:
+            if len(package_urls) > 1:
+                logging.warning("Error running oss-find-source, trying one at a time: %s", msg)
+                return cls._find_source_each(package_urls)
+            logging.warning("Error running oss-find-source for %s: %s", package_urls[0], msg)
+            return {package_urls[0]: None}  # Cached as a miss, for the negative TTL
+
+        if len(package_urls) == 1:
+            urls = [token for token in output.split() if token.startswith("https://")]
+            return {package_urls[0]: cls._github_repository(urls[0] if urls else None)}
+
+        found = {}
+        for line in output.splitlines():
+            tokens = [token.strip("()[],'\"") for token in line.split()]
+            urls = [token for token in tokens if token.startswith("https://")]
+            purls = [token for token in tokens if token in package_urls]
+            if urls and purls:
+                found[purls[0]] = cls._github_repository(urls[0])
+
+        if not found:
+            return cls._find_source_each(package_urls)
+        return {p: found.get(p) for p in package_urls}
+
+    @classmethod
+    def _find_source_each(cls, package_urls: List[str]) -> Dict[str, Union[str, None]]:
+        found = {}
+        for package_url in package_urls:
+            found.update(cls._find_source([package_url]))
+        return found
+
+    @staticmethod
+    def _github_repository(repository_url: str) -> str:
+        if repository_url and repository_url.startswith("https://github.com/"):
+            return repository_url
+        return None
+
     def get_source_repository(self):
         """
         Identifies the source code repository for the given package, using OSS Gadget.
@@ -40,34 +436,55 @@ class BaseJob:
             logging.debug("Unable to identify source repository, invalid package_url")
             return None
 
-        prefix = ""
-        try:
-            r = subprocess.check_output(["oss-find-source"])
-        except FileNotFoundError:
-            res = requests.get(self.OSS_GADGET_RELEASE_URL)
-            with zipfile.ZipFile(io.BytesIO(res.content)) as zip_:
-                zip_.extractall("ossgadget")
-                os.environ["PATH"] = os.environ["PATH"] + ":./ossgadget"
-                prefix = "ossgadget/OSSGadget_linux_0.1.260/"
-
-        res = subprocess.check_output([prefix + "oss-find-source", str(self.package_url)])
-        if res:
-            repository_url = res.decode("utf-8").split()[1]
-            if repository_url.startswith("https://github.com/"):
-                return repository_url
-        logging.warn(f"Unable to identify source code repository for [{self.package_url}]")
-        return None
+        return self.resolve_source_repositories([self.package_url]).get(str(self.package_url))
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """Returns the HTTP session shared by all jobs, so that connections are reused."""
+        with cls._lock:
+            if cls._session is None:
+                cls._session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=max(10, cls.METRIC_API_CONCURRENCY * 4))
+                cls._session.mount("http://", adapter)
+                cls._session.mount("https://", adapter)
+            return cls._session
+
+    def get_submitter(self) -> MetricSubmitter:
+        """Returns a new submitter for this job's metrics, on the shared session."""
+        return MetricSubmitter(
+            self.METRIC_API_ENDPOINT,
+            self.get_session(),
+            concurrency=self.METRIC_API_CONCURRENCY,
+            compress=self.METRIC_API_GZIP,
+        )
+
+    def submit(self, payloads: Iterable[dict]) -> bool:
+        """Submits payloads to the metric API and waits for them. Returns True on success."""
+        submitter = self.get_submitter()
+        submitter.submit_many(payloads)
+        return submitter.close()
 
     def execute(self):
         raise Exception("Not implemented.")
 
-    def get_api_token(self, key: str) -> str:
+    def get_github_tokens(self) -> GitHubTokenPool:
+        """Returns the GitHub token pool shared by the whole process, or None."""
+        return GitHubTokenPool.shared()
+
+    def get_api_token(self, key: str, resource: str = "core") -> str:
         """
         Retrieves an appropriate API token, based on the key provided.
 
-        Currently, only 'github' is supported.
+        Currently, only 'github' is supported. If several GitHub tokens are configured
+        (GITHUB_API_TOKENS), this is the one with the most quota left for the resource
+        ("core" for REST, "graphql"); collectors that make many requests, or hand the token
+        to a tool, should use get_github_tokens() to hold one while it's in use.
         """
         if key == "github":
-            return self.GITHUB_API_TOKEN
+            pool = self.get_github_tokens()
+            if pool is None:
+                return self.GITHUB_API_TOKEN
+            with pool.token(resource) as token:
+                return token
         else:
             raise KeyError("Unable to find key.")
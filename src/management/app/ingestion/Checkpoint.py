@@ -0,0 +1,61 @@
+import logging
+import os
+from typing import Tuple
+
+from app.models import IngestionState
+
+
+class FileCheckpoint:
+    """
+    Progress through a single input file, stored in the database so that an interrupted
+    import can resume where it left off.
+
+    A checkpoint records the byte offset just past the last line whose metrics were
+    written, along with the number of lines read so far. It also records the size and
+    modification time of the file, so a checkpoint taken against an older copy of the
+    file (such as a previous BigQuery extract) is ignored instead of being applied to
+    the new one.
+    """
+
+    def __init__(self, source: str, filename: str):
+        self.source = source
+        self.filename = filename
+        self.name = f"{source}:{os.path.basename(filename)}"
+
+        stat = os.stat(filename)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+    def load(self) -> Tuple[int, int, bool]:
+        """Returns the (offset, records, complete) to resume from."""
+        value = (
+            IngestionState.objects.filter(name=self.name).values_list("value", flat=True).first()
+        )
+        if not value:
+            return 0, 0, False
+
+        if value.get("size") != self.size or value.get("mtime") != self.mtime:
+            logging.info("File %s has changed since it was checkpointed, ignoring.", self.filename)
+            return 0, 0, False
+
+        return value.get("offset", 0), value.get("records", 0), value.get("complete", False)
+
+    def save(self, offset: int, records: int, complete: bool = False):
+        IngestionState.objects.update_or_create(
+            name=self.name,
+            defaults={
+                "value": {
+                    "filename": self.filename,
+                    "size": self.size,
+                    "mtime": self.mtime,
+                    "offset": offset,
+                    "records": records,
+                    "complete": complete,
+                }
+            },
+        )
+
+    @staticmethod
+    def clear_all(source: str):
+        """Removes every checkpoint for a source, so that the next import starts over."""
+        IngestionState.objects.filter(name__startswith=f"{source}:").delete()
@@ -0,0 +1,197 @@
+import io
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from app.ingestion.MetricWriter import MetricWriter
+from app.ingestion.PackageRegistry import PackageRegistry
+from app.models import Metric, Package, SourceDigest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+
+class CopyMetricWriter(MetricWriter):
+    """
+    MetricWriter that loads each batch with PostgreSQL's COPY.
+
+    Rows are streamed into a temporary staging table with copy_expert, then merged into
+    the package, metric and source_digest tables with a handful of set-based statements.
+    Temporary tables aren't WAL-logged and are private to each connection, so parallel
+    workers each get their own. On any other database, this falls back to the ORM
+    writes of MetricWriter.
+    """
+
+    STAGING_TABLE = "metric_staging"
+
+    def __init__(self, key_prefix: str, registry: PackageRegistry = None, **kwargs):
+        self.use_copy = connection.vendor == "postgresql"
+        if self.use_copy:
+            # Packages are resolved in SQL, so there's nothing to preload.
+            registry = registry if registry is not None else PackageRegistry(preload=False)
+        else:
+            logging.info("COPY is only supported on PostgreSQL, using the ORM instead.")
+        super().__init__(key_prefix, registry=registry, **kwargs)
+
+    def _write(self, pending: Dict[str, Tuple[List[dict], Optional[str]]]):
+        if not self.use_copy:
+            return super()._write(pending)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            self._create_staging_table(cursor)
+            cursor.copy_expert(
+                f"COPY {self.STAGING_TABLE} (package_url, key, value, properties, digest) "
+                "FROM STDIN",
+                self._to_copy_buffer(pending),
+            )
+            num_new, num_changed, num_unchanged, num_rows = self._merge(cursor)
+
+        self.num_records += len(pending)
+        self.num_rows += num_rows
+        self.num_new += num_new
+        self.num_changed += num_changed
+        self.num_unchanged += num_unchanged
+
+    def _create_staging_table(self, cursor):
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE IF NOT EXISTS {self.STAGING_TABLE} (
+                package_url varchar(256) NOT NULL,
+                key varchar(256),
+                value text,
+                properties jsonb,
+                digest varchar(64)
+            ) ON COMMIT DELETE ROWS
+            """
+        )
+
+    def _to_copy_buffer(self, pending: Dict[str, Tuple[List[dict], Optional[str]]]) -> io.StringIO:
+        """
+        Serializes the batch in COPY text format. A record without any metrics is still
+        staged, with a NULL key, so that its old metrics are removed.
+        """
+        buffer = io.StringIO()
+        for package_url, (metrics, digest) in pending.items():
+            for metric in metrics or [{}]:
+                properties = metric.get("properties")
+                if properties is not None:
+                    properties = json.dumps(properties, cls=DjangoJSONEncoder)
+                value = metric.get("value")
+                if value is not None:
+                    value = str(value)
+                fields = [package_url, metric.get("key"), value, properties, digest]
+                buffer.write("\t".join(map(self._escape, fields)) + "\n")
+        buffer.seek(0)
+        return buffer
+
+    @staticmethod
+    def _escape(value) -> str:
+        if value is None:
+            return "\\N"
+        return (
+            value.replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
+    @staticmethod
+    def _like_prefix(prefix: str) -> str:
+        """Returns a LIKE pattern matching strings that start with prefix."""
+        return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    def _merge(self, cursor) -> Tuple[int, int, int, int]:
+        """Merges the staging table, returning (new, changed, unchanged, rows written)."""
+        staging = self.STAGING_TABLE
+        package = Package._meta.db_table
+        metric = Metric._meta.db_table
+        source_digest = SourceDigest._meta.db_table
+
+        cursor.execute(
+            f"""
+            INSERT INTO {package} (package_url, last_updated)
+            SELECT DISTINCT package_url, now() FROM {staging}
+            ON CONFLICT (package_url) DO NOTHING
+            """
+        )
+
+        num_new = num_changed = num_unchanged = 0
+        if self.source:
+            cursor.execute(
+                f"""
+                SELECT
+                    COUNT(DISTINCT s.package_url) FILTER (WHERE d.digest IS NULL),
+                    COUNT(DISTINCT s.package_url) FILTER (WHERE d.digest <> s.digest),
+                    COUNT(DISTINCT s.package_url) FILTER (WHERE d.digest = s.digest)
+                FROM {staging} s
+                JOIN {package} p ON p.package_url = s.package_url
+                LEFT JOIN {source_digest} d ON d.package_id = p.id AND d.key_prefix = %s
+                """,
+                [self.digest_prefix],
+            )
+            num_new, num_changed, num_unchanged = cursor.fetchone()
+
+            if self.force:
+                num_changed += num_unchanged
+                num_unchanged = 0
+            else:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {staging} s
+                    USING {package} p, {source_digest} d
+                    WHERE p.package_url = s.package_url
+                      AND d.package_id = p.id
+                      AND d.key_prefix = %s
+                      AND d.digest = s.digest
+                    """,
+                    [self.digest_prefix],
+                )
+
+        cursor.execute(
+            f"""
+            DELETE FROM {metric} m
+            USING (
+                SELECT DISTINCT p.id FROM {staging} s
+                JOIN {package} p ON p.package_url = s.package_url
+            ) c
+            WHERE m.package_id = c.id AND m.key LIKE %s
+            """,
+            [self._like_prefix(self.key_prefix)],
+        )
+
+        descendants, ancestors = self.overlapping_prefixes()
+        cursor.execute(
+            f"""
+            DELETE FROM {source_digest} d
+            USING (
+                SELECT DISTINCT p.id FROM {staging} s
+                JOIN {package} p ON p.package_url = s.package_url
+            ) c
+            WHERE d.package_id = c.id AND (d.key_prefix LIKE %s OR d.key_prefix = ANY(%s))
+            """,
+            [self._like_prefix(descendants), ancestors],
+        )
+
+        cursor.execute(
+            f"""
+            INSERT INTO {metric} (package_id, key, value, properties, last_updated)
+            SELECT p.id, s.key, s.value, s.properties, now() FROM {staging} s
+            JOIN {package} p ON p.package_url = s.package_url
+            WHERE s.key IS NOT NULL
+            """
+        )
+        num_rows = cursor.rowcount
+
+        if self.source:
+            cursor.execute(
+                f"""
+                INSERT INTO {source_digest} (package_id, key_prefix, digest, last_updated)
+                SELECT DISTINCT p.id, %s, s.digest, now() FROM {staging} s
+                JOIN {package} p ON p.package_url = s.package_url
+                WHERE s.digest IS NOT NULL
+                ON CONFLICT (package_id, key_prefix)
+                DO UPDATE SET digest = EXCLUDED.digest, last_updated = EXCLUDED.last_updated
+                """,
+                [self.digest_prefix],
+            )
+
+        return num_new, num_changed, num_unchanged, num_rows
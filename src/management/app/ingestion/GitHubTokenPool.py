@@ -0,0 +1,170 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import requests
+
+# GitHub's hourly limits for an authenticated user, assumed until a response says otherwise.
+DEFAULT_LIMIT = 5000
+
+RATE_LIMIT_URL = "https://api.github.com/rate_limit"
+
+
+class TokenState:
+    """What is known about one token's quota for each API ("core" for REST, "graphql")."""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.remaining = {}  # resource -> requests (or points) remaining
+        self.reset_at = {}  # resource -> epoch seconds when the quota resets
+        self.in_flight = {}  # resource -> requests currently using this token
+
+    def headroom(self, resource: str, now: float) -> int:
+        if self.reset_at.get(resource, 0) <= now:
+            remaining = DEFAULT_LIMIT  # Unknown, or reset since we last heard
+        else:
+            remaining = self.remaining.get(resource, DEFAULT_LIMIT)
+        return remaining - self.in_flight.get(resource, 0)
+
+
+class GitHubTokenPool:
+    """
+    Spreads GitHub API requests across several tokens, tracking each token's remaining
+    quota from the X-RateLimit-* response headers (REST) and the `rateLimit` field
+    (GraphQL). Each request goes to the token with the most headroom, and callers only
+    wait when every token is exhausted, until the first one resets.
+
+    A single pool is shared by everything in the process (see shared()), so that loaders
+    and collectors running side by side see each other's usage.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, tokens: List[str], min_headroom: int = 1):
+        tokens = [t.strip() for t in tokens if t and t.strip()]
+        if not tokens:
+            raise ValueError("No GitHub API tokens configured.")
+        self.tokens = {token: TokenState(token) for token in dict.fromkeys(tokens)}
+        self.min_headroom = min_headroom
+        self.condition = threading.Condition()
+
+    @classmethod
+    def shared(cls) -> "GitHubTokenPool":
+        """
+        Returns the process-wide pool, built from GITHUB_API_TOKENS (comma-separated), or
+        GITHUB_API_TOKEN for a single token. Returns None if neither is set.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                tokens = os.environ.get("GITHUB_API_TOKENS") or os.environ.get("GITHUB_API_TOKEN")
+                if not tokens:
+                    return None
+                cls._shared = cls(tokens.split(","))
+            return cls._shared
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def acquire(self, resource: str = "graphql") -> str:
+        """Returns the token with the most headroom, waiting if all of them are exhausted."""
+        with self.condition:
+            while True:
+                now = time.time()
+                state = max(self.tokens.values(), key=lambda s: s.headroom(resource, now))
+                if state.headroom(resource, now) >= self.min_headroom:
+                    state.in_flight[resource] = state.in_flight.get(resource, 0) + 1
+                    return state.token
+
+                reset_at = min(s.reset_at.get(resource, now) for s in self.tokens.values())
+                delay = max(1.0, reset_at - now + 1)
+                logging.warning(
+                    "All %d GitHub tokens are out of %s quota, waiting %.0fs.",
+                    len(self.tokens),
+                    resource,
+                    delay,
+                )
+                # Releases (and new quota information) wake waiters early.
+                self.condition.wait(delay)
+
+    def release(self, token: str, resource: str = "graphql"):
+        with self.condition:
+            state = self.tokens[token]
+            state.in_flight[resource] = max(0, state.in_flight.get(resource, 0) - 1)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def token(self, resource: str = "graphql") -> Iterator[str]:
+        token = self.acquire(resource)
+        try:
+            yield token
+        finally:
+            self.release(token, resource)
+
+    def update(self, token: str, resource: str, remaining: int, reset_at: float):
+        with self.condition:
+            state = self.tokens.get(token)
+            if state is None:
+                return
+            state.remaining[resource] = remaining
+            state.reset_at[resource] = reset_at
+            self.condition.notify_all()
+
+    def update_from_headers(self, token: str, headers: dict):
+        """Records the quota reported by a REST (or GraphQL) response's headers."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_at = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset_at is None:
+            return
+        resource = headers.get("X-RateLimit-Resource", "core")
+        self.update(token, resource, int(remaining), float(reset_at))
+
+    def update_from_graphql(self, token: str, rate_limit: Optional[dict]):
+        """Records the quota from a GraphQL `rateLimit { remaining resetAt }` field."""
+        if not rate_limit or rate_limit.get("remaining") is None:
+            return
+        reset_at = time.time() + 60 * 60
+        if rate_limit.get("resetAt"):
+            reset_at = datetime.fromisoformat(rate_limit["resetAt"].replace("Z", "+00:00"))
+            reset_at = reset_at.timestamp()
+        self.update(token, "graphql", int(rate_limit["remaining"]), reset_at)
+
+    def mark_exhausted(self, token: str, resource: str, retry_after: float = 60):
+        """Records that a token was rate limited, when the response doesn't say for how long."""
+        self.update(token, resource, 0, time.time() + retry_after)
+
+    def refresh(self, session: requests.Session, token: str):
+        """
+        Asks GitHub how much quota a token has left (which doesn't count against it), for
+        when the token was handed to a tool that made its own requests.
+        """
+        try:
+            res = session.get(
+                RATE_LIMIT_URL, headers={"Authorization": f"token {token}"}, timeout=30
+            )
+        except requests.RequestException as msg:
+            logging.warning("Unable to refresh GitHub token quota: %s", msg)
+            return
+        self.update_from_headers(token, res.headers)
+        if res.status_code == 200:
+            graphql = (res.json().get("resources") or {}).get("graphql") or {}
+            if graphql.get("remaining") is not None and graphql.get("reset"):
+                self.update(token, "graphql", int(graphql["remaining"]), float(graphql["reset"]))
+
+    def summary(self) -> Dict[str, dict]:
+        """Remaining quota per token (identified by its last four characters)."""
+        with self.condition:
+            return {
+                f"...{state.token[-4:]}": {
+                    resource: {
+                        "remaining": state.remaining.get(resource),
+                        "reset_at": state.reset_at.get(resource),
+                    }
+                    for resource in state.remaining
+                }
+                for state in self.tokens.values()
+            }
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.ingestion.PackageRegistry import PackageRegistry
+from app.models import Metric, SourceDigest
+from app.telemetry import (
+    ERRORS,
+    FLUSH_SECONDS,
+    RECORDS_PARSED,
+    RECORDS_UNCHANGED,
+    ROWS_WRITTEN,
+)
+from django.db import transaction
+from django.db.models import Q
+
+
+class MetricWriter:
+    """
+    Buffers metrics for many packages and writes them to the database in batches.
+
+    Each record replaces every metric under `key_prefix` for its package. When a batch
+    is flushed, all of its packages are resolved (or created) through the registry,
+    then their existing metrics under the prefix are removed with one DELETE and the
+    new rows are written with one bulk INSERT, inside a single transaction.
+
+    If a `source` is given, a digest of each record's metrics is stored per package and
+    key prefix, and records whose digest matches the stored one are skipped entirely. The
+    digest covers the rows that would be written rather than the raw source record, so
+    volatile fields that aren't stored (such as scan dates) don't defeat it, and a
+    change to how a loader derives its metrics is picked up on the next run. Since
+    digests describe what is stored under a prefix, replacing a package's rows also
+    clears its digests for overlapping prefixes written by other loaders.
+    """
+
+    def __init__(
+        self,
+        key_prefix: str,
+        batch_size: int = 500,
+        registry: PackageRegistry = None,
+        source: str = None,
+        force: bool = False,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+
+        self.key_prefix = key_prefix
+        self.digest_prefix = key_prefix.rstrip(".")
+        self.batch_size = batch_size
+        self.registry = registry if registry is not None else PackageRegistry()
+        self.source = source
+        self.force = force
+
+        self._pending = {}  # type: Dict[str, Tuple[List[dict], Optional[str]]]
+
+        # Prometheus metrics are labelled by source, or by key prefix if there isn't one.
+        label = source or key_prefix.rstrip(".")
+        self._records_parsed = RECORDS_PARSED.labels(label)
+        self._records_unchanged = RECORDS_UNCHANGED.labels(label)
+        self._rows_written = ROWS_WRITTEN.labels(label)
+        self._write_errors = ERRORS.labels(label, "write")
+        self._flush_seconds = FLUSH_SECONDS.labels(label)
+        self._start_time = time.monotonic()
+
+        self.num_records = 0
+        self.num_rows = 0
+        self.num_failed = 0
+        self.num_new = 0
+        self.num_changed = 0
+        self.num_unchanged = 0
+
+    @staticmethod
+    def digest(metrics: List[dict]) -> str:
+        """Returns the SHA-256 digest of the canonical JSON form of a record's metrics."""
+        canonical = json.dumps(metrics, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def overlapping_prefixes(self) -> Tuple[str, List[str]]:
+        """
+        Returns the key prefixes whose stored digests are invalidated by replacing rows
+        under this writer's prefix: (a prefix that every descendant starts with, and the
+        ancestors). This writer's own prefix is included only if it doesn't store digests.
+        """
+        parts = self.digest_prefix.split(".")
+        ancestors = [".".join(parts[:i]) for i in range(1, len(parts))]
+        if not self.source:
+            ancestors.append(self.digest_prefix)
+        return self.digest_prefix + ".", ancestors
+
+    def add(self, package_url: str, metrics: List[dict]):
+        """
+        Queues the metrics for a package, flushing the batch once it is full.
+
+        Each metric is a dictionary of Metric field values (key, value, properties).
+        """
+        digest = self.digest(metrics) if self.source else None
+        self._records_parsed.inc()
+
+        self._pending[str(package_url)] = (metrics, digest)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all pending records to the database."""
+        if not self._pending:
+            return
+
+        pending = self._pending
+        self._pending = {}
+        num_rows = self.num_rows
+        num_unchanged = self.num_unchanged
+
+        with self._flush_seconds.time():
+            try:
+                self._write(pending)
+            except Exception as msg:
+                logging.warning("Failed to write batch of %d records: %s", len(pending), msg)
+                # Retry one record at a time so that a single bad row doesn't lose the batch.
+                for package_url, entry in pending.items():
+                    try:
+                        self._write({package_url: entry})
+                    except Exception as msg:
+                        self.num_failed += 1
+                        self._write_errors.inc()
+                        logging.warning("Failed to save data (%s): %s", package_url, msg)
+
+        self._rows_written.inc(self.num_rows - num_rows)
+        self._records_unchanged.inc(self.num_unchanged - num_unchanged)
+
+    def close(self):
+        """Flushes any remaining records."""
+        self.flush()
+
+    def _write(self, pending: Dict[str, Tuple[List[dict], Optional[str]]]):
+        # Packages are created outside of the transaction so that the registry never
+        # holds the id of a package that was rolled back.
+        package_ids = self.registry.get_ids(pending.keys())
+
+        stored_digests = {}
+        if self.source:
+            stored_digests = dict(
+                SourceDigest.objects.filter(
+                    key_prefix=self.digest_prefix, package_id__in=list(package_ids.values())
+                ).values_list("package_id", "digest")
+            )
+
+        num_new = 0
+        num_changed = 0
+        num_unchanged = 0
+        changed_ids = []
+        rows = []
+        digests = []
+
+        for package_url, (metrics, digest) in pending.items():
+            package_id = package_ids[package_url]
+
+            if digest is not None:
+                stored_digest = stored_digests.get(package_id)
+                if stored_digest is None:
+                    num_new += 1
+                elif stored_digest != digest or self.force:
+                    num_changed += 1
+                else:
+                    num_unchanged += 1
+                    continue
+                digests.append(
+                    SourceDigest(
+                        package_id=package_id, key_prefix=self.digest_prefix, digest=digest
+                    )
+                )
+
+            changed_ids.append(package_id)
+            for metric in metrics:
+                rows.append(Metric(package_id=package_id, **metric))
+
+        if changed_ids:
+            with transaction.atomic():
+                Metric.objects.filter(
+                    package_id__in=changed_ids, key__startswith=self.key_prefix
+                ).delete()
+                Metric.objects.bulk_create(rows, batch_size=1000)
+                descendants, ancestors = self.overlapping_prefixes()
+                SourceDigest.objects.filter(package_id__in=changed_ids).filter(
+                    Q(key_prefix__startswith=descendants) | Q(key_prefix__in=ancestors)
+                ).delete()
+                SourceDigest.objects.bulk_create(
+                    digests,
+                    batch_size=1000,
+                    update_conflicts=True,
+                    unique_fields=["package", "key_prefix"],
+                    update_fields=["digest", "last_updated"],
+                )
+
+        self.num_records += len(pending)
+        self.num_rows += len(rows)
+        self.num_new += num_new
+        self.num_changed += num_changed
+        self.num_unchanged += num_unchanged
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start_time
+
+    @property
+    def records_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.num_records / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        summary = (
+            "Processed %d records (%d metrics written, %d failed) in %.1fs (%.1f records/sec)"
+            % (
+                self.num_records,
+                self.num_rows,
+                self.num_failed,
+                self.elapsed,
+                self.records_per_second,
+            )
+        )
+        if self.source:
+            summary += "; %d new, %d changed, %d unchanged" % (
+                self.num_new,
+                self.num_changed,
+                self.num_unchanged,
+            )
+        return summary
+
+
+WRITER_BACKENDS = ["orm", "copy"]
+
+
+def get_writer_class(backend: str = "orm") -> type:
+    """Returns the MetricWriter class for a --backend option."""
+    if backend == "orm":
+        return MetricWriter
+    if backend == "copy":
+        from app.ingestion.CopyMetricWriter import CopyMetricWriter
+
+        return CopyMetricWriter
+    raise ValueError(f"Unknown writer backend: {backend}")
@@ -0,0 +1,82 @@
+import logging
+from typing import Dict, Iterable
+
+from app.models import Package
+
+
+class PackageRegistry:
+    """
+    In-process map of Package URL to Package id, shared by the loaders.
+
+    All known packages are loaded with a single query when the registry is created, so
+    looking up a package is a dictionary access instead of a get_or_create round trip.
+    Packages that don't exist yet are created in batches.
+    """
+
+    def __init__(self, batch_size: int = 1000, preload: bool = True):
+        self.batch_size = batch_size
+        self._package_ids = {}  # type: Dict[str, int]
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        if preload:
+            self.load()
+
+    def load(self):
+        """(Re-)loads all known packages from the database."""
+        self._package_ids = dict(
+            Package.objects.order_by().values_list("package_url", "id").iterator(chunk_size=10000)
+        )
+        logging.info("Loaded %d packages into registry.", len(self._package_ids))
+
+    def __len__(self):
+        return len(self._package_ids)
+
+    def __contains__(self, package_url) -> bool:
+        return str(package_url) in self._package_ids
+
+    def get_id(self, package_url) -> int:
+        """Returns the Package id for a Package URL, creating the Package if needed."""
+        return self.get_ids([package_url])[str(package_url)]
+
+    def get_ids(self, package_urls: Iterable) -> Dict[str, int]:
+        """
+        Returns a map of Package URL to Package id for the given Package URLs.
+
+        Any packages that don't exist yet are created in batches of `batch_size`.
+        """
+        result = {}
+        missing = {}  # type: Dict[str, None]
+        for package_url in map(str, package_urls):
+            if package_url in result or package_url in missing:
+                continue
+            package_id = self._package_ids.get(package_url)
+            if package_id is None:
+                self.num_misses += 1
+                missing[package_url] = None
+            else:
+                self.num_hits += 1
+                result[package_url] = package_id
+
+        missing = list(missing)
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+            Package.objects.bulk_create(
+                [Package(package_url=p) for p in batch], ignore_conflicts=True
+            )
+            # Re-read the ids, since bulk_create doesn't return them on every backend.
+            created = dict(
+                Package.objects.filter(package_url__in=batch).values_list("package_url", "id")
+            )
+            self._package_ids.update(created)
+            result.update(created)
+
+        return result
+
+    def summary(self) -> str:
+        return "Package registry: %d packages, %d hits, %d misses" % (
+            len(self._package_ids),
+            self.num_hits,
+            self.num_misses,
+        )
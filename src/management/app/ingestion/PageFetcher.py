@@ -0,0 +1,98 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from app.telemetry import ERRORS, FETCH_SECONDS
+from requests.adapters import HTTPAdapter
+
+
+class PageFetcher:
+    """
+    Fetches a paged JSON API (url?page=1, url?page=2, ...) with several pages in flight.
+
+    Up to `concurrency` pages are requested at once over a pooled session, and their
+    entries are yielded in page order. Since only that many pages are ever outstanding,
+    the fetcher stays at most `concurrency` pages ahead of whoever is consuming it.
+    Fetching stops at the first page that is empty or returns an error; any pages
+    requested past that point are discarded.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        concurrency: int = 4,
+        timeout: int = 120,
+        session: requests.Session = None,
+        source: str = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.source = source or urlparse(url).netloc
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+        self.num_pages = 0
+        self.num_entries = 0
+        self.fetch_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch(self, page: int) -> Optional[list]:
+        start_time = time.monotonic()
+        res = self.session.get(self.url, params={"page": page}, timeout=self.timeout)
+        elapsed = time.monotonic() - start_time
+        FETCH_SECONDS.labels(self.source).observe(elapsed)
+        with self._lock:
+            self.fetch_seconds += elapsed
+
+        if res.status_code != 200:
+            ERRORS.labels(self.source, "fetch").inc()
+            logging.warning("Retrieved status code %d from URL [%s]", res.status_code, res.url)
+            return None
+        return res.json()
+
+    def __iter__(self) -> Iterator[List[dict]]:
+        """Yields the entries of each page, in order."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            window = collections.deque()
+            next_page = 1
+            try:
+                while True:
+                    while len(window) < self.concurrency:
+                        window.append(executor.submit(self._fetch, next_page))
+                        next_page += 1
+
+                    entries = window.popleft().result()
+                    if entries is None:
+                        return
+                    if not len(entries):
+                        logging.info("No more entries.")
+                        return
+
+                    self.num_pages += 1
+                    self.num_entries += len(entries)
+                    yield entries
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def summary(self) -> str:
+        average = self.fetch_seconds / self.num_pages if self.num_pages else 0.0
+        return "Fetched %d pages (%d entries), %.2fs average per request" % (
+            self.num_pages,
+            self.num_entries,
+            average,
+        )
@@ -6,11 +6,15 @@ import subprocess
 import sys
 
 import requests
+from app.ingestion.MetricWriter import WRITER_BACKENDS, MetricWriter, get_writer_class
+from app.ingestion.PackageRegistry import PackageRegistry
+from app.ingestion.PageFetcher import PageFetcher
 from app.models import Metric, Package
+from app.purl import cache_summary, url_to_purl
+from app.telemetry import export_metrics
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from packageurl.contrib import purl2url, url2purl
-from packageurl.contrib.url2purl import url2purl
 
 
 class Command(BaseCommand):
@@ -21,60 +25,86 @@ class Command(BaseCommand):
 
     BEST_PRACTICES_ROOT_URL = "https://bestpractices.coreinfrastructure.org/en/projects.json"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            default=self.BEST_PRACTICES_ROOT_URL,
+            help="URL of the paged Best Practices projects.json API.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of records to buffer before writing to the database.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of pages to fetch in parallel.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rewrite records even if they haven't changed since the last import.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=WRITER_BACKENDS,
+            default="orm",
+            help="How to write metrics: ORM bulk inserts, or COPY into a staging table "
+            "(PostgreSQL only, other databases fall back to the ORM).",
+        )
+
     def handle(self, *args, **options):
         logging.info("Gathering all best practice data.")
-        page = 0
-        while True:
-            page += 1
-            url = self.BEST_PRACTICES_ROOT_URL + f"?page={page}"
-
-            res = requests.get(url, timeout=120)
-            if res.status_code != 200:
-                logging.warning("Retrieved status code %d from URL [%s]", res.status_code, url)
-                break
-
-            entries = res.json()
-            if not len(entries):
-                logging.info("No more entries.")
-                break
-
-            payload = []
+        registry = PackageRegistry(preload=options["backend"] == "orm")
+        writer = get_writer_class(options["backend"])(
+            "openssf.bestpractice.",
+            batch_size=options["batch_size"],
+            registry=registry,
+            source="bestpractice",
+            force=options["force"],
+        )
+        fetcher = PageFetcher(
+            options["url"], concurrency=options["concurrency"], source="bestpractice"
+        )
 
+        # The next pages are fetched in the background while this page is being written.
+        for entries in fetcher:
             for entry in entries:
-                package_url = None
-                for url_key in ["repo_url", "homepage_url"]:
-                    package_url = url2purl(entry.get(url_key))
-                    if package_url:
-                        break
+                self.import_entry(entry, writer)
+        writer.close()
 
-                if not package_url:
-                    logging.warning("Unable to find Package URL for id #%s", entry.get("id"))
-                    continue
+        logging.info(fetcher.summary())
+        logging.info(writer.summary())
+        logging.info(registry.summary())
+        logging.info(cache_summary())
+        self.stdout.write(writer.summary())
+        export_metrics("load_bestpractices_data")
 
-                package, _ = Package.objects.get_or_create(package_url=str(package_url))
+    def import_entry(self, entry: dict, writer: MetricWriter):
+        package_url = None
+        for url_key in ["repo_url", "homepage_url"]:
+            package_url = url_to_purl(entry.get(url_key))
+            if package_url:
+                break
 
-                with transaction.atomic():
-                    Metric.objects.filter(
-                        package=package, key__startswith="openssf.bestpractice."
-                    ).delete()
+        if not package_url:
+            logging.warning("Unable to find Package URL for id #%s", entry.get("id"))
+            return
 
-                    project_id = entry.get("id")
-                    if project_id:
-                        metric = Metric(package=package, key=f"openssf.bestpractice.detail-url")
-                        metric.value = (
-                            f"https://bestpractices.coreinfrastructure.org/projects/{project_id}"
-                        )
-                        metric.save()
+        metrics = []
+        project_id = entry.get("id")
+        if project_id:
+            metrics.append(
+                {
+                    "key": "openssf.bestpractice.detail-url",
+                    "value": f"https://bestpractices.coreinfrastructure.org/projects/{project_id}",
+                }
+            )
 
-                    for k, v in entry.items():
-                        k_name = k.lower().strip()
-                        try:
-                            metric, _ = Metric.objects.get_or_create(
-                                package=package, key=f"openssf.bestpractice.raw.{k_name}"
-                            )
-                            metric.value = v
-                            metric.save()
-                        except Exception as msg:
-                            logging.warning(
-                                "Failed to save data (%s, %s): %s", package_url, k_name, msg
-                            )
+        for k, v in entry.items():
+            k_name = k.lower().strip()
+            metrics.append({"key": f"openssf.bestpractice.raw.{k_name}", "value": v})
+        writer.add(str(package_url), metrics)
@@ -1,17 +1,25 @@
 # Refreshes security reviews from the authoritative source code repository.
 import collections
+import contextlib
 import csv
+import gzip
 import json
 import logging
 import os
 import re
+import resource
 import subprocess
+import time
 import traceback
-from io import StringIO
+from io import StringIO, TextIOWrapper
 
 import dateutil
 import requests
+from app.ingestion.MetricWriter import WRITER_BACKENDS, MetricWriter, get_writer_class
+from app.ingestion.PackageRegistry import PackageRegistry
 from app.models import Metric, Package
+from app.purl import cache_summary, url_to_purl
+from app.telemetry import ERRORS, FETCH_SECONDS, export_metrics
 from dateutil.parser import parse
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
@@ -23,52 +31,111 @@ class Command(BaseCommand):
     Refreshes data from the OpenSSF Criticality project.
     """
 
+    CRITICALITY_SCORE_URL = "https://www.googleapis.com/download/storage/v1/b/ossf-criticality-score/o/all.csv?generation=1614554714813772&alt=media"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            default=self.CRITICALITY_SCORE_URL,
+            help="URL or local path of the criticality CSV file (may be gzip-compressed).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of records to buffer before writing to the database.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rewrite records even if they haven't changed since the last import.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=WRITER_BACKENDS,
+            default="orm",
+            help="How to write metrics: ORM bulk inserts, or COPY into a staging table "
+            "(PostgreSQL only, other databases fall back to the ORM).",
+        )
+
     def handle(self, *args, **options):
         """
         Loads data from the public data collected by the OpenSSF Criticality project.
+
+        The CSV file is streamed and written to the database in batches, so memory use
+        doesn't grow with the size of the file.
         """
         logging.info("Gathering all criticality data.")
         try:
-            payloads = []
-
-            res = requests.get(
-                "https://www.googleapis.com/download/storage/v1/b/ossf-criticality-score/o/all.csv?generation=1614554714813772&alt=media",
-                timeout=120,
+            registry = PackageRegistry(preload=options["backend"] == "orm")
+            writer = get_writer_class(options["backend"])(
+                "openssf.criticality.raw.",
+                batch_size=options["batch_size"],
+                registry=registry,
+                source="criticality",
+                force=options["force"],
             )
-            if res.status_code != 200:
-                logging.warning("Failure fetching latest JSON: %s", res.status_code)
-                return
-
-            content = StringIO(res.text)
-            reader = csv.DictReader(content, delimiter=",")
-            for row in reader:
-                package_url = url2purl.url2purl(row.get("url"))
-                if not package_url:
-                    logging.warning(
-                        "Unable to identify Package URL from repository: [%s]", row.get("url")
-                    )
-                    continue
-
-                package, _ = Package.objects.get_or_create(package_url=str(package_url))
 
-                with transaction.atomic():
-                    Metric.objects.filter(
-                        package=package, key__startswith="openssf.criticality.raw."
-                    ).delete()
+            with self.open_source(options["source"]) as lines:
+                reader = csv.DictReader(lines, delimiter=",")
+                for row in reader:
+                    package_url = url_to_purl(row.get("url"))
+                    if not package_url:
+                        ERRORS.labels("criticality", "parse").inc()
+                        logging.warning(
+                            "Unable to identify Package URL from repository: [%s]", row.get("url")
+                        )
+                        continue
 
+                    metrics = []
                     for key, value in row.items():
                         if key in ["name", "url"]:
                             continue
-                        try:
-                            metric, _ = Metric.objects.get_or_create(
-                                package=package, key=f"openssf.criticality.raw.{key}"
-                            )
-                            metric.value = value
-                            metric.save()
-                        except Exception as msg:
-                            logging.warning(
-                                "Failed to save data (%s, %s): %s", package_url, key, msg
-                            )
+                        metrics.append({"key": f"openssf.criticality.raw.{key}", "value": value})
+                    writer.add(str(package_url), metrics)
+            writer.close()
+
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            logging.info(writer.summary())
+            logging.info(registry.summary())
+            logging.info(cache_summary())
+            logging.info("Peak RSS: %.1f MB", peak_rss)
+            self.stdout.write(f"{writer.summary()}, peak RSS {peak_rss:.1f} MB")
         except Exception as msg:
             traceback.print_exc()
             logging.warn("Error: %s", msg)
+        finally:
+            export_metrics("load_criticality_score")
+
+    @contextlib.contextmanager
+    def open_source(self, source: str):
+        """
+        Opens a URL or local file and yields it as a text stream, leaving line splitting
+        to the csv module (quoted fields may contain newlines).
+
+        Files ending in ".gz", or served as application/gzip, are decompressed on the fly.
+        """
+        if source.startswith(("http://", "https://")):
+            start_time = time.monotonic()
+            with requests.get(source, stream=True, timeout=120) as res:
+                FETCH_SECONDS.labels("criticality").observe(time.monotonic() - start_time)
+                if res.status_code != 200:
+                    ERRORS.labels("criticality", "fetch").inc()
+                    raise CommandError(f"Failure fetching criticality data: {res.status_code}")
+                # Undo any Content-Encoding, so only gzipped files are left to decompress, and
+                # keep the response open at EOF so TextIOWrapper can see the end of the file.
+                res.raw.decode_content = True
+                res.raw.auto_close = False
+                body = res.raw
+                if source.split("?")[0].endswith(".gz") or res.headers.get(
+                    "Content-Type", ""
+                ).startswith(("application/gzip", "application/x-gzip")):
+                    body = gzip.GzipFile(fileobj=res.raw)
+                with TextIOWrapper(body, encoding="utf-8", newline="") as f:
+                    yield f
+        elif source.endswith(".gz"):
+            with gzip.open(source, "rt", encoding="utf-8", newline="") as f:
+                yield f
+        else:
+            with open(source, "r", encoding="utf-8", newline="") as f:
+                yield f
@@ -1,13 +1,21 @@
 #!/usr/bin/python
+import asyncio
+import contextlib
 import json
 import logging
 import os
 import re
 import subprocess
 import sys
+import time
 
 import requests
+from app.ingestion.GitHubTokenPool import GitHubTokenPool
+from app.ingestion.MetricWriter import MetricWriter
+from app.ingestion.PackageRegistry import PackageRegistry
 from app.models import Metric, Package
+from app.purl import parse_purl
+from app.telemetry import ERRORS, FETCH_SECONDS, export_metrics
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from gql import Client, gql
@@ -19,115 +27,339 @@ from packageurl import PackageURL
 class Command(BaseCommand):
     """Refresh metadata about project releases for a GitHub repository.
 
-    This collector only applies to GitHub repositories.
+    This collector only applies to GitHub repositories. Many repositories are packed
+    into each GraphQL query using aliases, and several queries run concurrently, each
+    with whichever of the GITHUB_API_TOKENS has the most quota left.
     """
 
     GITHUB_API_ENDPOINT = "https://api.github.com/graphql"
 
+    # Times a repository whose query failed is retried, on its own, before giving up.
+    MAX_RETRIES = 2
+
+    REFS_QUERY = """
+        refs(refPrefix: "refs/tags/", last: 100{cursor}) {{
+            pageInfo {{
+                hasPreviousPage
+                startCursor
+            }}
+            nodes {{
+                name
+                target {{
+                    oid
+                    ... on Tag {{
+                        message
+                        commitUrl
+                        tagger {{
+                            name
+                            email
+                            date
+                        }}
+                    }}
+                }}
+            }}
+        }}"""
+
+    RELEASES_QUERY = """
+        releases(last: 100{cursor}) {{
+            pageInfo {{
+                hasPreviousPage
+                startCursor
+            }}
+            edges {{
+                node {{
+                    tagName
+                    createdAt
+                }}
+            }}
+        }}"""
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not GITHUB_API_TOKENS:
             raise CommandError("No GitHub API tokens configured, skipping.")
 
-        github_token = GITHUB_API_TOKENS.split(",")[0]
-        headers = {"Authorization": f"token {github_token}"}
-        transport = AIOHTTPTransport(url=self.GITHUB_API_ENDPOINT, headers=headers)
-        self.client = Client(transport=transport, fetch_schema_from_transport=True)
+        self.tokens = GitHubTokenPool.shared()
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=25,
+            help="Number of repositories to request in each GraphQL query.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of GraphQL queries to run at the same time.",
+        )
+        parser.add_argument(
+            "--max-pages",
+            type=int,
+            default=10,
+            help="Maximum number of pages (of 100) of tags and releases to read per repository.",
+        )
 
     def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.concurrency = options["concurrency"]
+        self.max_pages = options["max_pages"]
+
+        writer = MetricWriter("openssf.version.github.", registry=PackageRegistry())
+
+        packages = (
+            Package.objects.filter(package_url__startswith="pkg:github/")
+            .exclude(metric__key="openssf.version.github.release")
+            .values_list("package_url", flat=True)
+        )
+
+        repositories = []
+        for package_url in packages.iterator():
+            repository = self.parse_repository(package_url)
+            if repository:
+                repositories.append(repository)
+
+            if len(repositories) >= self.batch_size * self.concurrency * 4:
+                self.refresh(repositories, writer)
+                repositories = []
+        self.refresh(repositories, writer)
+        writer.close()
 
-        for package in Package.objects.all():
-            if package.metric_set.filter(key="openssf.version.github.release").exists():
+        logging.info(writer.summary())
+        logging.info("GitHub token quota: %s", self.tokens.summary())
+        self.stdout.write(writer.summary())
+        export_metrics("load_github_project_releases")
+
+    def parse_repository(self, package_url_str: str) -> dict:
+        package_url = parse_purl(package_url_str)
+        if package_url.type != "github":
+            logging.debug('Package URL is not of type "github", ignoring.')
+            return None
+
+        org = package_url.namespace
+        repo = package_url.name
+
+        if not org or not repo:
+            logging.warning("Ignoring %s, missing org or repo.", str(package_url))
+            return None
+
+        # Avoid GraphQL Injection
+        org = org.replace('"', "").replace("\\", "")
+        repo = repo.replace('"', "").replace("\\", "")
+
+        return {
+            "package_url": package_url_str,
+            "org": org,
+            "repo": repo,
+            "tags": [],
+            "releases": [],
+            "refs_cursor": "",
+            "releases_cursor": "",
+            "found": False,
+            "pages": 0,
+            "failed": False,
+            "attempts": 0,
+        }
+
+    def refresh(self, repositories: list, writer: MetricWriter):
+        """Retrieves tags and releases for the repositories, then queues them for writing."""
+        if not repositories:
+            return
+
+        logging.info("Gathering project releases for %d repositories", len(repositories))
+        asyncio.run(self.fetch_all(repositories))
+
+        for repository in repositories:
+            if not repository["found"]:
                 continue
+            writer.add(
+                repository["package_url"],
+                [
+                    {
+                        "key": "openssf.version.github.tag",
+                        "properties": repository["tags"],
+                    },
+                    {
+                        "key": "openssf.version.github.release",
+                        "properties": repository["releases"],
+                    },
+                ],
+            )
+
+    async def fetch_all(self, repositories: list):
+        """
+        Fetches every page of tags and releases for the repositories.
 
-            logging.info("Gathering project releases for [%s]", str(package.package_url))
+        The first round requests the newest page for every repository. Each later round
+        requests only the repositories that still have older pages, up to max_pages. A
+        repository whose query failed is retried in a batch of its own, up to
+        MAX_RETRIES times, keeping the pages already collected for it.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
 
-            package_url = PackageURL.from_string(package.package_url)
-            if package_url.type != "github":
-                logging.debug('Package URL is not of type "github", ignoring.')
-                return
+        async with contextlib.AsyncExitStack() as stack:
+            sessions = {}  # token -> session
+            for token in self.tokens.tokens:
+                transport = AIOHTTPTransport(
+                    url=self.GITHUB_API_ENDPOINT, headers={"Authorization": f"token {token}"}
+                )
+                sessions[token] = await stack.enter_async_context(
+                    Client(transport=transport, execute_timeout=120)
+                )
 
-            org = package_url.namespace
-            repo = package_url.name
+            pending = repositories
+            while pending:
+                fresh = [r for r in pending if not r["failed"]]
+                batches = [
+                    fresh[i : i + self.batch_size] for i in range(0, len(fresh), self.batch_size)
+                ]
+                batches.extend([r] for r in pending if r["failed"])
+                await asyncio.gather(
+                    *[self.fetch_batch(sessions, semaphore, batch) for batch in batches]
+                )
+                pending = [r for r in pending if self.has_more(r)]
 
-            if not org or not repo:
-                logging.warning("Ignoring %s, missing org or repo.", str(package_url))
-                return
+    def has_more(self, repository: dict) -> bool:
+        """Returns True if there's another page (or a retry) to request for a repository."""
+        if repository["failed"]:
+            return repository["attempts"] <= self.MAX_RETRIES
+        return (
+            repository["found"]
+            and repository["pages"] < self.max_pages
+            and bool(repository["refs_cursor"] or repository["releases_cursor"])
+        )
 
-            # Avoid GraphQL Injection
-            org = org.replace('"', "")
-            repo = repo.replace('"', "")
+    def fail(self, repository: dict, msg):
+        """Marks a repository's latest request as failed, to be retried."""
+        repository["failed"] = True
+        repository["attempts"] += 1
+        if repository["attempts"] > self.MAX_RETRIES:
+            logging.warning(
+                "Giving up on %s after %d attempts, keeping %d pages: %s",
+                repository["package_url"],
+                repository["attempts"],
+                repository["pages"],
+                msg,
+            )
 
-            # Provide a GraphQL query
-            query = gql(
-                """
-                {{
-                    repository(owner: "{0}", name: "{1}") {{
-                        refs(refPrefix: "refs/tags/", last: 100) {{
-                        nodes {{
-                            name
-                            target {{
-                            oid
-                            ... on Tag {{
-                                message
-                                commitUrl
-                                tagger {{
-                                name
-                                email
-                                date
-                                }}
-                            }}
-                            }}
-                        }}
-                        }}
-                    }}
-                    repository(owner: "{0}", name: "{1}") {{
-                        releases(last: 100) {{
-                            edges {{
-                                node {{
-                                    tagName
-                                    createdAt
-                                }}
-                            }}
-                        }}
-                    }}
-                }}""".format(
-                    org, repo
+    async def fetch_batch(self, sessions: dict, semaphore: asyncio.Semaphore, batch: list):
+        """
+        Requests the next page for each repository in the batch as a single query.
+        Repositories that GitHub reports as missing are marked as not found; those whose
+        part of the query failed for any other reason are marked to be retried.
+        """
+        query = ["rateLimit {\n    remaining\n    resetAt\n}"]
+        for index, repository in enumerate(batch):
+            fields = ""
+            if repository["refs_cursor"] is not None:
+                fields += self.REFS_QUERY.format(cursor=self.cursor(repository["refs_cursor"]))
+            if repository["releases_cursor"] is not None:
+                fields += self.RELEASES_QUERY.format(
+                    cursor=self.cursor(repository["releases_cursor"])
+                )
+            query.append(
+                'r{0}: repository(owner: "{1}", name: "{2}") {{{3}\n}}'.format(
+                    index, repository["org"], repository["repo"], fields
                 )
             )
 
-            # Execute the query on the transport
-            results = self.client.execute(query)
-            versions = results.get("repository", {}).get("refs", {}).get("nodes", [])
-            with transaction.atomic():
-                Metric.objects.filter(package=package, key="openssf.version.github.tag").delete()
+        errors = {}  # alias -> error
+        async with semaphore:
+            start_time = time.monotonic()
+            try:
+                results = await self.execute(sessions, gql("{\n" + "\n".join(query) + "\n}"))
+            except Exception as msg:
+                ERRORS.labels("github-releases", "fetch").inc()
+                # Missing repositories are reported as errors, alongside the data for the
+                # rest of the batch.
+                results = getattr(msg, "data", None)
+                if not results:
+                    logging.warning(
+                        "Failed to retrieve batch of %d repositories: %s", len(batch), msg
+                    )
+                    for repository in batch:
+                        self.fail(repository, msg)
+                    return
+                for error in getattr(msg, "errors", None) or []:
+                    if isinstance(error, dict) and error.get("path"):
+                        errors[error["path"][0]] = error
+            finally:
+                FETCH_SECONDS.labels("github-releases").observe(time.monotonic() - start_time)
 
-                metric, _ = Metric.objects.get_or_create(
-                    package=package, key="openssf.version.github.tag"
-                )
+        for index, repository in enumerate(batch):
+            data = results.get(f"r{index}")
+            if not data:
+                error = errors.get(f"r{index}") or {}
+                if error.get("type") == "NOT_FOUND" or (not error and not repository["found"]):
+                    logging.warning("Unable to find repository for %s", repository["package_url"])
+                    repository["failed"] = False
+                    repository["found"] = False
+                else:
+                    self.fail(repository, error.get("message") or "No data returned.")
+                continue
+            repository["found"] = True
+            repository["failed"] = False
+            repository["pages"] += 1
 
-                properties = []
-                for version in versions:
-                    date_ = version.get("target", {}).get("tagger", {}).get("date")
+            if "refs" in data:
+                tags = []
+                for version in data["refs"].get("nodes", []):
+                    date_ = ((version.get("target") or {}).get("tagger") or {}).get("date")
                     if date_:
-                        properties.append({"timestamp": date_, "value": version.get("name")})
-                metric.properties = properties
-                metric.save()
-
-                Metric.objects.filter(
-                    package=package, key="openssf.version.github.release"
-                ).delete()
-                metric, _ = Metric.objects.get_or_create(
-                    package=package, key="openssf.version.github.release"
-                )
-                properties = []
-                releases = results.get("repository", {}).get("releases", {}).get("edges", [])
-                for release in releases:
-                    properties.append(
+                        tags.append({"timestamp": date_, "value": version.get("name")})
+                repository["tags"] = tags + repository["tags"]
+                repository["refs_cursor"] = self.next_cursor(data["refs"])
+
+            if "releases" in data:
+                releases = []
+                for release in data["releases"].get("edges", []):
+                    releases.append(
                         {
                             "timestamp": release.get("node", {}).get("createdAt"),
                             "value": release.get("node", {}).get("tagName"),
                         }
                     )
-                metric.properties = properties
-                metric.save()
+                repository["releases"] = releases + repository["releases"]
+                repository["releases_cursor"] = self.next_cursor(data["releases"])
+
+    async def execute(self, sessions: dict, query) -> dict:
+        """
+        Runs a query with the token that has the most quota left (waiting, off the event
+        loop, if they're all exhausted). A query that is rate limited is retried with
+        another token.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(len(sessions) + 1):
+            token = await loop.run_in_executor(None, self.tokens.acquire, "graphql")
+            try:
+                results = await sessions[token].execute(query)
+            except Exception as msg:
+                self.tokens.update_from_graphql(
+                    token, (getattr(msg, "data", None) or {}).get("rateLimit")
+                )
+                if "RATE_LIMITED" not in str(msg) and "rate limit" not in str(msg).lower():
+                    raise
+                logging.info("GitHub token rate limited, retrying: %s", msg)
+                self.tokens.mark_exhausted(token, "graphql")
+                continue
+            finally:
+                self.tokens.release(token, "graphql")
+            self.tokens.update_from_graphql(token, results.get("rateLimit"))
+            return results
+        raise CommandError("Every GitHub token was rate limited.")
+
+    @staticmethod
+    def cursor(cursor: str) -> str:
+        """Returns the pagination argument for a cursor ("" is the first page)."""
+        if not cursor:
+            return ""
+        return ', before: "{0}"'.format(cursor.replace('"', ""))
+
+    @staticmethod
+    def next_cursor(connection: dict) -> str:
+        """Returns the cursor for the previous page, or None if there isn't one."""
+        page_info = connection.get("pageInfo") or {}
+        if page_info.get("hasPreviousPage"):
+            return page_info.get("startCursor")
+        return None
@@ -5,11 +5,16 @@ import logging
 import os
 import re
 import subprocess
+import time
 import traceback
 
 import dateutil
 import requests
+from app.ingestion.MetricWriter import WRITER_BACKENDS, MetricWriter, get_writer_class
+from app.ingestion.PackageRegistry import PackageRegistry
 from app.models import Metric, Package
+from app.purl import cache_summary, url_to_purl
+from app.telemetry import ERRORS, FETCH_SECONDS, export_metrics
 from dateutil.parser import parse
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
@@ -21,6 +26,26 @@ class Command(BaseCommand):
     Refreshes data from the OpenSSF Scorecard project.
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of records to buffer before writing to the database.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rewrite records even if they haven't changed since the last import.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=WRITER_BACKENDS,
+            default="orm",
+            help="How to write metrics: ORM bulk inserts, or COPY into a staging table "
+            "(PostgreSQL only, other databases fall back to the ORM).",
+        )
+
     def handle(self, *args, **options):
         """
         Loads data from the public data collected by the OpenSSF Scorecard project.
@@ -75,49 +100,58 @@ class Command(BaseCommand):
             if os.path.exists("/tmp/latest.json"):
                 os.remove("/tmp/latest.json")
 
+            start_time = time.monotonic()
             res = subprocess.check_output(
                 ["gsutil", "cp", "gs://ossf-scorecards/latest.json", "/tmp"]
             )
+            FETCH_SECONDS.labels("scorecard").observe(time.monotonic() - start_time)
             logging.info(res)
 
+            registry = PackageRegistry(preload=options["backend"] == "orm")
+            writer = get_writer_class(options["backend"])(
+                "openssf.scorecard.raw.",
+                batch_size=options["batch_size"],
+                registry=registry,
+                source="scorecard",
+                force=options["force"],
+            )
             with open("/tmp/latest.json", "r") as f:
                 for line in f:
                     try:
                         data = json.loads(line.strip().strip(","))
                     except Exception as msg:
+                        ERRORS.labels("scorecard", "parse").inc()
                         logging.warning("Invalid JSON: [%s]", line)
                         continue
 
-                    package_url = url2purl.url2purl("https://" + data.get("Repo"))
+                    package_url = url_to_purl("https://" + data.get("Repo"))
                     if not package_url:
+                        ERRORS.labels("scorecard", "parse").inc()
                         logging.warning(
                             "Unable to identify Package URL from repository: [%s]", data.get("Repo")
                         )
                         continue
 
-                    with transaction.atomic():
-                        date_ = parse(data.get("Date"))
-                        package, _ = Package.objects.get_or_create(package_url=str(package_url))
-
-                        Metric.objects.filter(
-                            package=package, key__startswith="openssf.scorecard.raw."
-                        ).delete()
-
-                        for check in data.get("Checks", []):
-                            check_name = check.get("Name").lower().strip()
-                            try:
-                                metric, _ = Metric.objects.get_or_create(
-                                    package=package, key=f"openssf.scorecard.raw.{check_name}"
-                                )
-                                metric.value = str(check.get("Pass")).lower()
-                                metric.properties = check
-                                metric.save()
-                            except Exception as msg:
-                                logging.warning(
-                                    "Failed to save data (%s, %s): %s", package_url, check_name, msg
-                                )
+                    metrics = []
+                    for check in data.get("Checks", []):
+                        check_name = check.get("Name").lower().strip()
+                        metrics.append(
+                            {
+                                "key": f"openssf.scorecard.raw.{check_name}",
+                                "value": str(check.get("Pass")).lower(),
+                                "properties": check,
+                            }
+                        )
+                    writer.add(str(package_url), metrics)
+            writer.close()
             os.remove("/tmp/latest.json")
+            logging.info(writer.summary())
+            logging.info(registry.summary())
+            logging.info(cache_summary())
+            self.stdout.write(writer.summary())
 
         except Exception as msg:
             traceback.print_exc()
             logging.warn("Error: %s", msg)
+        finally:
+            export_metrics("load_scorecard_data")
@@ -3,52 +3,337 @@ import glob
 import collections
 import json
 import logging
+import multiprocessing
 import os
 import re
 import subprocess
 import traceback
 import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
 import dateutil
 import requests
+from app.ingestion.Checkpoint import FileCheckpoint
+from app.ingestion.MetricWriter import WRITER_BACKENDS, MetricWriter, get_writer_class
+from app.ingestion.PackageRegistry import PackageRegistry
 from app.models import Metric, Package
+from app.purl import cache_summary, url_to_purl
+from app.telemetry import (
+    ERRORS,
+    FETCH_SECONDS,
+    RECORDS_PARSED,
+    RECORDS_UNCHANGED,
+    ROWS_WRITTEN,
+    export_metrics,
+)
 from dateutil.parser import parse
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import connection, connections, transaction
 from packageurl.contrib import purl2url, url2purl
 
+KEY_PREFIX = "openssf.scorecard.raw"
+SOURCE = "scorecard-v2"
+
+# Set in each worker process by _init_worker()
+_worker_progress = None  # type: multiprocessing.Value
+_worker_registry = None  # type: PackageRegistry
+
+
+def _init_worker(progress, registry):
+    global _worker_progress, _worker_registry
+    _worker_progress = progress
+    _worker_registry = registry
+
+
+def _add_worker_progress(num_records):
+    with _worker_progress.get_lock():
+        _worker_progress.value += num_records
+
+
+def _import_shard(
+    filename: str, batch_size: int, force: bool, backend: str = "orm", resume: bool = False
+) -> dict:
+    """Imports a single shard inside a worker process, returning its statistics."""
+    writer = get_writer_class(backend)(
+        KEY_PREFIX, batch_size=batch_size, registry=_worker_registry, source=SOURCE, force=force
+    )
+    try:
+        num_errors = Command().import_file(
+            filename, writer, on_progress=_add_worker_progress, resume=resume
+        )
+        writer.close()
+    finally:
+        connections.close_all()
+    return {
+        "records": writer.num_records,
+        "rows": writer.num_rows,
+        "failed": writer.num_failed,
+        "new": writer.num_new,
+        "changed": writer.num_changed,
+        "unchanged": writer.num_unchanged,
+        "errors": num_errors,
+    }
+
 
 class Command(BaseCommand):
     """
     Refreshes data from the OpenSSF Scorecard-v2 project.
     """
-    
+
+    PROGRESS_INTERVAL = 1000
+    CHECKPOINT_INTERVAL = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of records to buffer before writing to the database.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes to import shards with (PostgreSQL only).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rewrite records even if they haven't changed since the last import.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=WRITER_BACKENDS,
+            default="orm",
+            help="How to write metrics: ORM bulk inserts, or COPY into a staging table "
+            "(PostgreSQL only, other databases fall back to the ORM).",
+        )
+        parser.add_argument(
+            "--shards",
+            help="Glob of newline-delimited JSON shards to import instead of extracting "
+            "the latest results from BigQuery.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue an interrupted import from its last checkpoint, reusing the "
+            "shards already downloaded.",
+        )
+
     def handle(self, *args, **options):
         """
         Loads data from the public data collected by the OpenSSF Scorecard-v2 project.
         """
         logging.info("Gathering all scorecard data.")
     
-        num_imported = 0
         sample_filename = glob.glob("/tmp/bq_extract-*.json")
-        if not sample_filename or os.stat(sample_filename[0]).st_mtime < (time.time() - (60 * 60 * 24)):
+        if options["shards"]:
+            logging.info("Importing shards matching %s.", options["shards"])
+        elif options["resume"] and sample_filename:
+            logging.info("Resuming import of existing BigQuery data.")
+        elif not sample_filename or os.stat(sample_filename[0]).st_mtime < (time.time() - (60 * 60 * 24)):
             self.load_from_bigquery()
         else:
             logging.info("BigQuery data was retrieved recently, skipping.")
 
-        for filename in glob.glob("/tmp/bq_extract-*.json"):
-            logging.info("Processing file: %s", filename)
-            with open(filename, "r") as f:
-                for line in f:
-                    num_imported += 1
-                    if num_imported % 1000 == 0:
-                        logging.info("Imported %d records", num_imported)
+        filenames = sorted(glob.glob(options["shards"] or "/tmp/bq_extract-*.json"))
+        if not options["resume"]:
+            FileCheckpoint.clear_all(SOURCE)
+
+        # The COPY backend resolves packages in SQL, so there's no need to preload them.
+        registry = PackageRegistry(preload=options["backend"] == "orm")
+
+        num_workers = options["workers"]
+        if num_workers > 1 and connection.vendor != "postgresql":
+            # SQLite (and the like) allow one writer at a time, so parallel shards fail with
+            # "database is locked" when their checkpoints and flushes collide.
+            logging.warning(
+                "Parallel imports need PostgreSQL, importing with 1 worker on %s.",
+                connection.vendor,
+            )
+            num_workers = 1
+
+        if num_workers > 1 and len(filenames) > 1:
+            self.import_parallel(
+                filenames,
+                num_workers,
+                options["batch_size"],
+                options["force"],
+                registry,
+                options["backend"],
+                options["resume"],
+            )
+        else:
+            writer = get_writer_class(options["backend"])(
+                KEY_PREFIX,
+                batch_size=options["batch_size"],
+                registry=registry,
+                source=SOURCE,
+                force=options["force"],
+            )
+            num_imported = 0
+
+            def log_progress(num_records):
+                nonlocal num_imported
+                num_imported += num_records
+                logging.info("Imported %d records", num_imported)
+
+            for filename in filenames:
+                self.import_file(
+                    filename, writer, on_progress=log_progress, resume=options["resume"]
+                )
+            writer.close()
+
+            logging.info(writer.summary())
+            logging.info(registry.summary())
+            logging.info(cache_summary())
+            self.stdout.write(writer.summary())
+
+        export_metrics("load_scorecard_v2")
+
+    def import_parallel(
+        self,
+        filenames: list,
+        num_workers: int,
+        batch_size: int,
+        force: bool,
+        registry: PackageRegistry,
+        backend: str = "orm",
+        resume: bool = False,
+    ):
+        """
+        Imports shards across a pool of worker processes.
+
+        Workers are forked after the registry is loaded, so they share it instead of each
+        loading their own copy. Each worker opens its own database connection. A shard that
+        fails is logged and skipped without affecting the others.
+
+        Ingestion metrics recorded inside the workers are lost when they exit, so the
+        counters are rebuilt here from each shard's statistics. Flush durations are
+        only recorded by sequential imports.
+        """
+        start_time = time.monotonic()
+        progress = multiprocessing.Value("q", 0)
+        totals = collections.Counter()
+        failed_shards = []
+
+        # Connections can't be shared with forked children, make sure none are inherited.
+        connections.close_all()
+
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(progress, registry),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _import_shard, filename, batch_size, force, backend, resume
+                ): filename
+                for filename in filenames
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=30)
+                for future in done:
+                    filename = futures[future]
                     try:
-                        data = json.loads(line)
-                        self.import_record(data)
-                    except Exception as e:
-                        logging.warn("Error processing line: %s", line)
-                        logging.warn(traceback.format_exc())
-                        continue
+                        result = future.result()
+                        totals.update(result)
+                        RECORDS_PARSED.labels(SOURCE).inc(result["records"])
+                        RECORDS_UNCHANGED.labels(SOURCE).inc(result["unchanged"])
+                        ROWS_WRITTEN.labels(SOURCE).inc(result["rows"])
+                        ERRORS.labels(SOURCE, "write").inc(result["failed"])
+                        ERRORS.labels(SOURCE, "parse").inc(result["errors"])
+                        logging.info("Finished file: %s", filename)
+                    except Exception as msg:
+                        failed_shards.append(filename)
+                        ERRORS.labels(SOURCE, "shard").inc()
+                        logging.warning("Error processing file %s: %s", filename, msg)
+                logging.info(
+                    "Imported %d records (%d of %d files complete)",
+                    progress.value,
+                    len(futures) - len(pending),
+                    len(futures),
+                )
+
+        elapsed = time.monotonic() - start_time
+        summary = (
+            "Processed %d records (%d metrics written, %d failed) in %.1fs (%.1f records/sec)"
+            % (
+                totals["records"],
+                totals["rows"],
+                totals["failed"],
+                elapsed,
+                totals["records"] / elapsed if elapsed > 0 else 0.0,
+            )
+        )
+        summary += "; %d new, %d changed, %d unchanged" % (
+            totals["new"],
+            totals["changed"],
+            totals["unchanged"],
+        )
+        logging.info(summary)
+        self.stdout.write(summary)
+        if failed_shards:
+            logging.warning("Failed files: %s", ", ".join(failed_shards))
+            self.stderr.write("Failed files: " + ", ".join(failed_shards))
+
+    def import_file(
+        self, filename: str, writer: MetricWriter, on_progress=None, resume: bool = False
+    ):
+        """
+        Imports every record in a shard, reporting progress every PROGRESS_INTERVAL lines.
+        Returns the number of lines that couldn't be imported.
+
+        Every CHECKPOINT_INTERVAL lines, the writer is flushed and the byte offset reached
+        is saved, so that with `resume` an interrupted import skips straight past the
+        lines it already wrote.
+        """
+        checkpoint = FileCheckpoint(SOURCE, filename)
+        offset, num_lines, complete = checkpoint.load() if resume else (0, 0, False)
+        if complete:
+            logging.info("File %s was already imported, skipping.", filename)
+            return 0
+        if offset:
+            logging.info(
+                "Resuming file %s at byte %d (%d records already imported)",
+                filename,
+                offset,
+                num_lines,
+            )
+        else:
+            logging.info("Processing file: %s", filename)
+
+        num_read = 0
+        num_errors = 0
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                num_lines += 1
+                num_read += 1
+                if num_read % self.PROGRESS_INTERVAL == 0 and on_progress:
+                    on_progress(self.PROGRESS_INTERVAL)
+                try:
+                    data = json.loads(line)
+                    self.import_record(data, writer)
+                except Exception as e:
+                    num_errors += 1
+                    ERRORS.labels(SOURCE, "parse").inc()
+                    logging.warn("Error processing line: %s", line)
+                    logging.warn(traceback.format_exc())
+
+                if num_read % self.CHECKPOINT_INTERVAL == 0:
+                    writer.flush()
+                    checkpoint.save(offset, num_lines)
+
+        writer.flush()
+        checkpoint.save(offset, num_lines, complete=True)
+        if on_progress:
+            on_progress(num_read % self.PROGRESS_INTERVAL)
+        return num_errors
 
     def load_from_bigquery(self):
         logging.debug("Querying BigQuery query")
@@ -108,34 +393,28 @@ class Command(BaseCommand):
 
         logging.debug("Downloading dataset")
 
+        start_time = time.monotonic()
         res = subprocess.check_output(
             ["gsutil", "cp", "gs://ossf-scorecards-dev/bq_extract-*.json", "/tmp"],
             timeout=1200
         )
+        FETCH_SECONDS.labels(SOURCE).observe(time.monotonic() - start_time)
         logging.debug("Results: %s", res)
 
-    def import_record(self, data):
-        _date = parse(data.get("date"))
+    def import_record(self, data, writer: MetricWriter):
         _repo_name = data.get("repo", {}).get("name")
         
-        package_url = url2purl.url2purl("https://" + _repo_name)
-        package = Package.objects.get_or_create(package_url=str(package_url))[0]
-
-        with transaction.atomic():
-            Metric.objects.filter(
-                package=package, key__startswith="openssf.scorecard.raw"
-            ).delete()
+        package_url = url_to_purl("https://" + _repo_name)
 
-            for check in data.get("checks", []):
-                _check_name = check.get("name").lower().strip()
-                _check_score = int(check.get("score", "-1"))
-                try:
-                    metric = Metric.objects.get_or_create(
-                        package=package, key=f"openssf.scorecard.raw.{_check_name}"
-                    )[0]
-                    metric.value = str(_check_score)
-                    metric.properties = check
-                    metric.last_updated = _date
-                    metric.save()
-                except Exception as msg:
-                    logging.warning("Failed to save data (%s, %s): %s", package_url, _check_name, msg)
+        metrics = []
+        for check in data.get("checks", []):
+            _check_name = check.get("name").lower().strip()
+            _check_score = int(check.get("score", "-1"))
+            metrics.append(
+                {
+                    "key": f"openssf.scorecard.raw.{_check_name}",
+                    "value": str(_check_score),
+                    "properties": check,
+                }
+            )
+        writer.add(str(package_url), metrics)
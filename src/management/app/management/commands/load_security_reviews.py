@@ -8,11 +8,15 @@ import os
 import re
 import shutil
 import subprocess
+import time
 import uuid
 
 import dateutil
 import requests
-from app.models import Metric, Package
+from app.ingestion.PackageRegistry import PackageRegistry
+from app.models import IngestionState, Metric, Package
+from app.purl import cache_summary, parse_purl
+from app.telemetry import ERRORS, FETCH_SECONDS, RECORDS_PARSED, ROWS_WRITTEN, export_metrics
 from dateutil.parser import parse
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
@@ -26,49 +30,148 @@ class Command(BaseCommand):
     _payload = {}
 
     WORK_ROOT = "/tmp"
+    STATE_NAME = "security-reviews"
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repo-url",
+            default=self.SECURITY_REVIEW_REPO_URL,
+            help="Repository to load security reviews from.",
+        )
+        parser.add_argument(
+            "--mirror-dir",
+            default=os.path.join(self.WORK_ROOT, "security-reviews"),
+            help="Local clone of the repository, kept between runs.",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Re-process every review instead of only those changed since the last run.",
+        )
+
     def handle(self, *args, **options):
+        try:
+            self.sync(options)
+        finally:
+            export_metrics("load_security_reviews")
+
+    def sync(self, options: dict):
         logging.info("Gathering security reviews.")
+        self.registry = PackageRegistry()
+        self.mirror_dir = options["mirror_dir"]
 
-        CLONE_DIR = os.path.join(self.WORK_ROOT, uuid.uuid4().hex)
+        head = self.update_mirror(options["repo_url"])
+        if not head:
+            logging.warning("Missing repository, clone likely failed.")
+            return
 
-        res = subprocess.check_output(
-            ["git", "clone", "--depth", "1", self.SECURITY_REVIEW_REPO_URL, CLONE_DIR]
-        )
+        state, _ = IngestionState.objects.get_or_create(name=self.STATE_NAME)
+        last_commit = (state.value or {}).get("commit")
 
-        if not os.path.isdir(CLONE_DIR):
-            logging.warning("Missing repository, clone likely failed.")
+        if last_commit == head and not options["full"]:
+            logging.info("Security reviews are up to date (%s).", head)
             return
 
-        # Delete all security reviews
-        # TODO: Wrap in transaction
         with transaction.atomic():
-            Metric.objects.filter(key="openssf.security-review").delete()
-
-            for root, _, files in os.walk(CLONE_DIR, topdown=False):
-                for name in files:
-                    try:
-                        self.process_file(
-                            os.path.join(root, name),
-                        )
-                    except:
-                        logging.warning("Error processing file: %s", name)
-
-        shutil.rmtree(CLONE_DIR)
+            if options["full"] or not last_commit or not self.has_commit(last_commit):
+                self.sync_all()
+            else:
+                self.sync_changes(last_commit, head)
+
+            state.value = {"commit": head}
+            state.save()
+
+        logging.info(self.registry.summary())
+
+        logging.info(cache_summary())
         logging.info("Success!")
 
+    def git(self, *args) -> str:
+        return subprocess.check_output(["git", "-C", self.mirror_dir, *args]).decode("utf-8")
+
+    def update_mirror(self, repo_url: str) -> str:
+        """
+        Clones the repository on the first run and fetches it afterwards, returning the
+        commit that was checked out.
+        """
+        start_time = time.monotonic()
+        if not os.path.isdir(os.path.join(self.mirror_dir, ".git")):
+            subprocess.check_output(["git", "clone", repo_url, self.mirror_dir])
+        else:
+            self.git("remote", "set-url", "origin", repo_url)
+            self.git("fetch", "origin")
+            self.git("reset", "--hard", "origin/HEAD")
+        FETCH_SECONDS.labels(self.STATE_NAME).observe(time.monotonic() - start_time)
+
+        if not os.path.isdir(self.mirror_dir):
+            return None
+        return self.git("rev-parse", "HEAD").strip()
+
+    def has_commit(self, commit: str) -> bool:
+        try:
+            self.git("cat-file", "-e", commit + "^{commit}")
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def sync_all(self):
+        """Replaces every security review."""
+        logging.info("Processing all security reviews.")
+        Metric.objects.filter(key="openssf.security-review").delete()
+
+        for name in self.git("ls-files", "-z").split("\0"):
+            if name:
+                self.process_path(name)
+
+    def sync_changes(self, last_commit: str, head: str):
+        """Applies only the reviews that were added, modified or removed since last_commit."""
+        logging.info("Processing security reviews changed since %s.", last_commit)
+        changes = self.git("diff", "--name-status", "--no-renames", "-z", last_commit, head)
+        fields = changes.split("\0")
+        for status, name in zip(fields[0::2], fields[1::2]):
+            # Remove whatever the previous version of the review contributed
+            self.delete_review(name)
+            if status != "D":
+                self.process_path(name)
+
+    def review_path(self, filename: str) -> str:
+        """
+        Returns a file's path within the repository (such as /reviews/npm/foo.md), or
+        None if it isn't under reviews/.
+        """
+        relative_path = os.path.relpath(filename, self.mirror_dir).replace(os.sep, "/")
+        if not relative_path.startswith("reviews/"):
+            return None
+        return "/" + relative_path
+
+    def delete_review(self, name: str):
+        relative_path = self.review_path(os.path.join(self.mirror_dir, name))
+        if relative_path is None:
+            return
+        Metric.objects.filter(
+            key="openssf.security-review", **{"properties__review-url-relative": relative_path}
+        ).delete()
+
+    def process_path(self, name: str):
+        try:
+            self.process_file(os.path.join(self.mirror_dir, name))
+        except:
+            ERRORS.labels(self.STATE_NAME, "parse").inc()
+            logging.warning("Error processing file: %s", name)
+
     def process_file(self, filename):
         logging.info("Processing %s", filename)
+        RECORDS_PARSED.labels(self.STATE_NAME).inc()
         if not os.path.isfile(filename):
             logging.warning("Unable to access: %s", filename)
             return
 
-        if "/reviews/" not in filename:
+        relative_path = self.review_path(filename)
+        if relative_path is None:
             return
-        relative_path = filename[filename.find("/reviews/") :]
 
         if not filename.endswith(".md"):
             return
@@ -109,7 +212,7 @@ class Command(BaseCommand):
 
         for package_url in metadata.get("Package-URLs"):
             try:
-                purl = PackageURL.from_string(package_url)
+                purl = parse_purl(package_url)
                 if not purl:
                     logging.warning(
                         "Unable to parse Package URL: [%s] in file [%s]", package_url, filename
@@ -124,12 +227,14 @@ class Command(BaseCommand):
                     continue
                 seen_package_url_nv.add(purl_nv)
 
-                package, _ = Package.objects.get_or_create(package_url=str(purl_nv))
+                package_id = self.registry.get_id(purl_nv)
                 metric, _ = Metric.objects.get_or_create(
-                    package=package, key="openssf.security-review"
+                    package_id=package_id, key="openssf.security-review"
                 )
                 metric.value = body
                 metric.properties = metadata  # properties
                 metric.save()
+                ROWS_WRITTEN.labels(self.STATE_NAME).inc()
             except Exception as msg:
+                ERRORS.labels(self.STATE_NAME, "write").inc()
                 logging.warning("Error saving metric: %s", msg)
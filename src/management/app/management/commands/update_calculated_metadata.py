@@ -5,11 +5,15 @@ import os
 import re
 import subprocess
 import sys
+from typing import List, Optional
 
 import requests
 from app.models import Metric, Package
+from app.purl import parse_purl
+from dateutil.parser import parse
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
+from django.utils import timezone
 from gql import Client, gql
 from gql.transport.aiohttp import AIOHTTPTransport
 from management.settings import GITHUB_API_TOKENS
@@ -25,45 +29,100 @@ class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of packages to update in each transaction.",
+        )
+        parser.add_argument(
+            "--since",
+            help="Only update packages that were updated after this date/time.",
+        )
+
     def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+
+        packages = Package.objects.order_by().values_list("id", "package_url")
+        if options.get("since"):
+            since = parse(options["since"])
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            packages = packages.filter(last_updated__gt=since)
+
+        num_packages = 0
+        num_metrics = 0
+        chunk = []
+        for package_id, package_url in packages.iterator(chunk_size=chunk_size):
+            chunk.append(Package(id=package_id, package_url=package_url))
+            if len(chunk) >= chunk_size:
+                num_metrics += self.update_packages(chunk)
+                num_packages += len(chunk)
+                chunk = []
+        num_metrics += self.update_packages(chunk)
+        num_packages += len(chunk)
+
+        logging.info("Updated %d metrics for %d packages.", num_metrics, num_packages)
+
+    def update_packages(self, packages: List[Package]) -> int:
+        """
+        Replaces the calculated metadata for a chunk of packages in a single transaction.
+        """
+        if not packages:
+            return 0
+
+        metrics = []
+        for package in packages:
+            try:
+                purl = parse_purl(package.package_url)
+            except ValueError:
+                purl = None
+            if not purl:
+                logging.warning("Invalid Package URL: %s", package.package_url)
+                continue
+
+            for handler in [self.handle_snyk, self.handle_isitmaintained, self.handle_project_url]:
+                metric = handler(package, purl)
+                if metric:
+                    metrics.append(metric)
+
         with transaction.atomic():
-            Metric.objects.filter(key__startswith="openssf.calc-metadata.").delete()
-            for package in Package.objects.all():
-                print(package)
-                purl = PackageURL.from_string(package.package_url)
-                if not purl:
-                    logging.warning("Invalid Package URL: %s", package.package_url)
-                    continue
-
-                self.handle_snyk(package, purl)
-                self.handle_isitmaintained(package, purl)
-                self.handle_project_url(package, purl)
-
-    def handle_snyk(self, package: Package, purl: PackageURL):
+            Metric.objects.filter(
+                package_id__in=[p.id for p in packages], key__startswith="openssf.calc-metadata."
+            ).delete()
+            Metric.objects.bulk_create(metrics, batch_size=1000)
+
+        return len(metrics)
+
+    def handle_snyk(self, package: Package, purl: PackageURL) -> Optional[Metric]:
         logging.debug("handle_snyk(%s)", package)
         snyk_url_map = {"npm": "npm-package", "docker": "docker", "pypi": "pypi"}
         if purl.type in ["npm", "docker", "pypi"]:
             metric = Metric(package=package, key="openssf.calc-metadata.snyk-advisory-url")
             metric.value = f"https://snyk.io/advisor/{snyk_url_map[purl.type]}/{package.full_name}"
-            metric.save()
+            return metric
+        return None
 
-    def handle_isitmaintained(self, package: Package, purl: PackageURL):
-        logging.debug("handle_snyk(%s)", package)
+    def handle_isitmaintained(self, package: Package, purl: PackageURL) -> Optional[Metric]:
+        logging.debug("handle_isitmaintained(%s)", package)
         if purl.type == "github":
             metric = Metric(package=package, key="openssf.calc-metadata.isitmaintained-url")
             metric.value = f"https://isitmaintained.com/project/{purl.namespace}/{purl.name}"
-            metric.save()
+            return metric
+        return None
 
-    def handle_project_url(self, package: Package, purl: PackageURL):
+    def handle_project_url(self, package: Package, purl: PackageURL) -> Optional[Metric]:
         logging.debug("handle_project_url(%s)", package)
         try:
             url = self.purl2url(purl)
             if url:
                 metric = Metric(package=package, key="openssf.calc-metadata.project-url")
                 metric.value = url
-                metric.save()
+                return metric
         except Exception as msg:
             logging.debug("Unable to find URL for [%s]: %s", str(purl), msg)
+        return None
 
     def purl2url(self, purl):
         if purl.type == "github":
@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def deduplicate_packages(apps, schema_editor):
+    """
+    Merges packages that share a package_url into the oldest one, so that
+    package_url can be made unique.
+    """
+    Package = apps.get_model("app", "Package")
+    Metric = apps.get_model("app", "Metric")
+
+    duplicates = (
+        Package.objects.values("package_url")
+        .annotate(num=Count("id"), keep_id=Min("id"))
+        .filter(num__gt=1)
+    )
+    for duplicate in duplicates:
+        others = Package.objects.filter(package_url=duplicate["package_url"]).exclude(
+            id=duplicate["keep_id"]
+        )
+        Metric.objects.filter(package__in=others).update(package_id=duplicate["keep_id"])
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_auto_20210403_2140'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_packages, migrations.RunPython.noop),
+    ]
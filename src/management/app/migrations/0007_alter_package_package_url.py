@@ -0,0 +1,18 @@
+# Generated by Django 4.1.10 on 2026-10-17 02:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_deduplicate_packages'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='package',
+            name='package_url',
+            field=models.CharField(max_length=256, unique=True),
+        ),
+    ]
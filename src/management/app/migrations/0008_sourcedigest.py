@@ -0,0 +1,31 @@
+# Generated by Django 4.1.10 on 2026-10-17 02:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_alter_package_package_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_prefix', models.CharField(max_length=256)),
+                ('digest', models.CharField(max_length=64)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.package')),
+            ],
+            options={
+                'db_table': 'source_digest',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sourcedigest',
+            constraint=models.UniqueConstraint(fields=('package', 'key_prefix'), name='source_digest_key_prefix_unique'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.10 on 2026-10-17 03:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_sourcedigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('value', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'ingestion_state',
+            },
+        ),
+    ]
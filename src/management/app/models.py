@@ -6,9 +6,11 @@ from django.db import models
 from django.db.models.fields.related import ManyToManyField
 from packageurl import PackageURL
 
+from app.purl import display_name, parse_purl
+
 
 class Package(models.Model):
-    package_url = models.CharField(max_length=256, db_index=True)
+    package_url = models.CharField(max_length=256, unique=True)
     last_updated = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
@@ -16,20 +18,11 @@ class Package(models.Model):
 
     @property
     def full_name(self):
-        purl = PackageURL.from_string(self.package_url)
-        if not purl:
-            return None
-        if purl.type in ["npm", "github"]:
-            if purl.namespace:
-                return f"{purl.namespace}/{purl.name}"
-            else:
-                return purl.name
-        else:
-            return purl.name
+        return display_name(self.package_url)
 
     @property
     def full_name_version(self):
-        purl = PackageURL.from_string(self.package_url)
+        purl = parse_purl(self.package_url)
         if purl.version:
             return f"{self.full_name}@{purl.version}"
         else:
@@ -54,3 +47,44 @@ class Metric(models.Model):
         db_table = "metric"
         ordering = ["key"]
         indexes = [models.Index(fields=["package", "key"])]
+
+
+class SourceDigest(models.Model):
+    """
+    Digest of the metrics most recently written for a package under a key prefix, used
+    by the loaders to skip records that haven't changed since the last run. Digests are
+    kept per key prefix rather than per loader, since loaders that write the same prefix
+    (such as scorecard and scorecard-v2) replace each other's rows.
+    """
+
+    package = models.ForeignKey(Package, on_delete=models.CASCADE)
+    key_prefix = models.CharField(max_length=256)
+    digest = models.CharField(max_length=64)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.package} / {self.key_prefix}"
+
+    class Meta:
+        db_table = "source_digest"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["package", "key_prefix"], name="source_digest_key_prefix_unique"
+            )
+        ]
+
+
+class IngestionState(models.Model):
+    """
+    Named state that a loader keeps between runs, such as the last commit it synced.
+    """
+
+    name = models.CharField(max_length=256, unique=True)
+    value = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        db_table = "ingestion_state"
@@ -0,0 +1,57 @@
+# Cached Package URL helpers. The same repositories show up across every data source
+# and every page render, so conversions are memoized in bounded LRU caches. Cached
+# PackageURL instances are shared between callers; their fields can't be reassigned, but
+# `qualifiers` is a plain dict, so callers must not modify it (build a new PackageURL).
+from functools import lru_cache
+from typing import Dict, Optional
+
+from packageurl import PackageURL
+from packageurl.contrib.url2purl import url2purl
+
+URL_CACHE_SIZE = 65536
+PURL_CACHE_SIZE = 65536
+DISPLAY_NAME_CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def url_to_purl(url: str) -> Optional[PackageURL]:
+    """Returns the PackageURL for a repository or package URL, or None."""
+    return url2purl(url)
+
+
+@lru_cache(maxsize=PURL_CACHE_SIZE)
+def parse_purl(package_url: str) -> PackageURL:
+    """Parses a Package URL string. Raises ValueError if it is invalid."""
+    return PackageURL.from_string(package_url)
+
+
+@lru_cache(maxsize=DISPLAY_NAME_CACHE_SIZE)
+def display_name(package_url: str) -> Optional[str]:
+    """Returns the name to show for a package, including its namespace where relevant."""
+    purl = parse_purl(package_url)
+    if not purl:
+        return None
+    if purl.type in ["npm", "github"] and purl.namespace:
+        return f"{purl.namespace}/{purl.name}"
+    return purl.name
+
+
+def cache_stats() -> Dict[str, dict]:
+    """Returns the hit/miss statistics of each cache."""
+    return {
+        "url_to_purl": url_to_purl.cache_info()._asdict(),
+        "parse_purl": parse_purl.cache_info()._asdict(),
+        "display_name": display_name.cache_info()._asdict(),
+    }
+
+
+def cache_summary() -> str:
+    """Returns a one-line summary of the caches' hit rates, for logging."""
+    parts = []
+    for name, info in cache_stats().items():
+        lookups = info["hits"] + info["misses"]
+        hit_rate = 100.0 * info["hits"] / lookups if lookups else 0.0
+        parts.append(
+            "%s %d hits, %d misses (%.1f%%)" % (name, info["hits"], info["misses"], hit_rate)
+        )
+    return "Package URL caches: " + "; ".join(parts)
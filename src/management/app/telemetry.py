@@ -0,0 +1,152 @@
+# Prometheus metrics for the ingestion commands. The loaders run as separate processes
+# (from cron), so each one writes its metrics to a file in INGESTION_METRICS_DIR when it
+# finishes, and/or pushes them to a Pushgateway. The web app's /metrics endpoint serves
+# its own process metrics along with the most recent file from each loader.
+import glob
+import logging
+import os
+from typing import Iterator
+
+from app.purl import cache_stats
+from django.conf import settings
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    disable_created_metrics,
+    push_to_gateway,
+    write_to_textfile,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+# The *_created timestamps only add noise to files that are rewritten on every run.
+disable_created_metrics()
+
+# Kept apart from the default registry, so the web app doesn't report (always empty)
+# ingestion metrics of its own alongside the ones read from the loaders' files.
+INGESTION_REGISTRY = CollectorRegistry()
+
+RECORDS_PARSED = Counter(
+    "ingestion_records_parsed",
+    "Records parsed from a source and queued for writing.",
+    ["source"],
+    registry=INGESTION_REGISTRY,
+)
+RECORDS_UNCHANGED = Counter(
+    "ingestion_records_unchanged",
+    "Records skipped because they hadn't changed since the last import.",
+    ["source"],
+    registry=INGESTION_REGISTRY,
+)
+ROWS_WRITTEN = Counter(
+    "ingestion_rows_written",
+    "Metric rows written to the database.",
+    ["source"],
+    registry=INGESTION_REGISTRY,
+)
+ERRORS = Counter(
+    "ingestion_errors",
+    "Errors while ingesting data, by stage (fetch, parse, write or shard).",
+    ["source", "stage"],
+    registry=INGESTION_REGISTRY,
+)
+FETCH_SECONDS = Histogram(
+    "ingestion_fetch_seconds",
+    "Time taken by each request to a source.",
+    ["source"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    registry=INGESTION_REGISTRY,
+)
+FLUSH_SECONDS = Histogram(
+    "ingestion_flush_seconds",
+    "Time taken to write each batch of records to the database.",
+    ["source"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=INGESTION_REGISTRY,
+)
+
+
+class PurlCacheCollector:
+    """
+    Reports the hits, misses and size of the Package URL caches in app.purl. Loaders
+    export them with the rest of their metrics (as ingestion_purl_cache_*), and the web
+    app serves its own (as purl_cache_*), so the two never share a family name.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def collect(self) -> Iterator[Metric]:
+        hits = CounterMetricFamily(
+            f"{self.prefix}_hits", "Package URL cache lookups that hit.", labels=["cache"]
+        )
+        misses = CounterMetricFamily(
+            f"{self.prefix}_misses", "Package URL cache lookups that missed.", labels=["cache"]
+        )
+        size = GaugeMetricFamily(
+            f"{self.prefix}_size", "Entries in each Package URL cache.", labels=["cache"]
+        )
+        for name, info in cache_stats().items():
+            hits.add_metric([name], info["hits"])
+            misses.add_metric([name], info["misses"])
+            size.add_metric([name], info["currsize"])
+        return iter([hits, misses, size])
+
+
+INGESTION_REGISTRY.register(PurlCacheCollector("ingestion_purl_cache"))
+REGISTRY.register(PurlCacheCollector("purl_cache"))
+
+
+def export_metrics(job: str):
+    """
+    Writes the ingestion metrics of this process to INGESTION_METRICS_DIR/<job>.prom
+    and pushes them to PROMETHEUS_PUSHGATEWAY, whichever are configured.
+    """
+    metrics_dir = settings.INGESTION_METRICS_DIR
+    if metrics_dir:
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            write_to_textfile(os.path.join(metrics_dir, f"{job}.prom"), INGESTION_REGISTRY)
+        except OSError as msg:
+            logging.warning("Unable to write metrics to %s: %s", metrics_dir, msg)
+
+    gateway = settings.PROMETHEUS_PUSHGATEWAY
+    if gateway:
+        try:
+            push_to_gateway(gateway, job=job, registry=INGESTION_REGISTRY)
+        except Exception as msg:
+            logging.warning("Unable to push metrics to %s: %s", gateway, msg)
+
+
+class MetricsFileCollector:
+    """
+    Collects the metrics files written by export_metrics(), labelling each sample with
+    the job that wrote it. Families with the same name are merged, since the text
+    format only allows each one to be declared once.
+    """
+
+    def __init__(self, metrics_dir: str):
+        self.metrics_dir = metrics_dir
+
+    def collect(self) -> Iterator[Metric]:
+        families = {}
+        for filename in sorted(glob.glob(os.path.join(self.metrics_dir, "*.prom"))):
+            job = os.path.splitext(os.path.basename(filename))[0]
+            try:
+                with open(filename, "r") as f:
+                    parsed = list(text_string_to_metric_families(f.read()))
+            except (OSError, ValueError) as msg:
+                logging.warning("Unable to read metrics file %s: %s", filename, msg)
+                continue
+
+            for family in parsed:
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = Metric(family.name, family.documentation, family.type)
+                    families[family.name] = merged
+                for sample in family.samples:
+                    merged.add_sample(sample.name, {**sample.labels, "job": job}, sample.value)
+
+        return iter(families.values())
@@ -1,3 +1,144 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import tempfile
 
-# Create your tests here.
+from app.ingestion.PageFetcher import PageFetcher
+from app.models import Metric
+from benchmark.servers import StandInServer
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+
+def project_page(first_id: int, count: int) -> bytes:
+    return json.dumps([{"id": first_id + i} for i in range(count)]).encode("utf-8")
+
+
+class PageFetcherTests(SimpleTestCase):
+    """PageFetcher against a local stand-in for the Best Practices API."""
+
+    def fetch(self, pages: list, concurrency: int = 4, latency: float = 0.0) -> list:
+        with tempfile.TemporaryDirectory() as directory:
+            with StandInServer(directory, pages, latency=latency) as server:
+                fetcher = PageFetcher(server.url + "/projects.json", concurrency=concurrency)
+                results = [[entry["id"] for entry in entries] for entries in fetcher]
+        self.assertEqual(fetcher.num_pages, len(results))
+        return results
+
+    def test_pages_are_yielded_in_order(self):
+        pages = [project_page(page * 10, 10) for page in range(12)]
+        results = self.fetch(pages, concurrency=4, latency=0.01)
+        self.assertEqual(results, [list(range(page * 10, page * 10 + 10)) for page in range(12)])
+
+    def test_stops_at_first_empty_page(self):
+        pages = [project_page(0, 3), project_page(3, 3), b"[]", project_page(6, 3)]
+        self.assertEqual(self.fetch(pages), [[0, 1, 2], [3, 4, 5]])
+
+    def test_stops_at_first_error(self):
+        pages = [project_page(0, 3), None, project_page(6, 3), project_page(9, 3)]
+        self.assertEqual(self.fetch(pages), [[0, 1, 2]])
+
+    def test_single_page_in_flight(self):
+        pages = [project_page(page * 2, 2) for page in range(3)]
+        self.assertEqual(self.fetch(pages, concurrency=1), [[0, 1], [2, 3], [4, 5]])
+
+
+@override_settings(INGESTION_METRICS_DIR=None, METRICS_ALLOWED_NETWORKS=["10.0.0.0/8"])
+class MetricsEndpointTests(SimpleTestCase):
+    """/metrics is only served to clients in METRICS_ALLOWED_NETWORKS."""
+
+    def test_allowed_network(self):
+        response = self.client.get("/metrics", REMOTE_ADDR="10.1.2.3")
+        self.assertEqual(response.status_code, 200)
+
+    def test_other_network(self):
+        response = self.client.get("/metrics", REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(response.status_code, 403)
+
+    def test_forwarded_client_is_checked(self):
+        # nginx is on an allowed network; the client it appended is not.
+        response = self.client.get(
+            "/metrics", REMOTE_ADDR="10.0.0.2", HTTP_X_FORWARDED_FOR="10.9.9.9, 203.0.113.7"
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class SecurityReviewSyncTests(TestCase):
+    """load_security_reviews against a local repository, synced after each commit."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.origin = os.path.join(temp_dir.name, "origin")
+        # A mirror directory with /reviews/ in its own path, which must not confuse the
+        # relative paths of the reviews.
+        self.mirror_dir = os.path.join(temp_dir.name, "reviews", "mirror")
+
+        self.git("init", "-q", self.origin)
+        self.git("-C", self.origin, "config", "user.email", "test@example.com")
+        self.git("-C", self.origin, "config", "user.name", "Test")
+
+    def git(self, *args):
+        subprocess.check_output(["git", *args], stderr=subprocess.STDOUT)
+
+    def write_review(self, name: str, package_urls: list, body: str):
+        filename = os.path.join(self.origin, "reviews", name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write("---\nPackage-URLs:\n")
+            f.writelines(f"  - {package_url}\n" for package_url in package_urls)
+            f.write(f"---\n{body}\n")
+
+    def commit(self):
+        self.git("-C", self.origin, "add", "-A")
+        self.git("-C", self.origin, "commit", "-q", "-m", "Update reviews")
+
+    def sync(self):
+        call_command("load_security_reviews", repo_url=self.origin, mirror_dir=self.mirror_dir)
+
+    def reviews(self) -> dict:
+        return {
+            metric.package.package_url: (
+                metric.properties["review-url-relative"],
+                metric.value,
+            )
+            for metric in Metric.objects.filter(key="openssf.security-review")
+        }
+
+    def test_added_modified_and_deleted_reviews(self):
+        self.write_review("npm/left-pad.md", ["pkg:npm/left-pad@1.0.0"], "Looks fine.")
+        self.write_review("pypi/requests.md", ["pkg:pypi/requests"], "No issues.")
+        self.commit()
+        self.sync()
+        self.assertEqual(
+            self.reviews(),
+            {
+                "pkg:npm/left-pad": ("/reviews/npm/left-pad.md", "Looks fine."),
+                "pkg:pypi/requests": ("/reviews/pypi/requests.md", "No issues."),
+            },
+        )
+
+        self.write_review("npm/left-pad.md", ["pkg:npm/left-pad"], "Found a bug.")
+        os.remove(os.path.join(self.origin, "reviews", "pypi", "requests.md"))
+        self.write_review("gem/rails.md", ["pkg:gem/rails"], "Reviewed.")
+        self.commit()
+        self.sync()
+        self.assertEqual(
+            self.reviews(),
+            {
+                "pkg:npm/left-pad": ("/reviews/npm/left-pad.md", "Found a bug."),
+                "pkg:gem/rails": ("/reviews/gem/rails.md", "Reviewed."),
+            },
+        )
+
+    def test_unchanged_repository_is_not_reprocessed(self):
+        self.write_review("npm/left-pad.md", ["pkg:npm/left-pad"], "Looks fine.")
+        self.commit()
+        self.sync()
+
+        Metric.objects.filter(key="openssf.security-review").update(value="Changed locally.")
+        self.sync()
+        self.assertEqual(
+            self.reviews(),
+            {"pkg:npm/left-pad": ("/reviews/npm/left-pad.md", "Changed locally.")},
+        )
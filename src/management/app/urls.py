@@ -6,6 +6,7 @@ from app.views import (
     api_get_package,
     general_about,
     home,
+    metrics,
     search_package,
 )
 
@@ -14,5 +15,6 @@ urlpatterns = [
     path("general/about", general_about),
     path("api/1/get-project", api_get_package),
     path("search", search_package),
+    path("metrics", metrics),
 ]
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,20 +1,25 @@
+import ipaddress
 import json
 import logging
 import os
 import random
 
 from django.apps import apps
+from django.conf import settings
 from django.core import serializers
 from django.core.management import call_command, find_commands, get_commands
 from django.core.paginator import Paginator
 from django.forms.models import model_to_dict
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.http.response import HttpResponseBadRequest
 from django.shortcuts import HttpResponseRedirect, get_object_or_404, render
 from packageurl import PackageURL
 from packageurl.contrib.url2purl import url2purl
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
 
 from app.models import Metric, Package
+from app.purl import parse_purl, url_to_purl
+from app.telemetry import MetricsFileCollector
 
 
 def home(request: HttpRequest) -> HttpResponse:
@@ -63,13 +68,13 @@ def api_get_package(request: HttpRequest) -> HttpResponse:
     purl = None
     package_url = request.GET.get("package_url")
     if package_url:
-        purl = PackageURL.from_string(package_url)
+        purl = parse_purl(package_url)
         if not purl:
             return HttpResponseBadRequest("Invalid Package URL.")
     else:
         url = request.GET.get("url")
         if url:
-            purl = url2purl(url)
+            purl = url_to_purl(url)
             if not purl:
                 return HttpResponseBadRequest("Invalid URL.")
     if not purl:
@@ -106,3 +111,41 @@ def search_package(request: HttpRequest) -> HttpResponse:
 
 def general_about(request: HttpRequest) -> HttpResponse:
     return render(request, "app/about.html", {})
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Exposes metrics in the Prometheus text format: those of this process, followed by
+    the latest ingestion metrics written by each loader.
+
+    Only clients in METRICS_ALLOWED_NETWORKS may read them. For a request relayed by
+    nginx, that's the client nginx appended to X-Forwarded-For, not nginx itself.
+    """
+    if not is_metrics_client_allowed(request):
+        return HttpResponseForbidden("Forbidden")
+
+    output = generate_latest(REGISTRY)
+    if settings.INGESTION_METRICS_DIR:
+        registry = CollectorRegistry()
+        registry.register(MetricsFileCollector(settings.INGESTION_METRICS_DIR))
+        output += generate_latest(registry)
+    return HttpResponse(output, content_type=CONTENT_TYPE_LATEST)
+
+
+def is_metrics_client_allowed(request: HttpRequest) -> bool:
+    """Returns True if the client is in one of the METRICS_ALLOWED_NETWORKS."""
+    client = request.META.get("REMOTE_ADDR", "")
+    forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
+    if forwarded_for:
+        client = forwarded_for.split(",")[-1]
+    try:
+        address = ipaddress.ip_address(client.strip())
+    except ValueError:
+        return False
+    for network in settings.METRICS_ALLOWED_NETWORKS:
+        try:
+            if address in ipaddress.ip_network(network.strip(), strict=False):
+                return True
+        except ValueError:
+            logging.warning("Invalid network in METRICS_ALLOWED_NETWORKS: %s", network)
+    return False
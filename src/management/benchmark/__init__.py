@@ -0,0 +1,6 @@
+# Ingestion benchmark. Generates synthetic source data at a configurable scale, serves
+# the network sources from local stand-in servers, and runs each load_* command against
+# a scratch database, reporting throughput, queries per record and peak memory as JSON.
+#
+# Usage (from src/management):
+#   python -m benchmark --scale 10000 --output results.json
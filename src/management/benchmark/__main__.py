@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from benchmark import generators
+from benchmark.runner import run
+from benchmark.servers import StandInServer
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(__file__),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark", description="Benchmarks the ingestion commands."
+    )
+    parser.add_argument("--scale", type=int, default=10000, help="Records per source.")
+    parser.add_argument("--shards", type=int, default=4, help="Number of scorecard-v2 shards.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic data.")
+    parser.add_argument(
+        "--database",
+        choices=["sqlite", "configured"],
+        default="sqlite",
+        help="Run against a scratch SQLite database, or the database configured through "
+        "DB_ENGINE/DB_DATABASE/... (which should be a scratch PostgreSQL database).",
+    )
+    parser.add_argument("--backend", choices=["orm", "copy"], default="orm")
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=2,
+        help="Times to run each loader. Later runs measure re-importing unchanged data.",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds of latency per HTTP request."
+    )
+    parser.add_argument(
+        "--loaders",
+        nargs="+",
+        default=["scorecard_v2", "criticality", "bestpractices", "security_reviews"],
+        choices=["scorecard_v2", "criticality", "bestpractices", "security_reviews"],
+    )
+    parser.add_argument("--work-dir", help="Directory for generated data (default: a temp dir).")
+    parser.add_argument("--output", help="File to write the JSON report to (default: stdout).")
+    options = parser.parse_args()
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="ingestion-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    database = {"LOG_FILENAME": os.getenv("LOG_FILENAME") or os.path.join(work_dir, "log.txt")}
+    database["SECRET_KEY"] = os.getenv("SECRET_KEY") or "benchmark"
+    if options.database == "sqlite":
+        database["DB_ENGINE"] = "django.db.backends.sqlite3"
+        database["DB_DATABASE"] = os.path.join(work_dir, "benchmark.sqlite3")
+        if os.path.exists(database["DB_DATABASE"]):
+            os.remove(database["DB_DATABASE"])
+    # Metrics from the loaders aren't part of the report.
+    database["INGESTION_METRICS_DIR"] = ""
+    database["PROMETHEUS_PUSHGATEWAY"] = ""
+
+    print("Generating data in %s" % work_dir, file=sys.stderr)
+    generators.scorecard_v2_shards(work_dir, options.scale, options.shards, options.seed)
+    generators.criticality_csv(work_dir, options.scale, options.seed)
+    pages = generators.bestpractices_pages(options.scale, 200, options.seed)
+    reviews_dir = generators.security_reviews_repo(
+        os.path.join(work_dir, "security-reviews"), max(1, options.scale // 100), options.seed
+    )
+    run(database, "migrate", ["--verbosity", "0"])
+
+    backend = ["--backend", options.backend]
+    results = []
+    with StandInServer(work_dir, pages, latency=options.latency) as server:
+        loaders = {
+            "scorecard_v2": (
+                "load_scorecard_v2",
+                ["--shards", os.path.join(work_dir, "bq_extract-*.json")] + backend,
+                options.scale,
+            ),
+            "criticality": (
+                "load_criticality_score",
+                ["--source", server.url + "/all.csv.gz"] + backend,
+                options.scale,
+            ),
+            "bestpractices": (
+                "load_bestpractices_data",
+                ["--url", server.url + "/projects.json"] + backend,
+                options.scale,
+            ),
+            "security_reviews": (
+                "load_security_reviews",
+                ["--repo-url", reviews_dir, "--mirror-dir", os.path.join(work_dir, "mirror")],
+                max(1, options.scale // 100),
+            ),
+        }
+        for name in options.loaders:
+            command, args, num_records = loaders[name]
+            for run_number in range(1, options.runs + 1):
+                print("Running %s (run %d)" % (command, run_number), file=sys.stderr)
+                result = run(database, command, args)
+                results.append(
+                    {
+                        "loader": command,
+                        "run": run_number,
+                        "records": num_records,
+                        "seconds": round(result["seconds"], 3),
+                        "records_per_second": round(num_records / result["seconds"], 1),
+                        "queries": result["queries"],
+                        "queries_per_record": round(result["queries"] / num_records, 4),
+                        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+                        "vendor": result["vendor"],
+                    }
+                )
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": options.database,
+        "backend": options.backend,
+        "scale": options.scale,
+        "seed": options.seed,
+        "latency": options.latency,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
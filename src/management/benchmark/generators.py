@@ -0,0 +1,192 @@
+# Synthetic source data for the ingestion benchmark. Everything is derived from a seeded
+# random number generator, so the same scale and seed always produce the same inputs.
+# Repositories are shared between sources (as they are in the real data), so that the
+# loaders see a realistic mix of new and existing packages.
+import csv
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+from typing import List
+
+SCORECARD_CHECKS = [
+    "Binary-Artifacts",
+    "Branch-Protection",
+    "CI-Tests",
+    "CII-Best-Practices",
+    "Code-Review",
+    "Contributors",
+    "Dangerous-Workflow",
+    "Dependency-Update-Tool",
+    "Fuzzing",
+    "License",
+    "Maintained",
+    "Packaging",
+    "Pinned-Dependencies",
+    "SAST",
+    "Security-Policy",
+    "Signed-Releases",
+    "Token-Permissions",
+    "Vulnerabilities",
+]
+
+CRITICALITY_COLUMNS = [
+    "name",
+    "url",
+    "language",
+    "created_since",
+    "updated_since",
+    "contributor_count",
+    "org_count",
+    "commit_frequency",
+    "recent_releases_count",
+    "updated_issues_count",
+    "closed_issues_count",
+    "comment_frequency",
+    "dependents_count",
+    "criticality_score",
+]
+
+SCORECARD_DOCS_URL = "https://github.com/ossf/scorecard/blob/main/docs/checks.md#"
+
+LANGUAGES = ["C", "C++", "Go", "Java", "JavaScript", "Python", "Ruby", "Rust", "TypeScript"]
+
+BESTPRACTICES_STATUSES = ["Met", "Unmet", "N/A", "?"]
+
+
+def repository(index: int) -> str:
+    """Returns the repository (without scheme) for the index-th synthetic project."""
+    return f"github.com/org{index // 10}/project{index}"
+
+
+def scorecard_v2_shards(directory: str, num_records: int, num_shards: int, seed: int) -> List[str]:
+    """Writes newline-delimited JSON shards in the BigQuery export format."""
+    rng = random.Random(seed)
+    filenames = [
+        os.path.join(directory, "bq_extract-%012d.json" % shard) for shard in range(num_shards)
+    ]
+    files = [open(filename, "w") for filename in filenames]
+    try:
+        for index in range(num_records):
+            checks = []
+            for name in SCORECARD_CHECKS:
+                score = rng.randint(-1, 10)
+                checks.append(
+                    {
+                        "name": name,
+                        "score": score,
+                        "reason": f"{score} out of 10 for {name.lower()}",
+                        "details": [f"Info: detail {i}" for i in range(rng.randint(0, 5))],
+                        "documentation": {
+                            "short": f"Determines {name.lower()}.",
+                            "url": SCORECARD_DOCS_URL + name.lower(),
+                        },
+                    }
+                )
+            record = {
+                "date": "2022-01-%02d" % rng.randint(1, 28),
+                "repo": {"name": repository(index), "commit": "%040x" % rng.getrandbits(160)},
+                "scorecard": {"version": "v4.0.0", "commit": "%040x" % rng.getrandbits(160)},
+                "checks": checks,
+            }
+            files[index % num_shards].write(json.dumps(record) + "\n")
+    finally:
+        for f in files:
+            f.close()
+    return filenames
+
+
+def criticality_csv(directory: str, num_records: int, seed: int) -> str:
+    """Writes all.csv (and a gzipped copy) in the Criticality Score format."""
+    rng = random.Random(seed)
+    filename = os.path.join(directory, "all.csv")
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CRITICALITY_COLUMNS)
+        for index in range(num_records):
+            writer.writerow(
+                [
+                    f"project{index}",
+                    "https://" + repository(index),
+                    rng.choice(LANGUAGES),
+                    rng.randint(1, 200),
+                    rng.randint(0, 24),
+                    rng.randint(1, 5000),
+                    rng.randint(1, 50),
+                    round(rng.uniform(0, 100), 1),
+                    rng.randint(0, 50),
+                    rng.randint(0, 5000),
+                    rng.randint(0, 5000),
+                    round(rng.uniform(0, 10), 1),
+                    rng.randint(0, 500000),
+                    round(rng.random(), 5),
+                ]
+            )
+
+    with open(filename, "rb") as source, gzip.open(filename + ".gz", "wb") as target:
+        target.write(source.read())
+    return filename
+
+
+def bestpractices_pages(num_records: int, page_size: int, seed: int) -> List[bytes]:
+    """Returns the JSON body of each page of the Best Practices projects API."""
+    rng = random.Random(seed)
+    pages = []
+    for start in range(0, num_records, page_size):
+        entries = []
+        for index in range(start, min(start + page_size, num_records)):
+            entry = {
+                "id": index + 1,
+                "name": f"project{index}",
+                "homepage_url": f"https://project{index}.example.org",
+                "repo_url": "https://" + repository(index),
+                "badge_level": rng.choice(["in_progress", "passing", "silver", "gold"]),
+                "tiered_percentage": rng.randint(0, 300),
+                "created_at": "2021-%02d-01T00:00:00.000Z" % rng.randint(1, 12),
+            }
+            for criterion in range(40):
+                entry[f"criterion_{criterion}_status"] = rng.choice(BESTPRACTICES_STATUSES)
+                entry[f"criterion_{criterion}_justification"] = "x" * rng.randint(0, 80)
+            entries.append(entry)
+        pages.append(json.dumps(entries).encode("utf-8"))
+    return pages
+
+
+def security_reviews_repo(directory: str, num_reviews: int, seed: int) -> str:
+    """Creates a git repository laid out like ossf/security-reviews, replacing any old one."""
+    rng = random.Random(seed)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    def git(*args):
+        subprocess.check_output(
+            ["git", "-C", directory]
+            + ["-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost"]
+            + list(args)
+        )
+
+    git("init", "-q")
+    for index in range(num_reviews):
+        name = f"project{index}"
+        review_dir = os.path.join(directory, "reviews", "github", f"org{index // 10}", name)
+        os.makedirs(review_dir, exist_ok=True)
+        with open(os.path.join(review_dir, "review.md"), "w") as f:
+            f.write("---\n")
+            f.write("Publication-State: Active\n")
+            f.write("Access: Public\n")
+            f.write("Reviewers:\n- Name: Benchmark\n  Organization: OpenSSF\n")
+            f.write("Domain: Security\n")
+            f.write("Methodology:\n- Static Analysis\n- Manual Review\n")
+            f.write("Issues-Identified: %s\n" % rng.choice(["None", "Minor", "Severe"]))
+            f.write("Package-URLs:\n")
+            f.write("- pkg:github/org%d/%s@1.%d.0\n" % (index // 10, name, index % 10))
+            f.write("Review-Date: 2022-01-01\n")
+            f.write("---\n\n")
+            f.write(f"# Review of {name}\n\n")
+            for _ in range(rng.randint(1, 5)):
+                f.write("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4 + "\n\n")
+    git("add", "-A")
+    git("commit", "-q", "-m", "Add reviews")
+    return directory
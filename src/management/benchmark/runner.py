@@ -0,0 +1,52 @@
+import logging
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from multiprocessing import get_context
+
+DJANGO_SETTINGS_MODULE = "management.settings"
+
+
+def run_in_child(database: dict, command: str, args: list) -> dict:
+    """
+    Runs a management command in a freshly spawned process, so that its peak RSS and
+    query count aren't affected by anything that ran before it.
+    """
+    os.environ.update(database)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", DJANGO_SETTINGS_MODULE)
+
+    import django
+
+    django.setup()
+    # Progress logging would drown out the report; warnings still get through.
+    logging.disable(logging.INFO)
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    num_queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal num_queries
+        num_queries += 1
+        return execute(sql, params, many, context)
+
+    start_time = time.monotonic()
+    with connection.execute_wrapper(count_queries):
+        call_command(command, *args, stdout=StringIO(), stderr=StringIO())
+    elapsed = time.monotonic() - start_time
+
+    return {
+        "vendor": connection.vendor,
+        "seconds": elapsed,
+        "queries": num_queries,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run(database: dict, command: str, args: list) -> dict:
+    context = get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_in_child, database, command, args).result()
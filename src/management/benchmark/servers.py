@@ -0,0 +1,71 @@
+# Local stand-ins for the network sources used by the loaders.
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    """
+    Serves static files from a directory (such as all.csv), and the pages of the Best
+    Practices projects API at /projects.json?page=N. Pages past the last one are empty,
+    like the real API, and a page of None is served as a 500 error.
+    """
+
+    def __init__(self, *args, pages: List[bytes] = None, latency: float = 0.0, **kwargs):
+        self.pages = pages or []
+        self.latency = latency
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(self.path)
+        if url.path != "/projects.json":
+            return super().do_GET()
+
+        try:
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        body = self.pages[page - 1] if 0 < page <= len(self.pages) else b"[]"
+        if body is None:
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer:
+    """Runs a StandInHandler on an ephemeral local port, in a background thread."""
+
+    def __init__(self, directory: str, pages: List[bytes], latency: float = 0.0):
+        handler = partial(StandInHandler, directory=directory, pages=pages, latency=latency)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -177,3 +177,14 @@ if bool(os.getenv("CACHE_ENABLED")):
 
 
 GITHUB_API_TOKENS = os.getenv("GITHUB_API_TOKENS")
+
+# Ingestion metrics (Prometheus): loaders write them to files in this directory, which
+# /metrics serves, and/or push them to a Pushgateway.
+INGESTION_METRICS_DIR = os.getenv("INGESTION_METRICS_DIR")
+PROMETHEUS_PUSHGATEWAY = os.getenv("PROMETHEUS_PUSHGATEWAY")
+
+# Networks allowed to read /metrics (comma-separated); by default, loopback and the
+# private ranges that Docker networks use, so Prometheus can scrape the container.
+METRICS_ALLOWED_NETWORKS = os.getenv(
+    "METRICS_ALLOWED_NETWORKS", "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16"
+).split(",")
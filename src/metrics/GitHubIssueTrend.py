@@ -1,32 +1,369 @@
 #!/usr/bin/python
+import collections
+import contextlib
 import json
 import logging
 import os
 import re
+import sqlite3
 import subprocess
 import sys
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional, Tuple
 
-import requests
 from dateutil.parser import parse
 from gql import Client, gql
 from gql.transport.aiohttp import AIOHTTPTransport
 
-from .Base import BaseJob
+from .Base import CACHE_DIR, BaseJob
+
+
+class IssueStore:
+    """
+    The issues seen so far for each repository, in a SQLite database, along with how far
+    collection has got: the `updatedAt` watermark of the last complete run, and the page
+    cursor (and watermark) of a run that was interrupted part-way through.
+
+    Per-month aggregates are adjusted as each page is saved, so the metrics are read from
+    them rather than recomputed over every issue. Issues that a full pass no longer
+    returns (deleted, or transferred to another repository) are marked as gone.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS issue (
+                    repository TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    closed_at TEXT,
+                    updated_at TEXT NOT NULL,
+                    seconds_to_close INTEGER,
+                    seen_at TEXT,
+                    gone INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (repository, id)
+                )
+                """
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS issue_by_time_to_close "
+                "ON issue (repository, seconds_to_close)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS issue_by_created "
+                "ON issue (repository, gone, created_at)"
+            )
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS issue_collection (
+                    repository TEXT PRIMARY KEY,
+                    watermark TEXT,
+                    cursor TEXT,
+                    cursor_since TEXT,
+                    full_sync_at TEXT,
+                    sync_marker TEXT
+                )
+                """
+            )
+            # Issues opened and closed in each month; of those opened, how many are now
+            # open or closed; and the number and total time-to-close of those closed.
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS issue_month (
+                    repository TEXT NOT NULL,
+                    month TEXT NOT NULL,
+                    opened INTEGER NOT NULL DEFAULT 0,
+                    closed INTEGER NOT NULL DEFAULT 0,
+                    num_open INTEGER NOT NULL DEFAULT 0,
+                    num_closed INTEGER NOT NULL DEFAULT 0,
+                    timed INTEGER NOT NULL DEFAULT 0,
+                    timed_seconds INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (repository, month)
+                )
+                """
+            )
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Opens a connection for one transaction, closing it afterwards."""
+        connection = sqlite3.connect(self.filename, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def apply(connection: sqlite3.Connection, repository: str, counts: collections.Counter):
+        """Adds the changes in counts, keyed by (month, column), to the monthly aggregates."""
+        for (month, column), amount in counts.items():
+            if not amount:
+                continue
+            connection.execute(
+                f"""
+                INSERT INTO issue_month (repository, month, {column}) VALUES (?, ?, ?)
+                ON CONFLICT (repository, month) DO UPDATE
+                SET {column} = {column} + excluded.{column}
+                """,
+                (repository, month, amount),
+            )
+
+    def get_progress(self, repository: str) -> Tuple[str, str, str, str, str]:
+        """
+        Returns the (watermark, cursor, cursor_since, full_sync_at, sync_marker) for a
+        repository. sync_marker is set while a full pass is in progress.
+        """
+        with self.connect() as connection:
+            row = connection.execute(
+                """
+                SELECT watermark, cursor, cursor_since, full_sync_at, sync_marker
+                FROM issue_collection WHERE repository = ?
+                """,
+                (repository,),
+            ).fetchone()
+        return row or (None, None, None, None, None)
+
+    def save_page(
+        self, repository: str, issues: List[dict], cursor: str, since: str, marker: str = None
+    ):
+        """
+        Stores a page of issues, and the cursor to continue from, in one transaction,
+        adjusting the monthly aggregates by the difference each issue makes. During a full
+        pass, marker records that the issues were seen.
+        """
+        with self.connect() as connection:
+            ids = [issue["id"] for issue in issues]
+            counts = collections.Counter()
+            for state, created_at, closed_at in connection.execute(
+                f"""
+                SELECT state, created_at, closed_at FROM issue
+                WHERE repository = ? AND gone = 0 AND id IN ({", ".join("?" * len(ids))})
+                """,
+                (repository, *ids),
+            ):
+                add_contribution(counts, state, created_at, closed_at, -1)
+            for issue in issues:
+                add_contribution(
+                    counts, issue["state"], issue["createdAt"], issue.get("closedAt"), 1
+                )
+
+            connection.executemany(
+                """
+                INSERT INTO issue (repository, id, state, created_at, closed_at, updated_at,
+                    seconds_to_close, seen_at, gone)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                ON CONFLICT (repository, id) DO UPDATE
+                SET state = excluded.state, created_at = excluded.created_at,
+                    closed_at = excluded.closed_at, updated_at = excluded.updated_at,
+                    seconds_to_close = excluded.seconds_to_close,
+                    seen_at = COALESCE(excluded.seen_at, issue.seen_at), gone = 0
+                """,
+                [
+                    (
+                        repository,
+                        issue["id"],
+                        issue["state"],
+                        issue["createdAt"],
+                        issue.get("closedAt"),
+                        issue["updatedAt"],
+                        seconds_to_close(issue["state"], issue["createdAt"], issue.get("closedAt")),
+                        marker,
+                    )
+                    for issue in issues
+                ],
+            )
+            self.apply(connection, repository, counts)
+            connection.execute(
+                """
+                INSERT INTO issue_collection (repository, cursor, cursor_since, sync_marker)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (repository) DO UPDATE
+                SET cursor = excluded.cursor, cursor_since = excluded.cursor_since,
+                    sync_marker = excluded.sync_marker
+                """,
+                (repository, cursor, since, marker),
+            )
+
+    def finish(self, repository: str, marker: str = None) -> int:
+        """
+        Moves the watermark up to the most recent update seen, and clears the cursor. At the
+        end of a full pass, marks the issues it didn't return as gone, and returns how many.
+        """
+        num_gone = 0
+        with self.connect() as connection:
+            if marker:
+                counts = collections.Counter()
+                gone = connection.execute(
+                    """
+                    SELECT id, state, created_at, closed_at FROM issue
+                    WHERE repository = ? AND gone = 0 AND (seen_at IS NULL OR seen_at != ?)
+                    """,
+                    (repository, marker),
+                ).fetchall()
+                for _, state, created_at, closed_at in gone:
+                    add_contribution(counts, state, created_at, closed_at, -1)
+                connection.executemany(
+                    """
+                    UPDATE issue SET gone = 1, seconds_to_close = NULL
+                    WHERE repository = ? AND id = ?
+                    """,
+                    [(repository, id_) for id_, *_ in gone],
+                )
+                self.apply(connection, repository, counts)
+                num_gone = len(gone)
+
+            connection.execute(
+                """
+                UPDATE issue_collection SET cursor = NULL, cursor_since = NULL, sync_marker = NULL,
+                    full_sync_at = COALESCE(?, full_sync_at),
+                    watermark = (SELECT MAX(updated_at) FROM issue WHERE repository = ?)
+                WHERE repository = ?
+                """,
+                (marker, repository, repository),
+            )
+        return num_gone
+
+    def get_totals(self, repository: str) -> Tuple[int, int, int, int]:
+        """Returns the (num_open, num_closed, timed, timed_seconds) totals for a repository."""
+        with self.connect() as connection:
+            row = connection.execute(
+                """
+                SELECT SUM(num_open), SUM(num_closed), SUM(timed), SUM(timed_seconds)
+                FROM issue_month WHERE repository = ?
+                """,
+                (repository,),
+            ).fetchone()
+        return tuple(value or 0 for value in row)
+
+    def percentile_hours(self, repository: str, fraction: float, count: int) -> float:
+        """
+        Returns a percentile of the time-to-close, in hours, of the count closed issues,
+        interpolating between the nearest two. Only those two are read, from the index.
+        """
+        if not count:
+            return 0
+        position = (count - 1) * fraction
+        lower = int(position)
+        values = [
+            seconds
+            for (seconds,) in self.get_issues(
+                repository,
+                """
+                SELECT seconds_to_close FROM issue
+                WHERE repository = ? AND seconds_to_close IS NOT NULL
+                ORDER BY seconds_to_close LIMIT 2 OFFSET ?
+                """,
+                (lower,),
+            )
+        ]
+        if not values:
+            return 0
+        return (values[0] + (values[-1] - values[0]) * (position - lower)) / 3600
+
+    def get_issues(self, repository: str, query: str, params: tuple = ()) -> list:
+        with self.connect() as connection:
+            return connection.execute(query, (repository,) + params).fetchall()
+
+
+def seconds_to_close(state: str, created_at: str, closed_at: str) -> Optional[int]:
+    """Returns how long a closed issue took to close, or None if it isn't closed."""
+    if state != "CLOSED" or not closed_at:
+        return None
+    return round((parse(closed_at) - parse(created_at)).total_seconds())
+
+
+def add_contribution(
+    counts: collections.Counter, state: str, created_at: str, closed_at: str, sign: int
+):
+    """Adds (or, with a sign of -1, removes) an issue's share of the monthly aggregates."""
+    opened_month = created_at[:7]
+    counts[opened_month, "opened"] += sign
+    if state == "OPEN":
+        counts[opened_month, "num_open"] += sign
+    elif state == "CLOSED":
+        counts[opened_month, "num_closed"] += sign
+    if closed_at:
+        closed_month = closed_at[:7]
+        counts[closed_month, "closed"] += sign
+        seconds = seconds_to_close(state, created_at, closed_at)
+        if seconds is not None:
+            counts[closed_month, "timed"] += sign
+            counts[closed_month, "timed_seconds"] += sign * seconds
 
 
 class RefreshGithubIssueTrend(BaseJob):
-    """Refresh metadata from the most recent issues in a GitHub repository.
+    """Refresh metadata from the issues in a GitHub repository.
+
+    The full issue history is collected once and stored; later runs only fetch issues
+    updated since the previous run, and the metrics are read from aggregates kept in the
+    store. Every ISSUE_TREND_FULL_SYNC_DAYS the full history is fetched again, so that
+    issues that were deleted or transferred stop counting.
 
     This collector only applies to GitHub repositories.
     """
 
     GITHUB_API_ENDPOINT = "https://api.github.com/graphql"
+    ISSUE_STORE = os.environ.get(
+        "ISSUE_TREND_STORE", os.path.join(CACHE_DIR, "github-issues.sqlite3")
+    )
+    FULL_SYNC_DAYS = int(os.environ.get("ISSUE_TREND_FULL_SYNC_DAYS", "30"))
+
+    ISSUES_QUERY = """
+        query ($owner: String!, $name: String!, $since: DateTime, $cursor: String) {
+            rateLimit {
+                remaining
+                resetAt
+            }
+            repository(owner: $owner, name: $name) {
+                issues(
+                    first: 100
+                    after: $cursor
+                    orderBy: {field: UPDATED_AT, direction: ASC}
+                    filterBy: {since: $since}
+                ) {
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                    nodes {
+                        id
+                        createdAt
+                        closedAt
+                        updatedAt
+                        state
+                    }
+                }
+            }
+        }
+    """
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        headers = {"Authorization": f'token {self.get_api_token("github")}'}
-        transport = AIOHTTPTransport(url=self.GITHUB_API_ENDPOINT, headers=headers)
-        self.client = Client(transport=transport, fetch_schema_from_transport=True)
+        self.clients = {}  # token -> Client
+        self.store = IssueStore(self.ISSUE_STORE)
+
+    def get_client(self, token: str) -> Client:
+        if token not in self.clients:
+            headers = {"Authorization": f"token {token}"}
+            transport = AIOHTTPTransport(url=self.GITHUB_API_ENDPOINT, headers=headers)
+            self.clients[token] = Client(transport=transport, fetch_schema_from_transport=True)
+        return self.clients[token]
+
+    def execute_query(self, query, variable_values: dict) -> dict:
+        """Runs a query with the GitHub token that has the most quota left."""
+        pool = self.get_github_tokens()
+        if pool is None:
+            client = self.get_client(self.get_api_token("github", "graphql"))
+            return client.execute(query, variable_values=variable_values)
+
+        with pool.token("graphql") as token:
+            results = self.get_client(token).execute(query, variable_values=variable_values)
+        pool.update_from_graphql(token, results.get("rateLimit"))
+        return results
 
     def execute(self):
         """
@@ -45,83 +382,122 @@ class RefreshGithubIssueTrend(BaseJob):
             logging.warning("Ignoring %s, missing org or repo.", str(self.package_url))
             return
 
-        # Avoid GraphQL Injection
-        org = org.replace('"', "")
-        repo = repo.replace('"', "")
+        repository = f"{org}/{repo}".lower()
+        self.collect(org, repo, repository)
+        payloads = self.get_payloads(f"pkg:github/{org}/{repo}", repository)
 
-        # Provide a GraphQL query
-        query = gql(
-            """
-            {{
-                repository(owner: "{0}", name: "{1}") {{
-                    issues(last: 100) {{
-                        nodes {{
-                            id
-                            title
-                            createdAt
-                            closedAt
-                            state
-                        }}
-                    }}
-                }}
-            }}
-            """.format(
-                org, repo
-            )
-        )
+        logging.info("Submitting %d entries to API.", len(payloads))
+        if not self.submit(payloads):
+            raise RuntimeError(f"Failed to submit issue metrics for {self.package_url}.")
 
-        # Execute the query on the transport
-        results = self.client.execute(query)
-        issues = results.get("repository", {}).get("issues", {}).get("nodes", [])
-        if not issues:
-            logging.info("No issues found.")
+        return
 
-        num_open = 0
-        num_closed = 0
-        time_to_close_agg = []
-        time_to_close_agg_avg = 0
-
-        for issue in issues:
-            if issue.get("state") == "OPEN":
-                num_open += 1
-            elif issue.get("state") == "CLOSED":
-                num_closed += 1
-                time_to_close_agg.append(
-                    parse(issue.get("closedAt")) - parse(issue.get("createdAt"))
-                )
+    def collect(self, org: str, repo: str, repository: str) -> int:
+        """
+        Fetches the issues updated since the last run (all of them, the first time and when
+        a full pass is due), a page at a time, storing each page along with the cursor for
+        the next one, so that an interrupted run picks up where it left off. Returns the
+        number of pages fetched.
+        """
+        watermark, cursor, since, full_sync_at, marker = self.store.get_progress(repository)
+        if cursor is None:
+            since, marker = watermark, None
+            if watermark is None or self.full_sync_due(full_sync_at):
+                since, marker = None, datetime.now(timezone.utc).isoformat()
+        query = gql(self.ISSUES_QUERY)
 
-        if time_to_close_agg:
-            time_to_close_agg_avg = (
-                float(sum([r.total_seconds() for r in time_to_close_agg]))
-                / len(time_to_close_agg)
-                / (60 * 24)
+        num_pages = 0
+        while True:
+            results = self.execute_query(
+                query, {"owner": org, "name": repo, "since": since, "cursor": cursor}
             )
+            issues = (results.get("repository") or {}).get("issues") or {}
+            page_info = issues.get("pageInfo") or {}
+            num_pages += 1
+
+            cursor = page_info.get("endCursor") or cursor
+            self.store.save_page(repository, issues.get("nodes") or [], cursor, since, marker)
+            if not page_info.get("hasNextPage"):
+                break
+
+        num_gone = self.store.finish(repository, marker)
+        logging.info("Fetched %d pages of issues updated since %s.", num_pages, since or "ever")
+        if num_gone:
+            logging.info("Marked %d issues missing from the full pass as gone.", num_gone)
+        return num_pages
+
+    def full_sync_due(self, full_sync_at: str) -> bool:
+        """Returns True if the last full pass is older than FULL_SYNC_DAYS, or never ran."""
+        if not full_sync_at:
+            return True
+        return parse(full_sync_at) < datetime.now(timezone.utc) - timedelta(
+            days=self.FULL_SYNC_DAYS
+        )
+
+    def get_payloads(self, package_url: str, repository: str) -> List[dict]:
+        """Computes the issue metrics for a repository from the stored aggregates."""
+        num_open, num_closed, num_timed, timed_seconds = self.store.get_totals(repository)
 
         if num_open + num_closed == 0:
+            logging.info("No issues found.")
             open_pct = 0
         else:
             open_pct = float(num_open) / (num_open + num_closed)
 
-        payloads = [
-            {
-                "package_url": f"pkg:github/{org}/{repo}",
-                "key": "openssf.github.issue.last-100.open-pct",
-                "operation": "replace",
-                "values": [{"value": open_pct}],
-            },
-            {
-                "package_url": f"pkg:github/{org}/{repo}",
-                "key": "openssf.github.issue.last-100.time-to-close-hours",
-                "operation": "replace",
-                "values": [{"value": time_to_close_agg_avg}],
-            },
-        ]
+        mean_hours = timed_seconds / num_timed / 3600 if num_timed else 0
+        median_hours = self.store.percentile_hours(repository, 0.5, num_timed)
+        p90_hours = self.store.percentile_hours(repository, 0.9, num_timed)
 
-        logging.info("Submitting %d entries to API.", len(payloads))
-        res = requests.post(self.METRIC_API_ENDPOINT, json=payloads, timeout=120)
-        if res.status_code == 200:
-            logging.info("Success: %s", res.text)
-        else:
-            logging.warning("Failure: status code: %s", res.status_code)
+        # Issues opened and closed in each month
+        months = {}
+        for month, opened, closed in self.store.get_issues(
+            repository,
+            """
+            SELECT month, opened, closed FROM issue_month
+            WHERE repository = ? AND (opened > 0 OR closed > 0) ORDER BY month
+            """,
+        ):
+            months[month] = {"opened": opened, "closed": closed}
 
-        return
+        # The most recent 100 issues, as this collector used to report
+        last_100 = self.store.get_issues(
+            repository,
+            """
+            SELECT state, seconds_to_close / 3600.0 FROM issue
+            WHERE repository = ? AND gone = 0 ORDER BY created_at DESC LIMIT 100
+            """,
+        )
+        last_100_closed = [hours for state, hours in last_100 if state == "CLOSED" and hours]
+        last_100_open = sum(1 for state, _ in last_100 if state == "OPEN")
+
+        def payload(key: str, values: list) -> dict:
+            return {
+                "package_url": package_url,
+                "key": f"openssf.github.issue.{key}",
+                "operation": "replace",
+                "values": values,
+            }
+
+        return [
+            payload("open-pct", [{"value": open_pct}]),
+            payload("count", [{"value": num_open + num_closed}]),
+            payload("time-to-close-hours.mean", [{"value": mean_hours}]),
+            payload("time-to-close-hours.median", [{"value": median_hours}]),
+            payload("time-to-close-hours.p90", [{"value": p90_hours}]),
+            payload(
+                "count-by-month",
+                [
+                    {"timestamp": f"{month}-01", "value": counts["opened"], "properties": counts}
+                    for month, counts in months.items()
+                    if month
+                ],
+            ),
+            payload(
+                "last-100.open-pct",
+                [{"value": float(last_100_open) / len(last_100) if last_100 else 0}],
+            ),
+            payload(
+                "last-100.time-to-close-hours",
+                [{"value": sum(last_100_closed) / len(last_100_closed) if last_100_closed else 0}],
+            ),
+        ]
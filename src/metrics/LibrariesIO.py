@@ -4,7 +4,6 @@ import re
 import subprocess
 import sys
 
-import requests
 from pybraries import Search
 
 from .Base import BaseJob
@@ -68,10 +67,7 @@ class RefreshLibrariesIO(BaseJob):
                 }
             )
 
-        res = requests.post(self.METRIC_API_ENDPOINT, json=payloads, timeout=120)
-        if res.status_code == 200:
-            logging.info("Success: %s", res.text)
-        else:
-            logging.warning("Failure: status code: %s", res.status_code)
+        if not self.submit(payloads):
+            raise RuntimeError(f"Failed to submit libraries.io metrics for {self.package_url}.")
 
         return
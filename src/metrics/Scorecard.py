@@ -3,6 +3,7 @@
 # Refreshes security reviews from the authoritative source code repository.
 
 import collections
+import contextlib
 import json
 import logging
 import os
@@ -10,7 +11,6 @@ import re
 import subprocess
 
 import dateutil
-import requests
 from dateutil.parser import parse
 from packageurl.contrib import purl2url, url2purl
 
@@ -27,54 +27,65 @@ class RefreshScorecard(BaseJob):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    LATEST_URL = "https://storage.googleapis.com/ossf-scorecards/latest.json"
+
     def execute_complete(self):
         """
         Loads data from the public data collected by the OpenSSF Scorecard project.
+
+        The file is streamed and decoded a line at a time, and payloads are submitted in
+        batches as they fill, so memory use stays flat and submission overlaps with the
+        download. If the submitter falls behind, reading pauses until it catches up.
         """
         logging.info("Gathering all scorecard data.")
+        submitter = self.get_submitter()
+        num_lines = 0
         try:
-            payloads = []
-
-            res = requests.get(
-                "https://storage.googleapis.com/ossf-scorecards/latest.json", timeout=120
-            )
-            if res.status_code != 200:
-                logging.warning("Failure fetching latest JSON: %s", res.status_code)
-                return
-
-            for line in res.text.splitlines():
-                try:
-                    data = json.loads(line)
-                except Exception as msg:
-                    logging.warning("Invalid JSON: [%s]", line)
-                    continue
-
-                package_url = url2purl.url2purl("https://" + data.get("Repo"))
-                if not package_url:
-                    logging.warning(
-                        "Unable to identify Package URL from repository: [%s]", data.get("Repo")
-                    )
-                    continue
-
-                date_ = parse(data.get("Date"))
-
-                for check in data.get("Checks", []):
-                    check_name = check.get("CheckName").lower().strip()
-                    payload = {
-                        "package_url": str(package_url),
-                        "operation": "replace",
-                        "key": f"openssf.scorecard.raw.{check_name}",
-                        "values": [{"value": str(check.get("Pass")).lower(), "properties": check}],
-                    }
-                    payloads.append(payload)
-            res = requests.post(self.METRIC_API_ENDPOINT, json=payloads, timeout=120)
-            if res.status_code == 200:
-                logging.info("Success: %s", res.text)
-            else:
-                logging.warning("Failure: status code: %s", res.status_code)
+            with self.get_session().get(self.LATEST_URL, stream=True, timeout=120) as res:
+                if res.status_code != 200:
+                    logging.warning("Failure fetching latest JSON: %s", res.status_code)
+                    return
+
+                for line in res.iter_lines(chunk_size=1024 * 1024):
+                    if not line:
+                        continue
+                    num_lines += 1
+                    try:
+                        data = json.loads(line)
+                    except Exception as msg:
+                        logging.warning("Invalid JSON: [%s]", line[:200])
+                        continue
+
+                    package_url = url2purl.url2purl("https://" + data.get("Repo"))
+                    if not package_url:
+                        logging.warning(
+                            "Unable to identify Package URL from repository: [%s]",
+                            data.get("Repo"),
+                        )
+                        continue
+
+                    date_ = parse(data.get("Date"))
+
+                    for check in data.get("Checks", []):
+                        check_name = check.get("CheckName").lower().strip()
+                        submitter.submit(
+                            {
+                                "package_url": str(package_url),
+                                "operation": "replace",
+                                "key": f"openssf.scorecard.raw.{check_name}",
+                                "values": [
+                                    {"value": str(check.get("Pass")).lower(), "properties": check}
+                                ],
+                            }
+                        )
 
         except Exception as msg:
             logging.warn("Error: %s", msg)
+        finally:
+            # Whatever was read is still submitted, even if the download failed.
+            logging.info("Read %d lines of scorecard data.", num_lines)
+            if not submitter.close():
+                raise RuntimeError("Failed to submit scorecard data.")
 
     def execute(self):
         """
@@ -86,11 +97,29 @@ class RefreshScorecard(BaseJob):
         if not source_repo:
             return
 
-        token = self.get_api_token("github")
-        if not token:
-            logging.warning("Unable to retrieve Github token.")
-            return
+        # The scorecard CLI spends REST quota, so the token with the most of it left is held
+        # for the whole run, and its quota is refreshed afterwards.
+        pool = self.get_github_tokens()
+        if pool is None:
+            tokens = contextlib.nullcontext(self.get_api_token("github"))
+        else:
+            tokens = pool.token("core")
+
+        with tokens as token:
+            if not token:
+                logging.warning("Unable to retrieve Github token.")
+                return
+            try:
+                self.run_scorecard(source_repo, token)
+            finally:
+                if pool is not None:
+                    pool.refresh(self.get_session(), token)
+
+        if pool is not None:
+            logging.info("GitHub token quota: %s", pool.summary())
 
+    def run_scorecard(self, source_repo: str, token: str):
+        """Runs the scorecard CLI against a repository and submits its checks."""
         try:
             result = subprocess.run(
                 f'docker run --rm -it --env "GITHUB_AUTH_TOKEN={token}" docker.io/library/scorecard --repo={source_repo} --format json',
@@ -117,11 +146,8 @@ class RefreshScorecard(BaseJob):
                 }
                 payloads.append(payload)
 
-            res = requests.post(self.METRIC_API_ENDPOINT, json=payloads, timeout=120)
-            if res.status_code == 200:
-                logging.info("Success: %s", res.text)
-            else:
-                logging.warning("Failure: status code: %s", res.status_code)
+            if not self.submit(payloads):
+                raise RuntimeError(f"Failed to submit scorecard metrics for {self.package_url}.")
 
         except Exception as msg:
             logging.warn("Error processing Scorecard data: %s", msg)
@@ -9,7 +9,6 @@ import shutil
 import subprocess
 
 import dateutil
-import requests
 from dateutil.parser import parse
 from packageurl.contrib import purl2url
 
@@ -40,11 +39,8 @@ class RefreshSecurityReviews(BaseJob):
 
         payload_values = [v for _, v in self._payload.items()]
 
-        res = requests.post(self.METRIC_API_ENDPOINT, json=payload_values, timeout=120)
-        if res.status_code == 200:
-            logging.info("Success: %s", res.text)
-        else:
-            logging.warning("Failure: status code: %s", res.status_code)
+        if not self.submit(payload_values):
+            raise RuntimeError("Failed to submit security reviews.")
 
         shutil.rmtree("security-reviews")
 
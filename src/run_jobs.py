@@ -1,8 +1,12 @@
 import argparse
+import json
 import logging
 import os
 import subprocess
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Tuple
 
 from packageurl import PackageURL
 
@@ -10,27 +14,167 @@ import metrics
 
 logging.basicConfig(level=logging.INFO)
 
+# Collectors run for each package by --analyze and --analyze-file.
+COLLECTORS = [
+    metrics.RefreshGithubIssueTrend,
+    metrics.RefreshLibrariesIO,
+    metrics.RefreshScorecard,
+    metrics.RefreshGithubProjectReleases,
+]
+
+
+def run_collector(collector, package_url: PackageURL, task: dict):
+    """Runs one collector for one package, recording when it started."""
+    task["started"] = time.monotonic()
+    collector(package_url=package_url).execute()
+
+
+def analyze(
+    package_urls: list, concurrency: int, timeout: float, report_file=None
+) -> Tuple[bool, int]:
+    """
+    Runs every collector for every package on a thread pool, since they spend their time
+    waiting on APIs and subprocesses. At most `concurrency` collectors run at once, across
+    all packages. A collector that runs longer than `timeout` seconds is reported as timed
+    out and abandoned (threads can't be interrupted).
+
+    Writes a report for each package (as a JSON line) as soon as all of its collectors
+    have finished. Returns whether every collector succeeded, and the number abandoned.
+    """
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    reports = {}  # package_url -> report
+    remaining = {}  # package_url -> number of collectors still running
+    tasks = {}  # future -> task
+    summary = {True: 0, False: 0}  # packages where every collector succeeded, or not
+
+    for package_url in package_urls:
+        key = str(package_url)
+        if key in reports:
+            continue
+        reports[key] = {"package_url": key, "collectors": {}}
+        remaining[key] = len(COLLECTORS)
+        for collector in COLLECTORS:
+            task = {"package_url": key, "collector": collector.__name__, "started": None}
+            tasks[executor.submit(run_collector, collector, package_url, task)] = task
+
+    def finish(task: dict, status: str, error: str = None):
+        elapsed = time.monotonic() - task["started"] if task["started"] else 0.0
+        reports[task["package_url"]]["collectors"][task["collector"]] = {
+            "status": status,
+            "seconds": round(elapsed, 3),
+            "error": error,
+        }
+        if status != "success":
+            logging.warning(
+                "%s failed for [%s] (%s): %s", task["collector"], task["package_url"], status, error
+            )
+
+        remaining[task["package_url"]] -= 1
+        if remaining[task["package_url"]] == 0:
+            report = reports.pop(task["package_url"])
+            logging.info(
+                "Finished [%s]: %s",
+                report["package_url"],
+                ", ".join(f"{k}={v['status']}" for k, v in report["collectors"].items()),
+            )
+            if report_file:
+                report_file.write(json.dumps(report) + "\n")
+                report_file.flush()
+            summary[all(c["status"] == "success" for c in report["collectors"].values())] += 1
+
+    num_abandoned = 0
+    pending = set(tasks)
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            if error is None:
+                finish(tasks[future], "success")
+            else:
+                finish(tasks[future], "error", f"{type(error).__name__}: {error}")
+
+        now = time.monotonic()
+        for future in list(pending):
+            task = tasks[future]
+            if task["started"] is not None and now - task["started"] > timeout:
+                pending.remove(future)
+                num_abandoned += 1
+                finish(task, "timeout", f"Took longer than {timeout} seconds.")
+
+    logging.info(
+        "Analyzed %d packages: %d succeeded, %d had failures.",
+        summary[True] + summary[False],
+        summary[True],
+        summary[False],
+    )
+    executor.shutdown(wait=num_abandoned == 0)
+    return summary[False] == 0, num_abandoned
+
+
+def read_package_urls(filename: str) -> list:
+    """Reads PackageURLs, one per line, skipping blank lines and comments."""
+    package_urls = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                package_urls.append(PackageURL.from_string(line))
+            except ValueError as msg:
+                logging.warning("Ignoring invalid PackageURL [%s]: %s", line, msg)
+    return package_urls
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--analyze", help="PackageURL to analyze through all collectors.")
+parser.add_argument(
+    "--analyze-file", help="File of PackageURLs (one per line) to analyze through all collectors."
+)
 parser.add_argument("--analyze-all", action="store_true", help="Analyze all packages available.")
+parser.add_argument(
+    "--concurrency", type=int, default=8, help="Maximum number of collectors to run at once."
+)
+parser.add_argument(
+    "--timeout", type=float, default=600, help="Seconds before a collector is abandoned."
+)
+parser.add_argument("--report", help="File to write a JSON line per analyzed package to.")
 args = parser.parse_args()
 
 if args.analyze_all:
     metrics.BestPractices.RefreshBestPractices().execute_complete()
     metrics.RefreshScorecard().execute_complete()
     metrics.SecurityReviews.RefreshSecurityReviews().execute_complete()
-elif args.analyze:
+elif args.analyze or args.analyze_file:
     try:
-        package_url = PackageURL.from_string(args.analyze)
-        if not package_url:
+        if args.analyze:
+            package_urls = [PackageURL.from_string(args.analyze)]
+        else:
+            package_urls = read_package_urls(args.analyze_file)
+        if not package_urls:
             raise Exception("Invalid PackageURL.")
 
-        metrics.RefreshGithubIssueTrend(package_url=package_url).execute()
-        metrics.RefreshLibrariesIO(package_url=package_url).execute()
-        metrics.RefreshScorecard(package_url=package_url).execute()
-        metrics.RefreshGithubProjectReleases(package_url=package_url).execute()
+        if len(package_urls) > 1:
+            # Resolve source repositories for all packages up front, in a few batched
+            # oss-find-source runs; the collectors then find them in the cache.
+            metrics.BaseJob.resolve_source_repositories(package_urls)
+
+        report_file = open(args.report, "w") if args.report else None
+        try:
+            success, num_abandoned = analyze(
+                package_urls, args.concurrency, args.timeout, report_file
+            )
+        finally:
+            if report_file:
+                report_file.close()
+
+        if num_abandoned:
+            # Exit without waiting for the collectors that timed out.
+            logging.warning("Abandoning %d collectors that timed out.", num_abandoned)
+            logging.shutdown()
+            os._exit(0 if success else 1)
         # subprocess.check_call(["bash", "scripts/distinct-committers-365.sh", str(package_url)])
-        sys.exit(0)
+        sys.exit(0 if success else 1)
     except Exception as msg:
         logging.error("Error processing URL: %s", msg)
         sys.exit(1)